@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+画像リサイズ・圧縮処理のベンチマーク
+
+合成画像のコーパス（JPEG/PNG/WebP/MPO）を指定した枚数・解像度で生成し、
+処理の段階ごと（走査・デコード・リサイズ・エンコード・書き込み）の所要時間と、
+resize_core.resize_and_compress_image および CLI の処理速度（画像/秒）を計測します。
+結果は機械可読なJSONで出力するため、バージョン間の性能比較に使用できます。
+各出力をエンコードしたコーデックのバックエンド（pillow、mozjpeg など）も記録します。
+ネットワーク接続は不要です。
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import zlib
+import argparse
+import platform
+import subprocess
+import tempfile
+import shutil
+from datetime import datetime
+from pathlib import Path
+from PIL import Image, ImageDraw, ImageFilter
+from loguru import logger
+
+import resize_core as core
+
+# ベンチマーク結果のJSON形式のバージョン
+SCHEMA_VERSION = 2
+
+# コーパスで生成する形式: 名前 → (Pillowの形式名, 拡張子)
+CORPUS_FORMATS = {
+    "jpeg": ("JPEG", ".jpg"),
+    "png": ("PNG", ".png"),
+    "webp": ("WEBP", ".webp"),
+    "mpo": ("MPO", ".jpg"),
+}
+
+
+def parse_resolution(value):
+    """'1920x1080' 形式の解像度を (幅, 高さ) に変換する関数（argparse の type 用）"""
+    try:
+        width, height = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"解像度の形式が正しくありません: {value}")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"解像度には正の値を指定してください: {value}")
+    return width, height
+
+
+def parse_args():
+    """コマンドライン引数を解析する関数"""
+    parser = argparse.ArgumentParser(
+        description="合成画像を使って画像リサイズ・圧縮処理の性能を計測し、JSONで出力します。"
+    )
+    parser.add_argument(
+        "--formats", default="jpeg,png,webp,mpo",
+        help="生成する画像形式（カンマ区切り、デフォルト: jpeg,png,webp,mpo）"
+    )
+    parser.add_argument(
+        "--resolutions", default="1920x1080,4000x3000",
+        help="生成する解像度（カンマ区切り、デフォルト: 1920x1080,4000x3000）"
+    )
+    parser.add_argument(
+        "--count", type=int, default=5,
+        help="形式・解像度の組み合わせごとに生成する枚数 (デフォルト: 5)"
+    )
+    parser.add_argument(
+        "-w", "--width", type=int, default=1280,
+        help="リサイズ後の幅 (デフォルト: 1280)"
+    )
+    parser.add_argument(
+        "-q", "--quality", type=int, default=85,
+        help="圧縮品質 (デフォルト: 85)"
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="合成画像の乱数シード (デフォルト: 0)"
+    )
+    parser.add_argument(
+        "--codec", default=None,
+        help="エンコードに使うコーデックのバックエンド（auto、pillow、mozjpeg など。省略時は Pillow）"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="CLI計測時のワーカー数 (デフォルト: 1)"
+    )
+    parser.add_argument(
+        "--skip-cli", action="store_true",
+        help="CLI全体の計測を省略する"
+    )
+    parser.add_argument(
+        "--work-dir", default=None,
+        help="コーパスと出力を置く作業ディレクトリ（省略時は一時ディレクトリ）"
+    )
+    parser.add_argument(
+        "--keep", action="store_true",
+        help="終了後も作業ディレクトリを削除しない"
+    )
+    parser.add_argument(
+        "-o", "--output", default=None,
+        help="結果JSONの出力先（省略時は標準出力）"
+    )
+    return parser.parse_args()
+
+
+def make_synthetic_image(size, seed, with_alpha=False):
+    """
+    写真に近い特徴（グラデーション・ノイズ・図形・ぼかし）を持つ合成画像を生成する関数
+
+    Args:
+        size: 画像サイズ (幅, 高さ)
+        seed: 乱数シード（同じ値なら同じ画像になる）
+        with_alpha: アルファチャンネルを付けるか
+
+    Returns:
+        Image: 生成した画像
+    """
+    rng = random.Random(seed)
+    width, height = size
+
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40 + rng.random() * 40)
+    img = Image.merge("RGB", (gradient, noise, gradient.rotate(180)))
+
+    # ランダムな図形でエッジや色の変化を加える
+    draw = ImageDraw.Draw(img)
+    for _ in range(40):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1 = min(width, x0 + rng.randrange(1, max(2, width // 4)))
+        y1 = min(height, y0 + rng.randrange(1, max(2, height // 4)))
+        color = tuple(rng.randrange(256) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.ellipse((x0, y0, x1, y1), fill=color)
+        else:
+            draw.rectangle((x0, y0, x1, y1), outline=color, width=3)
+    img = img.filter(ImageFilter.GaussianBlur(1))
+
+    if with_alpha:
+        img.putalpha(gradient)
+    return img
+
+
+def generate_corpus(corpus_dir, formats, resolutions, count, seed):
+    """
+    合成画像のコーパスを生成する関数
+
+    Returns:
+        dict: 生成結果の概要（形式ごとの枚数・合計バイト数）
+    """
+    summary = {}
+    for fmt in formats:
+        pil_format, ext = CORPUS_FORMATS[fmt]
+        fmt_dir = corpus_dir / fmt
+        fmt_dir.mkdir(parents=True, exist_ok=True)
+        files = 0
+        total_bytes = 0
+
+        for width, height in resolutions:
+            for i in range(count):
+                image_seed = zlib.crc32(f"{seed}-{fmt}-{width}x{height}-{i}".encode())
+                with_alpha = fmt == "png" and i % 2 == 1
+                img = make_synthetic_image((width, height), image_seed, with_alpha=with_alpha)
+                path = fmt_dir / f"{fmt}_{width}x{height}_{i:03d}{ext}"
+                try:
+                    if pil_format == "MPO":
+                        # 2フレームのMPO（ステレオ写真相当）として保存
+                        second = make_synthetic_image((width, height), image_seed + 1)
+                        img.save(path, "MPO", save_all=True, append_images=[second], quality=90)
+                    elif pil_format == "JPEG":
+                        img.save(path, "JPEG", quality=90)
+                    else:
+                        img.save(path, pil_format)
+                except Exception as e:
+                    logger.warning(f"{fmt} 形式の画像を生成できませんでした（スキップします）: {e}")
+                    break
+                files += 1
+                total_bytes += path.stat().st_size
+
+        summary[fmt] = {"files": files, "bytes": total_bytes}
+    return summary
+
+
+def summarize(samples):
+    """計測値（秒）のリストを集計する関数"""
+    values = sorted(samples)
+    total = sum(values)
+    return {
+        "count": len(values),
+        "total_s": round(total, 6),
+        "mean_ms": round(total / len(values) * 1000, 3) if values else 0.0,
+        "p50_ms": round(core.percentile(values, 50) * 1000, 3),
+        "p95_ms": round(core.percentile(values, 95) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3) if values else 0.0,
+    }
+
+
+def bench_stages(corpus_dir, out_dir, target_width, quality, codec=None):
+    """
+    処理の段階ごとに所要時間を計測する関数
+
+    resize_core と同じ手順（縮小デコード、Lanczosリサイズ、保存オプション、コーデックの選択）を
+    段階に分けて実行し、それぞれを計測します。
+
+    Returns:
+        tuple: (段階ごとの集計, 出力ごとの記録のリスト)
+    """
+    timings = {stage: [] for stage in ("scan", "decode", "resize", "encode", "write")}
+    outputs = []
+
+    start = time.perf_counter()
+    extensions = [ext for _, ext in CORPUS_FORMATS.values()]
+    files = list(core.iter_image_files(corpus_dir, sort=True, extensions=extensions))
+    timings["scan"].append(time.perf_counter() - start)
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    for source in files:
+        start = time.perf_counter()
+        with Image.open(source) as img:
+            original_width, original_height = img.size
+            new_size = (target_width, max(1, int(original_height * target_width / original_width)))
+            resize_needed = original_width > target_width
+            if resize_needed:
+                core.apply_jpeg_draft(img, new_size)
+            img.load()
+            timings["decode"].append(time.perf_counter() - start)
+
+            output_format = "JPEG" if img.format == "MPO" else img.format
+            start = time.perf_counter()
+            frame = core.downscale_image(img, new_size) if resize_needed else img
+            timings["resize"].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            save_options, ext = core.build_save_options(
+                output_format, core.adjust_quality_by_balance(quality, 5, output_format.lower())
+            )
+            frame = core.convert_for_output(frame, output_format)
+            data, backend = core.encode_image(frame, save_options, codec)
+            timings["encode"].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with open(out_dir / f"{source.stem}{ext}", "wb") as f:
+            f.write(data)
+        timings["write"].append(time.perf_counter() - start)
+        outputs.append({
+            "source": source.name, "format": output_format, "backend": backend, "bytes": len(data),
+        })
+
+    return {stage: summarize(samples) for stage, samples in timings.items()}, outputs
+
+
+def bench_core(corpus_dir, out_dir, target_width, quality, codec=None):
+    """
+    resize_core.resize_and_compress_image を1枚ずつ呼び出して処理速度を計測する関数
+
+    段階ごとの集計 (stages) の encode にはバックエンドごとの件数 (backends) が含まれます。
+    """
+    extensions = [ext for _, ext in CORPUS_FORMATS.values()]
+    files = sorted(core.iter_image_files(corpus_dir, extensions=extensions))
+    errors = 0
+    recorder = core.enable_instrumentation()
+    start = time.perf_counter()
+    try:
+        for source in files:
+            dest = out_dir / source.relative_to(corpus_dir)
+            success, _, _ = core.resize_and_compress_image(
+                source, dest, target_width, quality, codec=codec
+            )
+            if not success:
+                errors += 1
+    finally:
+        elapsed = time.perf_counter() - start
+        core.disable_instrumentation()
+    return {
+        "images": len(files),
+        "errors": errors,
+        "seconds": round(elapsed, 6),
+        "images_per_sec": round(len(files) / elapsed, 3) if elapsed > 0 else None,
+        "stages": recorder.summary(),
+    }
+
+
+def bench_cli(corpus_dir, out_dir, log_dir, target_width, quality, workers):
+    """CLI（resize_images.py）を別プロセスで実行し、全体の処理速度を計測する関数"""
+    files = list(core.iter_image_files(corpus_dir))
+    command = [
+        sys.executable, str(Path(__file__).with_name("resize_images.py")),
+        "-s", str(corpus_dir), "-d", str(out_dir),
+        "-w", str(target_width), "-q", str(quality), "--workers", str(workers),
+    ]
+    env = dict(os.environ, EDIT_IMG_LOG_DIR=str(log_dir))
+
+    start = time.perf_counter()
+    completed = subprocess.run(command, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    elapsed = time.perf_counter() - start
+    return {
+        "images": len(files),
+        "workers": workers,
+        "returncode": completed.returncode,
+        "seconds": round(elapsed, 6),
+        "images_per_sec": round(len(files) / elapsed, 3) if elapsed > 0 else None,
+    }
+
+
+def get_environment():
+    """計測環境の情報を収集する関数"""
+    try:
+        from importlib.metadata import version
+        package_version = version("edit-img")
+    except Exception:
+        package_version = None
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        commit = None
+
+    return {
+        "package_version": package_version,
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "pillow": Image.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "codec_backends": sorted({backend.name for backend in core.get_codec_backends()}),
+    }
+
+
+def main():
+    """メイン関数"""
+    args = parse_args()
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    formats = [f.strip().lower() for f in args.formats.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in CORPUS_FORMATS]
+    if unknown:
+        print(f"未対応の形式です: {', '.join(unknown)}", file=sys.stderr)
+        return 1
+    try:
+        resolutions = [parse_resolution(r) for r in args.resolutions.split(",") if r.strip()]
+    except argparse.ArgumentTypeError as e:
+        print(e, file=sys.stderr)
+        return 1
+
+    if args.work_dir:
+        work_dir = Path(args.work_dir)
+    else:
+        work_dir = Path(tempfile.mkdtemp(prefix="edit-img-bench-"))
+    work_dir.mkdir(parents=True, exist_ok=True)
+    corpus_dir = work_dir / "corpus"
+
+    try:
+        print(f"コーパスを生成中: {work_dir}", file=sys.stderr)
+        corpus = generate_corpus(corpus_dir, formats, resolutions, args.count, args.seed)
+
+        print("段階別の計測中...", file=sys.stderr)
+        stages, outputs = bench_stages(
+            corpus_dir, work_dir / "out_stages", args.width, args.quality, args.codec
+        )
+
+        print("resize_core の計測中...", file=sys.stderr)
+        core_result = bench_core(
+            corpus_dir, work_dir / "out_core", args.width, args.quality, args.codec
+        )
+
+        cli_result = None
+        if not args.skip_cli:
+            print("CLI の計測中...", file=sys.stderr)
+            cli_result = bench_cli(
+                corpus_dir, work_dir / "out_cli", work_dir / "log",
+                args.width, args.quality, args.workers
+            )
+
+        report = {
+            "schema": SCHEMA_VERSION,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "environment": get_environment(),
+            "config": {
+                "formats": formats,
+                "resolutions": [f"{w}x{h}" for w, h in resolutions],
+                "count": args.count,
+                "width": args.width,
+                "quality": args.quality,
+                "seed": args.seed,
+                "codec": args.codec,
+            },
+            "corpus": {
+                "files": sum(v["files"] for v in corpus.values()),
+                "bytes": sum(v["bytes"] for v in corpus.values()),
+                "by_format": corpus,
+            },
+            "stages": stages,
+            "outputs": outputs,
+            "core": core_result,
+            "cli": cli_result,
+        }
+    finally:
+        if not args.keep and not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,11 +9,37 @@
 """
 
 import os
+import io
+import asyncio
+import csv
 import sys
+import math
+import mmap
 import json
+import queue
+import re
 import shutil
 import time
+import sqlite3
+import stat
+import subprocess
+import hashlib
+import itertools
+from collections import namedtuple
+import threading
+import tempfile
+import unicodedata
+import uuid
+import zlib
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from pathlib import Path
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
 from PIL import Image, UnidentifiedImageError
 from loguru import logger
 
@@ -31,6 +57,98 @@ WINDOWS_ERROR_MESSAGES = {
     1920: "メディアが書き込み保護されています",
 }
 
+# 検索対象とする画像ファイルの拡張子（小文字）
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# 出力キャッシュのデータベースファイル名（出力先ディレクトリ直下に作成）
+CACHE_DB_NAME = ".edit-img-cache.sqlite3"
+
+# 中断・再開用のジョブジャーナル（出力先ディレクトリ直下に作成）
+JOURNAL_DB_NAME = ".edit-img-journal.sqlite3"
+
+# JPEG縮小デコード時に確保する解像度の倍率（目標サイズの何倍以上でデコードするか）
+# 大きいほど最終的なLanczos縮小の品質が保たれ、1.0で最速になる
+DRAFT_OVERSAMPLE = 2.0
+
+# リサイズ不要な画像をそのまま出力するときの複製方法（copy_source_file を参照）
+COPY_METHODS = ('auto', 'hardlink', 'copy')
+
+# reflink 用の ioctl 番号（Linux の FICLONE）
+_FICLONE = 0x40049409
+
+# 出力できる形式とその拡張子（AVIFは対応するコーデックのバックエンドがある場合のみ出力できる）
+OUTPUT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp', 'AVIF': '.avif'}
+
+# 外部エンコーダー（mozjpeg・oxipng・avifenc）の実行のタイムアウト（秒）
+CODEC_SUBPROCESS_TIMEOUT = 300
+
+# PNGの圧縮の段階（png_tier_for_balance を参照）
+# fast: 圧縮レベル1・optimize なし（速度優先）、default: optimize あり（従来どおり）、
+# max: 圧縮レベル9で PNG_MAX_STRATEGIES の zlib 戦略を並列に試し、最も小さいものを使う
+PNG_TIERS = ('fast', 'default', 'max')
+PNG_MAX_STRATEGIES = (zlib.Z_DEFAULT_STRATEGY, zlib.Z_FILTERED, zlib.Z_RLE)
+
+# 大きく縮小する場合に、整数倍の reduce()（ボックスフィルタ）で目標サイズの何倍まで先に縮小するか
+# 残りを Lanczos で縮小する。小さいほど高速（2.0 で通常の Lanczos とほぼ同等の画質）
+RESIZE_REDUCING_GAP = 2.0
+
+# サンプリングによるサイズ見積もりで切り出す領域の一辺（出力サイズ換算のピクセル）と格子の分割数
+ESTIMATE_TILE_SIZE = 128
+ESTIMATE_TILE_GRID = 3
+
+# 目標サイズに収めるための品質探索で行うエンコードの最大回数
+BYTE_BUDGET_MAX_ENCODES = 8
+
+# 画質目標（SSIM）での品質探索に使う縮小プロキシの長辺（ピクセル）と、探索で行うエンコードの最大回数
+SSIM_PROXY_SIZE = 512
+SSIM_MAX_ENCODES = 7
+
+# SSIM の計算に使う窓の一辺（ピクセル）
+SSIM_WINDOW_SIZE = 8
+
+# 出力形式の自動選択（format='auto'）で解析に使う縮小画像の長辺（ピクセル）
+ANALYSIS_THUMBNAIL_SIZE = 256
+
+# 自動選択の基準（choose_output_format を参照）
+# エントロピーがこれを超え、エッジ密度が AUTO_PHOTO_EDGE_DENSITY 以上なら写真とみなす
+AUTO_GRAPHIC_ENTROPY = 5.0
+AUTO_PHOTO_EDGE_DENSITY = 0.1
+# 写真でなく、この色数以下ならパレットPNG
+AUTO_PALETTE_COLORS = 256
+# エントロピーが AUTO_GRAPHIC_ENTROPY 以下で、エッジ密度がこれ以上なら図・スクリーンショットとみなしてPNG
+AUTO_GRAPHIC_EDGE_DENSITY = 0.05
+
+# ファイル名・出力先ディレクトリの正規化結果をキャッシュする件数
+PATH_CACHE_SIZE = 8192
+
+# sanitize_filename で使う正規表現（毎回コンパイルしないよう読み込み時に用意）
+_EMOJI_SHORTCODE_RE = re.compile(r':(\w+):')
+_SAFE_CHARS_RE = re.compile(
+    r'[a-zA-Z0-9\-_. \[\]()\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+'
+)
+_REPEATED_UNDERSCORE_RE = re.compile(r'_+')
+
+# Windowsの予約語（ファイル名として使えない名前）
+_RESERVED_NAMES = frozenset([
+    "CON", "PRN", "AUX", "NUL",
+    "COM1", "COM2", "COM3", "COM4", "COM5", "COM6", "COM7", "COM8", "COM9",
+    "LPT1", "LPT2", "LPT3", "LPT4", "LPT5", "LPT6", "LPT7", "LPT8", "LPT9",
+])
+
+# 作成済み（存在を確認済み）の出力ディレクトリ
+_created_directories = set()
+_created_directories_lock = threading.Lock()
+
+# get_directory_size の結果（ディレクトリごとの Future）
+_directory_size_cache = {}
+_directory_size_lock = threading.Lock()
+
+# 段階パイプラインの既定のI/Oスレッド数（読み込み・書き込みそれぞれ）
+PIPELINE_IO_THREADS = 4
+
+# サイズ見積もり用にスレッドごとに使い回すメモリバッファ
+_estimate_buffers = threading.local()
+
 # ログ設定
 def setup_logging(console_level="INFO", file_level="DEBUG", log_file="process_{time}.log"):
     """ロギングの設定を行います"""
@@ -49,23 +167,102 @@ def setup_logging(console_level="INFO", file_level="DEBUG", log_file="process_{t
     )
 
 
-def get_directory_size(path):
-    """ディレクトリの合計サイズを取得します"""
+def _scan_directory_size(path):
+    """os.scandir でディレクトリツリーを1回だけ走査し、ファイルサイズの合計を返します"""
     total_size = 0
-    dir_path = Path(path)
+    stack = [str(path)]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            # Windowsでは scandir の結果にサイズが含まれるため追加の stat が不要
+                            total_size += entry.stat().st_size
+                    except OSError:
+                        # ファイルアクセスエラーの場合はスキップ
+                        pass
+        except OSError:
+            # 読み取れないディレクトリはスキップ
+            pass
+    return total_size
+
+
+def get_directory_size(path, use_cache=True):
+    """
+    ディレクトリの合計サイズを取得します
+    
+    同じディレクトリの結果はキャッシュされ、ツリー全体の走査は1回だけ行われます
+    （start_directory_size_scan で走査中の場合はその完了を待ちます）。
     
+    Args:
+        path: 対象のディレクトリ
+        use_cache: キャッシュ済み・走査中の結果を使うか（False の場合は再走査してキャッシュを更新）
+        
+    Returns:
+        int: ファイルサイズの合計（バイト）。存在しない場合は 0
+    """
+    dir_path = Path(path)
     if not dir_path.exists():
         return 0
     
-    for file_path in dir_path.glob('**/*'):
-        if file_path.is_file():
-            try:
-                total_size += file_path.stat().st_size
-            except OSError:
-                # ファイルアクセスエラーの場合はスキップ
-                pass
+    key = str(dir_path.resolve())
+    with _directory_size_lock:
+        future = _directory_size_cache.get(key) if use_cache else None
+        if future is None:
+            future = Future()
+            _directory_size_cache[key] = future
+            owner = True
+        else:
+            owner = False
     
-    return total_size
+    if owner:
+        try:
+            future.set_result(_scan_directory_size(dir_path))
+        except Exception as e:
+            future.set_exception(e)
+    return future.result()
+
+
+def start_directory_size_scan(path):
+    """
+    バックグラウンドのスレッドでディレクトリの合計サイズの走査を開始します
+    
+    画像の処理と並行して走査し、結果は get_directory_size のキャッシュに保存されます。
+    
+    Args:
+        path: 対象のディレクトリ
+        
+    Returns:
+        concurrent.futures.Future: 合計サイズ（バイト）を返す Future
+    """
+    result = Future()
+    
+    def run():
+        try:
+            result.set_result(get_directory_size(path))
+        except Exception as e:
+            result.set_exception(e)
+    
+    threading.Thread(target=run, name="directory-size-scan", daemon=True).start()
+    return result
+
+
+def invalidate_directory_size(path=None):
+    """
+    get_directory_size のキャッシュを消去します
+    
+    Args:
+        path: 対象のディレクトリ（省略時はすべて消去）
+    """
+    with _directory_size_lock:
+        if path is None:
+            _directory_size_cache.clear()
+        else:
+            _directory_size_cache.pop(str(Path(path).resolve()), None)
 
 
 def calculate_reduction_rate(source_dir, dest_dir):
@@ -353,10 +550,79 @@ def create_directory_with_permissions(directory_path):
         return False, None
 
 
+def ensure_directory(directory_path):
+    """
+    出力先ディレクトリが存在することを保証します（作成済みのディレクトリは再確認しません）
+    
+    同じディレクトリに多数のファイルを出力する場合に、ファイルごとの exists()/mkdir を省きます。
+    作成済みの記録は reset_directory_cache() で消去できます。
+    
+    Args:
+        directory_path: 作成するディレクトリパス（Path オブジェクトまたは文字列）
+    
+    Returns:
+        tuple: (成功したかどうか, 作成されたディレクトリパス)
+    """
+    key = str(directory_path)
+    if key in _created_directories:
+        return True, Path(directory_path)
+    
+    success, created_dir = create_directory_with_permissions(directory_path)
+    # 代替ディレクトリが作成された場合は記録しない（毎回警告を出すため）
+    if success and created_dir is not None and str(created_dir) == key:
+        with _created_directories_lock:
+            _created_directories.add(key)
+    return success, created_dir
+
+
+def reset_directory_cache():
+    """ensure_directory の作成済みディレクトリの記録を消去します（処理の開始時に呼び出します）"""
+    with _created_directories_lock:
+        _created_directories.clear()
+
+
+@lru_cache(maxsize=1)
+def _get_numpy():
+    """numpyを1度だけインポートして返します（インストールされていない場合は None）"""
+    try:
+        import numpy
+        return numpy
+    except ImportError:
+        logger.warning("numpyがインストールされていません。画像の解析を使う機能は無効になります。")
+        return None
+
+
+@lru_cache(maxsize=1)
+def _get_emoji_module():
+    """emojiパッケージを1度だけインポートして返します（インストールされていない場合は None）"""
+    try:
+        import emoji
+        return emoji
+    except ImportError:
+        logger.warning("emojiパッケージがインストールされていません。通常の絵文字処理を使用します。")
+        return None
+
+
 def sanitize_filename(filename):
     """
     ファイル名をWindows互換に変換します。絵文字などの特殊文字も処理します。
     
+    同じ名前の変換結果はキャッシュされます（ディレクトリ名などは1回だけ変換されます）。
+    
+    Args:
+        filename: 元のファイル名
+        
+    Returns:
+        str: 安全なファイル名
+    """
+    return _sanitize_filename_cached(str(filename))
+
+
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def _sanitize_filename_cached(filename):
+    """
+    ファイル名をWindows互換に変換します。絵文字などの特殊文字も処理します。
+    
     Args:
         filename: 元のファイル名
         
@@ -364,13 +630,9 @@ def sanitize_filename(filename):
         str: 安全なファイル名
     """
     try:
-        # emojiパッケージのインポート（必要な場合のみ実行）
-        try:
-            import emoji
-            has_emoji_lib = True
-        except ImportError:
-            has_emoji_lib = False
-            logger.warning("emojiパッケージがインストールされていません。通常の絵文字処理を使用します。")
+        # emojiパッケージの取得（インポートは初回のみ）
+        emoji = _get_emoji_module()
+        has_emoji_lib = emoji is not None
         
         # 文字列に変換
         safe_name = str(filename)
@@ -386,8 +648,7 @@ def sanitize_filename(filename):
                     demojized = emoji.demojize(safe_name)
                     
                     # コロンをアンダースコアに変換し、ファイル名に適した形式にする
-                    import re
-                    safe_name = re.sub(r':(\w+):', r'_\1_', demojized)
+                    safe_name = _EMOJI_SHORTCODE_RE.sub(r'_\1_', demojized)
                     logger.debug(f"絵文字を変換: '{original_name}' -> '{safe_name}'")
             except Exception as emoji_err:
                 logger.warning(f"絵文字処理中にエラーが発生しました: {emoji_err}")
@@ -401,18 +662,12 @@ def sanitize_filename(filename):
         safe_name = ''.join(c if ord(c) >= 32 else '_' for c in safe_name)
         
         # 絵文字パッケージが使えない場合のバックアップ処理
-        if not has_emoji_lib and emoji.emoji_count(original_name) > 0:
+        # （ASCII文字と日本語など一般的な文字は正規表現にマッチし、そのまま残す）
+        if not has_emoji_lib and not _SAFE_CHARS_RE.fullmatch(safe_name):
             # unicodedataを使用した代替絵文字処理
-            import unicodedata
-            import re
-            
-            # ASCII文字と一部の一般的な非ASCII文字を許可
-            # 日本語は正規表現でマッチしないようにし、そのまま残す
-            ascii_and_safe = re.compile(r'[a-zA-Z0-9\-_. \[\]()\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff]+')
-            
             def replace_unsafe_char(c):
                 # 日本語など一般的な文字はそのまま使用
-                if ascii_and_safe.fullmatch(c):
+                if _SAFE_CHARS_RE.fullmatch(c):
                     return c
                 # 絵文字やアクセント記号などは名前に変換
                 try:
@@ -428,18 +683,13 @@ def sanitize_filename(filename):
             # 安全でないUnicode文字を処理
             safe_name = ''.join(replace_unsafe_char(c) for c in safe_name)
         
-        # Windowsの予約語をチェック
-        reserved_names = ["CON", "PRN", "AUX", "NUL",
-                         "COM1", "COM2", "COM3", "COM4", "COM5", "COM6", "COM7", "COM8", "COM9",
-                         "LPT1", "LPT2", "LPT3", "LPT4", "LPT5", "LPT6", "LPT7", "LPT8", "LPT9"]
-        
         # ファイル名と拡張子を分ける
         name_parts = os.path.splitext(safe_name)
         base_name = name_parts[0]
         extension = name_parts[1] if len(name_parts) > 1 else ""
         
         # 予約語対策
-        if base_name.upper() in reserved_names:
+        if base_name.upper() in _RESERVED_NAMES:
             base_name = base_name + "_file"
         
         # 先頭や末尾のスペースとピリオドを削除
@@ -450,8 +700,7 @@ def sanitize_filename(filename):
             base_name = "unnamed_file"
         
         # ダブルアンダースコアをシングルに置換して可読性を高める
-        import re
-        base_name = re.sub(r'_+', '_', base_name)
+        base_name = _REPEATED_UNDERSCORE_RE.sub('_', base_name)
         
         # ファイル名が長すぎる場合は切り詰め
         if len(base_name) > 200:  # Windowsの制限より少なく
@@ -470,7 +719,6 @@ def sanitize_filename(filename):
     except Exception as e:
         # 例外発生時はログに記録し、デフォルト名を使用
         logger.error(f"ファイル名の正規化中にエラーが発生しました: {e}")
-        import uuid
         return f"unnamed_file_{uuid.uuid4().hex[:8]}"
 
 
@@ -558,22 +806,13 @@ def get_destination_path(source_path, source_dir, dest_dir):
             # パス部分の分割
             path_parts = rel_path_str.split(os.sep)
             
-            # 出力先パスの構築
-            result_path = Path(dest_dir_str)
+            # 出力先パスの構築（ディレクトリ部分はディレクトリごとに1回だけ変換）
+            result_path = _plan_destination_dir(dest_dir_str, tuple(path_parts[:-1]))
             
-            # ディレクトリ部分の処理
+            # ディレクトリ作成（作成済みのディレクトリは確認を省略）
             if len(path_parts) > 1:
-                for part in path_parts[:-1]:
-                    try:
-                        part_safe = sanitize_filename(part)
-                        result_path = result_path / part_safe
-                    except Exception:
-                        # 失敗した場合はスキップして次のディレクトリ部分へ
-                        continue
-                
-                # ディレクトリ作成
                 try:
-                    create_directory_with_permissions(result_path)
+                    ensure_directory(result_path)
                 except Exception as dir_err:
                     logger.debug(f"ディレクトリ作成エラーは無視します: {dir_err}")
             
@@ -622,12 +861,74 @@ def get_destination_path(source_path, source_dir, dest_dir):
     return result_path
 
 
-def find_image_files(source_dir) -> list[Path]:
+@lru_cache(maxsize=PATH_CACHE_SIZE)
+def _plan_destination_dir(dest_dir_str, dir_parts):
+    """出力先ディレクトリと相対ディレクトリの各部分から、安全化した出力先ディレクトリを求めます"""
+    result_path = Path(dest_dir_str)
+    for part in dir_parts:
+        try:
+            result_path = result_path / sanitize_filename(part)
+        except Exception:
+            # 失敗した場合はスキップして次のディレクトリ部分へ
+            continue
+    return result_path
+
+
+def iter_image_files(source_dir, sort: bool = False, extensions=IMAGE_EXTENSIONS):
+    """
+    指定されたディレクトリを1回だけ走査し、画像ファイルを見つけた順に返します
+    
+    os.scandir によるシングルパスの走査で、拡張子は大文字・小文字を区別せずに
+    判定します（.JPG なども対象）。見つかったパスはその場で yield されるため、
+    呼び出し側は走査の完了を待たずに処理を開始できます。
+    
+    Args:
+        source_dir: 検索対象のディレクトリパス（str または Path オブジェクト）
+        sort: True の場合、各ディレクトリ内を名前順に走査して再現性のある順序で返す
+        extensions: 対象とする拡張子（小文字、ドット付き）
+        
+    Yields:
+        Path: 画像ファイルのパス
+    """
+    extensions = frozenset(ext.lower() for ext in extensions)
+    pending_dirs = [str(source_dir)]
+    
+    while pending_dirs:
+        current_dir = pending_dirs.pop()
+        sub_dirs = []
+        
+        try:
+            with os.scandir(current_dir) as it:
+                entries = sorted(it, key=lambda e: e.name) if sort else it
+                for entry in entries:
+                    try:
+                        # シンボリックリンクのディレクトリは循環を避けるため辿らない
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.path)
+                        elif (os.path.splitext(entry.name)[1].lower() in extensions
+                              and entry.is_file()):
+                            yield Path(entry.path)
+                    except OSError as e:
+                        logger.debug(f"エントリの確認中にエラーが発生しました（スキップします）: {entry.path}: {e}")
+        except PermissionError as e:
+            # 一部のサブディレクトリにはアクセスできない可能性がある
+            logger.warning(f"一部のディレクトリにアクセスできませんでした（権限エラー）: {e}")
+            continue
+        except OSError as e:
+            logger.warning(f"ファイルシステムエラー（{current_dir}）: {e}")
+            continue
+        
+        # スタックなので逆順に積み、名前順の走査を保つ
+        pending_dirs.extend(reversed(sub_dirs))
+
+
+def find_image_files(source_dir, sort: bool = True) -> list[Path]:
     """
     指定されたディレクトリから全ての.jpgと.pngファイルを検索します
     
     Args:
         source_dir: 検索対象のディレクトリパス（str または Path オブジェクト）
+        sort: True の場合、パス順に並べ替えたリストを返す
         
     Returns:
         list[Path]: 画像ファイルパスのリスト（Path）
@@ -678,9 +979,6 @@ def find_image_files(source_dir) -> list[Path]:
         # 権限チェックでエラーがあれば後続の処理で捕捉する
         pass
     
-    image_files = []
-    extensions = [".jpg", ".jpeg", ".png"]
-    
     try:
         # Windows環境の場合は長いパス対応
         if os.name == 'nt':
@@ -694,38 +992,18 @@ def find_image_files(source_dir) -> list[Path]:
         else:
             norm_path = source_path
         
-        # 一度に複数の拡張子をチェック
-        for ext in extensions:
-            try:
-                # rglob を使用して再帰的に検索 (glob の代わりにより堅牢なパターン)
-                pattern = f"*{ext}"
-                found_files = list(norm_path.rglob(pattern))
-                logger.debug(f"{ext} 拡張子のファイルを {len(found_files)} 個見つけました")
-                image_files.extend(found_files)
-            except PermissionError as e:
-                # 権限エラーの場合（一部のサブディレクトリにはアクセスできない可能性がある）
-                logger.warning(f"一部のディレクトリにアクセスできませんでした（権限エラー）: {e}")
-                continue
-            except OSError as e:
-                # ファイルシステム関連のエラー
-                logger.warning(f"ファイルシステムエラー（パターン '{pattern}'）: {e}")
-                continue
-            except Exception as e:
-                # その他の予期せぬエラー
-                logger.warning(f"画像検索中にエラーが発生しました（パターン '{pattern}'）: {e}")
-                continue
-        
-        # 重複の削除（念のため）と並べ替え
-        unique_files = list(set(image_files))
-        sorted_files = sorted(unique_files)
+        # 1回の走査で全ての拡張子をまとめて検索
+        image_files = list(iter_image_files(norm_path))
+        if sort:
+            image_files.sort()
         
-        total_found = len(sorted_files)
+        total_found = len(image_files)
         if total_found > 0:
             logger.info(f"{total_found}個の画像ファイルが見つかりました")
         else:
             logger.warning(f"画像ファイルが見つかりませんでした: {source_dir}")
         
-        return sorted_files
+        return image_files
     except PermissionError as e:
         error_msg = f"ディレクトリにアクセスする権限がありません: {e}"
         logger.error(error_msg)
@@ -740,7 +1018,17 @@ def find_image_files(source_dir) -> list[Path]:
 def resize_and_compress_image(source_path, dest_path, target_width: int, quality: int, 
                        format: str = 'original', keep_exif: bool = True, 
                        balance: int = 5, webp_lossless: bool = False, 
-                       dry_run: bool = False) -> tuple[bool, bool, int | None]:
+                       dry_run: bool = False,
+                       cache: "OutputCache | None" = None,
+                       fast_decode: bool = True,
+                       draft_oversample: float = DRAFT_OVERSAMPLE,
+                       estimate_size: bool = False,
+                       estimate_mode: str = 'full',
+                       copy_unchanged: bool = False,
+                       copy_method: str = 'auto',
+                       use_mmap: bool = False,
+                       target_ssim: float | None = None,
+                       codec: str | None = None) -> tuple[bool, bool, int | None]:
     """
     画像をリサイズして圧縮します
     
@@ -749,11 +1037,23 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
         dest_path: 出力先ファイルパス (str または Path)
         target_width: 目標の幅 (ピクセル、1以上の整数)
         quality: 圧縮品質 (1-100の整数)
-        format: 出力形式 ('original', 'jpeg', 'png', 'webp')
+        format: 出力形式 ('original', 'auto', 'jpeg', 'png', 'webp', 'avif')
         keep_exif: EXIFメタデータを保持するか
-        balance: 圧縮と品質のバランス (1-10, 1=最高圧縮率, 10=最高品質)
+        balance: 圧縮と品質のバランス (1-10, 1=最高圧縮率, 10=最高品質。PNGでは圧縮の段階を選ぶ: png_tier_for_balance を参照)
         webp_lossless: WebPをロスレスで保存するかどうか
         dry_run: 実際の処理を行わずサイズ見積もりのみ実施
+        cache: 出力キャッシュ。指定した場合、出力が最新のファイルは処理をスキップする
+        fast_decode: 大きく縮小するJPEGをDCTスケーリングで縮小デコードするか
+        draft_oversample: 縮小デコード時に目標サイズの何倍以上の解像度を確保するか
+        estimate_size: 実際の保存時にも見積もりサイズを計算するか（ドライランでは常に計算）
+        estimate_mode: 見積もり方法 ('full'=全体をエンコード, 'sampled'=一部の領域から推定)
+        copy_unchanged: リサイズも形式変換も不要な画像を、デコード・再エンコードせずにそのままコピーするか
+        copy_method: copy_unchanged でコピーするときの複製方法 ('auto', 'hardlink', 'copy')
+        use_mmap: 元ファイルをメモリマップして Pillow に渡すか（巨大なTIFF/PNGをローカルディスクから読む場合に有効）
+        target_ssim: 指定した場合、リサイズ後の画像との SSIM がこの値以上になる最低の品質で保存する
+                     （JPEG・ロッシーのWebPのみ。balance で調整した品質が上限。numpy が必要）
+        codec: エンコードに使うコーデックのバックエンド (None=Pillow, 'auto'=使用可能な中で優先度が最も高いもの,
+               'mozjpeg' などのバックエンド名。select_codec_backend を参照)
         
     Returns:
         tuple[bool, bool, int | None]: (成功したか, 元のサイズを維持したか, 見積もりサイズ)
@@ -766,23 +1066,7 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
         PIL.UnidentifiedImageError: サポートされていない画像形式または破損している場合
     """
     # パラメータバリデーション
-    if target_width is None or target_width <= 0:
-        error_msg = f"無効な目標幅です: {target_width}. 1以上の正の整数が必要です"
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-    
-    if quality is None or not (1 <= quality <= 100):
-        error_msg = f"無効な品質値です: {quality}. 1から100の間の整数が必要です"
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-        
-    if balance is None or not (1 <= balance <= 10):
-        error_msg = f"無効なバランス値です: {balance}. 1から10の間の整数が必要です"
-        logger.error(error_msg)
-        raise ValueError(error_msg)
-    
-    if format not in ['original', 'jpeg', 'png', 'webp']:
-        logger.warning(f"推奨されない出力形式: {format}. 'original', 'jpeg', 'png', 'webp' のいずれかを使用することをお勧めします")
+    validate_resize_params(target_width, quality, balance, format)
     
     # 変数の初期化 - スコープ問題防止のため先に定義
     source_path_str = ""
@@ -808,26 +1092,40 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
         def normalize_path_with_retry(path):
             return normalize_long_path(path, remove_prefix=True)
             
-        source_path_str = retry_on_file_error(normalize_path_with_retry, source_path, max_retries=3, retry_delay=0.2)
+        with perf_stage('normalize', source_path):
+            source_path_str = retry_on_file_error(
+                normalize_path_with_retry, source_path, max_retries=3, retry_delay=0.2
+            )
         source_path = Path(source_path_str)
 
-        # 実際に存在するか確認し、存在しない場合は再試行
-        def check_file_exists(path):
-            if not Path(path).exists():
-                raise FileNotFoundError(f"ファイルが存在しません: {path}")
-            return True
-            
-        retry_on_file_error(check_file_exists, source_path_str, max_retries=3, retry_delay=0.3)
+        # 存在確認とサイズ取得を1回の stat で行い、失敗した場合は再試行
+        with perf_stage('stat', source_path_str):
+            file_size_before = retry_on_file_error(stat_source_file, source_path_str,
+                                                   max_retries=3, retry_delay=0.3).st_size
 
-        # ファイルサイズ取得にリトライ機構を使用
-        def get_size(path):
-            return os.path.getsize(path)
-            
-        file_size_before = retry_on_file_error(get_size, source_path_str, max_retries=3, retry_delay=0.2)
+        # キャッシュ上で出力が最新であればデコード・エンコードを省略
+        cache_params = None
+        if cache is not None and not dry_run:
+            # target_ssim・codec は指定した場合のみキーに含め、既存のキャッシュを無効にしない
+            extra_params = {}
+            if target_ssim:
+                extra_params['target_ssim'] = target_ssim
+            if codec is not None:
+                extra_params['codec'] = codec
+            cache_params = OutputCache.make_params(
+                width=target_width, quality=quality, format=format,
+                balance=balance, keep_exif=keep_exif, webp_lossless=webp_lossless,
+                fast_decode=fast_decode, draft_oversample=draft_oversample, **extra_params
+            )
+            cached = cache.lookup(source_path_str, cache_params, dest_path)
+            if cached is not None:
+                logger.info(f"出力が最新のためスキップ: {source_path_str} → {cached['dest']}")
+                return True, cached.get("keep_original_size", False), None
 
         # 出力先ディレクトリの安全な取得 (dest_path引数を使用)
         dest_dir = Path(dest_path).parent
-        success, created_dir = create_directory_with_permissions(dest_dir)
+        with perf_stage('mkdir', source_path_str):
+            success, created_dir = ensure_directory(dest_dir)
         if not success:
             error_msg = f"出力先ディレクトリを作成できませんでした: {dest_dir}"
             logger.error(error_msg)
@@ -836,19 +1134,27 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
         # 出力先パスを文字列に変換
         dest_path_str = str(dest_path)
         
-        # 画像ファイルの有効性を確認
+        # リサイズも形式変換も不要な画像は、ヘッダーだけで判断してデコードせずにコピー
+        if copy_unchanged:
+            plan = plan_image(source_path_str, target_width, format, copy_unchanged=True,
+                              file_size=file_size_before, keep_exif=keep_exif)
+            if plan.action == 'copy':
+                if dry_run:
+                    return True, True, file_size_before
+                final_dest_path_str = update_extension(
+                    dest_path_str, OUTPUT_EXTENSIONS[plan.output_format]
+                )
+                used = copy_source_file(source_path_str, final_dest_path_str, copy_method)
+                logger.info(f"リサイズ不要のため複製しました ({used}): {source_path_str} → {final_dest_path_str}")
+                if cache is not None:
+                    cache.store(source_path_str, cache_params, final_dest_path_str,
+                                info={"keep_original_size": True})
+                return True, True, None
+        
+        # 画像ファイルの有効性を確認（存在と種類は stat_source_file で確認済み。読み取り権限は開くときに確認される）
         try:
-            # ファイルの存在とアクセス権限を確認
-            if not os.path.isfile(source_path_str):
-                logger.error(f"ファイルが存在しません: {source_path_str}")
-                return False, False, None
-                
-            if not os.access(source_path_str, os.R_OK):
-                logger.error(f"ファイルに読み取り権限がありません: {source_path_str}")
-                return False, False, None
-            
             # 画像ファイルを開いてフォーマットを確認
-            with Image.open(source_path_str) as img:
+            with open_source_image(source_path_str, use_mmap) as img:
                 # 画像フォーマットの確認
                 img_format = img.format
                 SUPPORTED_FORMATS = {'JPEG', 'PNG', 'WEBP'} 
@@ -858,175 +1164,95 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
                 # 元の画像サイズ
                 original_width, original_height = img.size
                 
-                # --- 実際の出力形式を決定 --- 
-                actual_output_format = ''
-                is_mpo_input = (img_format == 'MPO') # MPO形式かどうかのフラグを追加
-                if format == 'original':
-                    # 元の形式を維持する場合
-                    if is_mpo_input:
-                        # MPOは維持できないのでJPEGとして扱い、警告を出す
-                        logger.warning(f"入力形式がMPOのため、元の形式を維持できません。JPEGとして処理します。 - {source_path.name}")
-                        actual_output_format = 'JPEG'
-                    elif img_format and img_format.upper() in SUPPORTED_FORMATS:
-                        actual_output_format = img_format.upper()
-                    else:
-                        # サポート外または不明な形式はJPEGにフォールバック
-                        if img_format:
-                             logger.warning(f"入力形式 '{img_format}' は維持できません。JPEGに変換します。 - {source_path.name}")
-                        else:
-                             logger.warning(f"入力形式が不明です。JPEGとして処理します。 - {source_path.name}")
-                        actual_output_format = 'JPEG'
-                elif format.upper() in SUPPORTED_FORMATS:
-                    # 特定の形式が指定された場合 (WEBP含む)
-                    actual_output_format = format.upper()
-                else:
-                     # 指定された形式がサポート外の場合、JPEGにフォールバック
-                     logger.warning(f"指定された出力形式 '{format}' はサポートされていません。JPEGとして処理します。")
-                     actual_output_format = 'JPEG'
-
-                logger.info(f"決定された出力形式: {actual_output_format}")
-                # --- 出力形式決定ここまで ---
-                
                 # 既に十分小さい場合はリサイズ不要
                 keep_original_size = original_width <= target_width
                 
-                # 縦横比を維持したリサイズ計算
+                # 縦横比を維持したリサイズ後のサイズを計算
                 if not keep_original_size:
                     ratio = original_height / original_width
                     new_height = int(target_width * ratio)
                     new_size = (target_width, new_height)
-                    resized_img = img.resize(new_size, Image.LANCZOS)
+                    if fast_decode:
+                        apply_jpeg_draft(img, new_size, draft_oversample)
                 else:
-                    resized_img = img
+                    new_size = (original_width, original_height)
                 
-                # 見積もりサイズ計算（テンポラリファイルに保存して測定）
-                estimated_size = None
+                # --- 実際の出力形式を決定（'auto' は縮小デコードの設定後に画素を解析する） --- 
+                actual_output_format, palette_colors = decide_output_format(
+                    img, format, name=source_path.name
+                )
+
+                logger.info(f"決定された出力形式: {actual_output_format}")
+                # --- 出力形式決定ここまで ---
                 
-                # ドライランまたはサイズ計算が必要な場合
-                if dry_run or not keep_original_size:
-                    # テンポラリパスを用意
-                    import tempfile
-                    import uuid
-                    import time
-                    
-                    # Windows環境での権限問題に対応するため、一意なファイル名を使用
-                    temp_dir = tempfile.gettempdir()
-                    temp_filename = f"resize_temp_{uuid.uuid4().hex}.jpg"
-                    temp_path = os.path.join(temp_dir, temp_filename)
-                    
-                    # リトライ機構を使って一時ファイル操作
-                    def save_temp_image():
-                        # RGBモードに変換してから保存
-                        img_to_save = resized_img.convert('RGB')
-                        img_to_save.save(temp_path, format='JPEG', quality=quality)
-                        return os.path.getsize(temp_path)
-                    
-                    try:
-                        # リトライ機構で一時ファイルを保存してサイズを計測
-                        estimated_size = retry_on_file_error(save_temp_image, max_retries=3, retry_delay=0.5)
-                    except Exception as e:
-                        logger.error(f"サイズ見積もりエラー: {e}")
-                    finally:
-                        # 一時ファイルの削除を試みる
-                        try:
-                            if os.path.exists(temp_path):
-                                os.remove(temp_path)
-                        except Exception as e:
-                            logger.debug(f"一時ファイルの削除に失敗: {e}")
+                # バランス値に基づいて最適化パラメータを調整 (JPEG/WebPの品質に使用)
+                optimized_quality = adjust_quality_by_balance(
+                    quality, balance, actual_output_format.lower()
+                )
                 
-                # 保存する画像を選択（ドライランでも必要）
-                if not keep_original_size:
-                    save_img = resized_img
-                else:
-                    # リサイズ不要でも、形式変換が必要な場合があるので img を使う
-                    save_img = img 
+                # 出力形式に応じた保存オプション
+                try:
+                    save_options, output_ext = build_save_options(
+                        actual_output_format, optimized_quality,
+                        exif=img.info.get('exif') if keep_exif else None,
+                        webp_lossless=webp_lossless, png_tier=png_tier_for_balance(balance)
+                    )
+                except ValueError as e:
+                    logger.error(str(e))
+                    return False, False, None
                 
-                # ドライランの場合は実際の保存は行わない
+                # ドライランの場合は保存せず、メモリ上でサイズを見積もるのみ
                 if dry_run:
-                    # ドライランの場合はサイズ見積もりを返すのみ
+                    with perf_stage('estimate', source_path_str):
+                        estimated_size = estimate_encoded_size(
+                            img, actual_output_format, save_options, webp_lossless,
+                            target_size=None if keep_original_size else new_size,
+                            sampled=(estimate_mode == 'sampled')
+                        )
                     return True, keep_original_size, estimated_size
                 
+                # 画像データのデコード（縮小デコードの設定後に読み込む）
+                with perf_stage('decode', source_path_str) as stage:
+                    img.load()
+                    stage.nbytes = file_size_before
+                
+                # 保存する画像を用意（リサイズ不要でも形式変換が必要な場合があるので img を使う）
+                with perf_stage('resize', source_path_str):
+                    if not keep_original_size:
+                        resized_img = downscale_image(img, new_size)
+                        save_img = resized_img
+                    else:
+                        save_img = img
+                    save_img = convert_for_output(
+                        save_img, actual_output_format, webp_lossless, palette_colors
+                    )
+                
+                # 画質目標が指定されていれば、画像の内容に合わせて品質を下げる
+                save_options = tune_quality_for_ssim(
+                    save_img, save_options, target_ssim, source_path_str, codec
+                )
+                
+                # 見積もりサイズは要求された場合のみ計算
+                if estimate_size:
+                    with perf_stage('estimate', source_path_str):
+                        estimated_size = estimate_encoded_size(
+                            save_img, actual_output_format, save_options, webp_lossless
+                        )
+                
                 # 以下は実際の保存処理
                 # ディレクトリが存在するか確認
                 if not os.path.exists(os.path.dirname(dest_path_str)):
                     os.makedirs(os.path.dirname(dest_path_str), exist_ok=True)
                 
-                # バランス値に基づいて最適化パラメータを調整 (JPEG/WebPの品質に使用)
-                optimized_quality = adjust_quality_by_balance(quality, balance, actual_output_format.lower())
-                
-                # 出力形式に応じた保存処理
-                save_options = {}
-                output_ext = ''
-                final_dest_path_str = str(dest_path) # 元のdest_pathをベースにする
-                final_dest_path = dest_path # Path オブジェクトも初期化
-
-                if actual_output_format == 'JPEG':
-                    output_ext = '.jpg'
-                    final_dest_path_str = update_extension(final_dest_path_str, output_ext)
-                    save_options = {
-                        'format': 'JPEG',
-                        'quality': optimized_quality,
-                        'optimize': True,
-                        'progressive': True
-                    }
-                    # EXIF情報を保持する場合
-                    if keep_exif and hasattr(img, 'info') and 'exif' in img.info:
-                        save_options['exif'] = img.info['exif']
-                    
-                    # JPEGはRGBモードである必要がある
-                    if save_img.mode != 'RGB':
-                        logger.debug(f"画像をRGBモードに変換中 (元: {save_img.mode})")
-                        save_img = save_img.convert('RGB')
-
-                elif actual_output_format == 'PNG':
-                    output_ext = '.png'
-                    final_dest_path_str = update_extension(final_dest_path_str, output_ext)
-                    # PNGの圧縮レベル (0-9, 9が最高圧縮)。品質とは直接関係ない。
-                    # 一旦固定値 (6) を使うか、バランスから簡易的に計算？ -> 固定値6 (Pillowのデフォルトより少し高め) にする
-                    compress_level = 6 
-                    save_options = {
-                        'format': 'PNG',
-                        'optimize': True,
-                        'compress_level': compress_level
-                    }
-                    # EXIFはPNG標準では保存されないことが多いが、念のため試みる (Pillow次第)
-                    if keep_exif and hasattr(img, 'info') and 'exif' in img.info:
-                         if 'exif' not in save_options: save_options['exif'] = img.info['exif'] # 試すだけ
-
-                elif actual_output_format == 'WEBP':
-                    output_ext = '.webp'
-                    final_dest_path_str = update_extension(final_dest_path_str, output_ext)
-                    save_options = {
-                        'format': 'WEBP',
-                        'quality': optimized_quality,
-                        'lossless': webp_lossless,
-                        'method': 6 # 高品質な圧縮方法
-                    }
-                    # EXIF情報を保持する場合
-                    if keep_exif and hasattr(img, 'info') and 'exif' in img.info:
-                        save_options['exif'] = img.info['exif']
-                    
-                    # ロスレスで透明度がある場合は RGBA のまま保存
-                    if webp_lossless and 'A' in save_img.mode:
-                         logger.debug("WebPロスレスでRGBAモードのまま保存")
-                    # ロッシーで透明度がある場合も Pillow はよしなに対応してくれるはず
-                    elif not webp_lossless and 'A' in save_img.mode:
-                         logger.debug("WebPロッシーでRGBAモードのまま保存 (透明度サポート)")
-                    # 透明度がない場合はRGBで良い
-                    elif 'A' not in save_img.mode and save_img.mode != 'RGB':
-                         logger.debug(f"WebP用に画像をRGBモードに変換中 (元: {save_img.mode})")
-                         save_img = save_img.convert('RGB')
-
-                else:
-                    logger.error(f"未対応の出力形式です: {actual_output_format}")
-                    return False, False, estimated_size # エラーとして返す
+                final_dest_path_str = update_extension(str(dest_path), output_ext)
+                final_dest_path = Path(final_dest_path_str)
 
-                # アトミック書き込みの実装（一時ファイル → リネーム）
-                import tempfile
-                import uuid
-                import shutil
-                import time
+                # メモリ上でエンコード（エンコードと書き込みを分けて計測できるようにする）
+                with perf_stage('encode', source_path_str) as stage:
+                    encoded, stage.backend = encode_image(save_img, save_options, codec)
+                    stage.nbytes = len(encoded)
                 
+                # アトミック書き込みの実装（一時ファイル → リネーム）
                 # 一時ファイルパスを生成（出力先と同一ボリューム上に作成）
                 temp_dir = dest_dir if dest_dir.exists() else tempfile.gettempdir()
                 temp_filename = f"resize_temp_{uuid.uuid4().hex}{output_ext}"
@@ -1036,7 +1262,8 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
                 # 画像を一時ファイルに保存
                 def save_image_to_temp():
                     logger.debug(f"一時ファイルに保存: {temp_path_str}, オプション: {save_options}")
-                    save_img.save(temp_path_str, **save_options)
+                    with open(temp_path_str, 'wb') as f:
+                        f.write(encoded)
                     return True
                 
                 # 一時ファイルを最終出力先にリネーム
@@ -1047,12 +1274,19 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
 
                 try:
                     # 一時ファイルに保存
-                    success = retry_on_file_error(save_image_to_temp, max_retries=3, retry_delay=0.5)
+                    with perf_stage('write', source_path_str) as stage:
+                        success = retry_on_file_error(
+                            save_image_to_temp, max_retries=3, retry_delay=0.5
+                        )
+                        stage.nbytes = len(encoded)
                     if not success:
                         raise OSError(f"一時ファイルへの保存に失敗しました: {temp_path_str}")
                     
                     # 最終出力先にリネーム
-                    success = retry_on_file_error(rename_to_final, max_retries=3, retry_delay=0.5)
+                    with perf_stage('rename', source_path_str):
+                        success = retry_on_file_error(
+                            rename_to_final, max_retries=3, retry_delay=0.5
+                        )
                     if not success:
                         raise OSError(f"最終出力先へのリネームに失敗しました: {final_dest_path_str}")
                     
@@ -1067,13 +1301,13 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
                         logger.debug(f"一時ファイルのクリーンアップに失敗: {cleanup_error}")
                     return False, False, estimated_size
 
-                if is_mpo_input:
+                if cache is not None:
+                    cache.store(source_path_str, cache_params, final_dest_path_str,
+                                info={"keep_original_size": keep_original_size})
+
+                if img_format == 'MPO':
                     logger.info(f"MPO形式のファイルをJPEGとして保存処理を実行します: {final_dest_path.name}")
 
-                if save_img.mode != 'RGB':
-                    logger.debug(f"JPEG保存のためRGBモードに変換中 (元: {save_img.mode})")
-                    save_img = save_img.convert('RGB')
-                
                 return True, keep_original_size, estimated_size
                 
         except UnidentifiedImageError:
@@ -1096,67 +1330,1799 @@ def resize_and_compress_image(source_path, dest_path, target_width: int, quality
         return False, False, None
 
 
-def update_extension(file_path, new_ext):
+def validate_resize_params(target_width, quality, balance, format='original'):
     """
-    ファイルパスの拡張子を更新します
+    リサイズのパラメータを検証します
     
-    Args:
-        file_path: 元のファイルパス
-        new_ext: 新しい拡張子 (ドット付き、例: '.jpg')
-        
-    Returns:
-        str: 拡張子を更新したパス
+    Raises:
+        ValueError: 目標幅・品質・バランスのいずれかが無効な場合
     """
-    path_obj = Path(file_path)
-    stem = path_obj.stem
-    parent = path_obj.parent
+    if target_width is None or target_width <= 0:
+        error_msg = f"無効な目標幅です: {target_width}. 1以上の正の整数が必要です"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
     
-    # 新しいパスを作成
-    new_path = parent / f"{stem}{new_ext}"
+    if quality is None or not (1 <= quality <= 100):
+        error_msg = f"無効な品質値です: {quality}. 1から100の間の整数が必要です"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
+        
+    if balance is None or not (1 <= balance <= 10):
+        error_msg = f"無効なバランス値です: {balance}. 1から10の間の整数が必要です"
+        logger.error(error_msg)
+        raise ValueError(error_msg)
     
-    return str(new_path)
+    if format not in ['original', 'auto', 'jpeg', 'png', 'webp', 'avif']:
+        logger.warning(f"推奨されない出力形式: {format}. 'original', 'auto', 'jpeg', 'png', 'webp', "
+                       f"'avif' のいずれかを使用することをお勧めします")
 
 
-def adjust_quality_by_balance(quality, balance, format):
+# メモリ上で処理した画像のエンコード結果と統計
+# original_size / output_size: (幅, 高さ)、input_bytes: 入力のバイト数（不明な場合は None）
+# backend: エンコードしたコーデックのバックエンド名
+EncodedImage = namedtuple(
+    'EncodedImage',
+    ['data', 'format', 'extension', 'original_size', 'output_size',
+     'input_bytes', 'output_bytes', 'keep_original_size', 'backend']
+)
+
+
+def resize_image_bytes(source, target_width: int, quality: int,
+                       format: str = 'original', keep_exif: bool = True,
+                       balance: int = 5, webp_lossless: bool = False,
+                       fast_decode: bool = True,
+                       draft_oversample: float = DRAFT_OVERSAMPLE,
+                       name: str | None = None,
+                       target_ssim: float | None = None,
+                       codec: str | None = None) -> EncodedImage:
     """
-    圧縮と品質のバランスに基づいて品質パラメータを調整します
+    メモリ上の画像データをリサイズして圧縮し、エンコード結果を返します
+    
+    resize_and_compress_image と同じ出力形式の決定・品質調整・EXIF保持を行いますが、
+    ファイルシステムには一切アクセスしません（ディレクトリ作成・一時ファイル・リネームなし）。
+    アップロードされた画像をディスクに書かずに処理する場合に使います。
     
     Args:
-        quality: 元の品質値 (1-100)
-        balance: 圧縮と品質のバランス (1-10, 1=最高圧縮率, 10=最高品質) - 現在は主に品質調整に使用
-        format: 出力形式 ('jpeg', 'png', 'webp')
+        source: 画像データ (bytes, bytearray, memoryview などのバッファ、または read できるファイルオブジェクト)
+        target_width: 目標の幅 (ピクセル、1以上の整数)
+        quality: 圧縮品質 (1-100の整数)
+        format: 出力形式 ('original', 'auto', 'jpeg', 'png', 'webp', 'avif')
+        keep_exif: EXIFメタデータを保持するか
+        balance: 圧縮と品質のバランス (1-10, 1=最高圧縮率, 10=最高品質)
+        webp_lossless: WebPをロスレスで保存するかどうか
+        fast_decode: 大きく縮小するJPEGをDCTスケーリングで縮小デコードするか
+        draft_oversample: 縮小デコード時に目標サイズの何倍以上の解像度を確保するか
+        name: ログと計測に使う名前（元のファイル名など）
+        target_ssim: 指定した場合、SSIM がこの値以上になる最低の品質で保存する（resize_and_compress_image と同じ）
+        codec: エンコードに使うコーデックのバックエンド（resize_and_compress_image と同じ）
         
     Returns:
-        int: 調整後の品質値
+        EncodedImage: エンコード済みデータ (bytes) と出力形式・拡張子・サイズなどの統計
+        
+    Raises:
+        ValueError: パラメータが無効な場合
+        TypeError: source がバッファでもファイルオブジェクトでもない場合
+        PIL.UnidentifiedImageError: サポートされていない画像形式または破損している場合
     """
-    # バランス値を正規化 (1-10 → 0.0-1.0)
-    balance_factor = (balance - 1) / 9.0
+    validate_resize_params(target_width, quality, balance, format)
+    label = name or '<bytes>'
     
-    # 形式ごとの品質調整
-    if format.lower() == 'jpeg':
-        # JPEGの場合: バランス値が高いほど高品質
-        # balance = 1 (最高圧縮) → quality * 0.7
-        # balance = 10 (最高品質) → quality * 1.2 (上限100)
-        adjustment = 0.7 + (balance_factor * 0.5)
-        new_quality = int(quality * adjustment)
+    if hasattr(source, 'read'):
+        fp, input_bytes = source, None
+    else:
+        input_bytes = memoryview(source).nbytes
+        # bytes はコピーせずに共有される
+        fp = io.BytesIO(source)
+    
+    with Image.open(fp) as img:
+        original_size = img.size
         
-    elif format.lower() == 'png':
-        # PNGの場合: 圧縮レベルは別関数で処理するのでそのまま返す
-        new_quality = quality
+        # 既に十分小さい場合はリサイズ不要
+        keep_original_size = original_size[0] <= target_width
+        if keep_original_size:
+            new_size = original_size
+        else:
+            new_size = (target_width, int(target_width * original_size[1] / original_size[0]))
+            if fast_decode:
+                apply_jpeg_draft(img, new_size, draft_oversample)
+        output_format, palette_colors = decide_output_format(img, format, name=label)
         
-    elif format.lower() == 'webp':
-        # WebPの場合: バランスに基づく調整
-        # balance = 1 (最高圧縮) → quality * 0.6
-        # balance = 10 (最高品質) → quality * 1.1 (上限100)
-        adjustment = 0.6 + (balance_factor * 0.5)
-        new_quality = int(quality * adjustment)
-    
-    else:
-        # 未対応の形式はそのまま返す
-        new_quality = quality
+        optimized_quality = adjust_quality_by_balance(quality, balance, output_format.lower())
+        save_options, output_ext = build_save_options(
+            output_format, optimized_quality,
+            exif=img.info.get('exif') if keep_exif else None,
+            webp_lossless=webp_lossless, png_tier=png_tier_for_balance(balance)
+        )
+        
+        with perf_stage('decode', label) as stage:
+            img.load()
+            stage.nbytes = input_bytes
+        
+        with perf_stage('resize', label):
+            save_img = img if keep_original_size else downscale_image(img, new_size)
+            save_img = convert_for_output(save_img, output_format, webp_lossless, palette_colors)
+        
+        save_options = tune_quality_for_ssim(save_img, save_options, target_ssim, label, codec)
+        
+        with perf_stage('encode', label) as stage:
+            data, backend = encode_image(save_img, save_options, codec)
+            stage.nbytes = len(data)
+            stage.backend = backend
     
-    # 範囲の正規化 (1-100)
-    return max(1, min(100, new_quality))
+    return EncodedImage(data, output_format, output_ext, original_size, save_img.size,
+                        input_bytes, len(data), keep_original_size, backend)
+
+
+def rendition_size(original_size, target_width):
+    """
+    縦横比を保って目標幅に合わせたサイズを返します（目標幅が元の幅以上なら元のサイズ）
+    """
+    original_width, original_height = original_size
+    if original_width <= target_width:
+        return original_size
+    return target_width, max(1, int(target_width * original_height / original_width))
+
+
+def iter_renditions(img, sizes, reducing_gap=RESIZE_REDUCING_GAP):
+    """
+    デコード済みの画像から、複数サイズの画像を大きい順に生成します
+    
+    各サイズは直前に生成した（より大きい）縮小結果からさらに縮小するため、小さいサイズほど
+    少ない画素数から計算でき、元画像からそれぞれ縮小するより速くなります。
+    元画像より大きいサイズが指定された場合は元画像から拡大し、次の縮小の入力には使いません。
+    
+    Args:
+        img: デコード済みの画像
+        sizes: (幅, 高さ) のイテラブル
+        reducing_gap: downscale_image に渡す2段階縮小の閾値
+        
+    Yields:
+        tuple: 幅の大きい順に ((幅, 高さ), 画像)。サイズが同じ場合は入力の画像をそのまま返します
+    """
+    base = img
+    for size in sorted(set(sizes), key=lambda size: size[0], reverse=True):
+        if size == base.size:
+            yield size, base
+            continue
+        resized = downscale_image(base, size, reducing_gap=reducing_gap)
+        if size[0] < base.size[0]:
+            base = resized
+        yield size, resized
+
+
+def write_file_atomic(dest_path, data, name=None):
+    """
+    データを同じディレクトリの一時ファイルに書き込んでからリネームし、出力を置き換えます
+    
+    Args:
+        dest_path: 出力先のパス
+        data: 書き込むデータ (bytes などのバッファ)
+        name: 計測に使う名前（元のファイル名など）
+    """
+    dest_path = str(dest_path)
+    temp_path = os.path.join(os.path.dirname(dest_path) or '.', f".tmp_write_{uuid.uuid4().hex}")
+    label = name or dest_path
+    try:
+        with perf_stage('write', label) as stage:
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+            stage.nbytes = memoryview(data).nbytes
+        with perf_stage('rename', label):
+            os.replace(temp_path, dest_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+# 複数サイズ出力（resize_renditions）の各出力の結果
+# size: (幅, 高さ)、output_bytes: 出力ファイルのバイト数
+RenditionResult = namedtuple(
+    'RenditionResult',
+    ['width', 'path', 'format', 'size', 'output_bytes', 'keep_original_size', 'backend']
+)
+
+
+def resize_renditions(source_path, targets, quality: int,
+                      format: str = 'original', keep_exif: bool = True,
+                      balance: int = 5, webp_lossless: bool = False,
+                      fast_decode: bool = True,
+                      draft_oversample: float = DRAFT_OVERSAMPLE,
+                      use_mmap: bool = False,
+                      target_ssim: float | None = None,
+                      codec: str | None = None) -> list[RenditionResult]:
+    """
+    1回のデコードから複数の幅の画像を生成し、それぞれの出力先に保存します
+    
+    縮小デコードは最も大きい幅に合わせて行い、各幅の画像は iter_renditions で大きい順に
+    縮小を重ねて生成します。各出力は一時ファイルからのリネームで書き込みます。
+    出力形式の決定・品質調整・EXIF保持は resize_and_compress_image と同じです。
+    
+    Args:
+        source_path: 元の画像ファイルパス
+        targets: (幅, 出力先パス) または (幅, 出力先パス, 出力形式) のイテラブル。
+                 出力先の拡張子は出力形式に合わせて変更されます
+        quality: 圧縮品質 (1-100の整数)
+        format: targets で出力形式を省略した場合の出力形式 ('original', 'auto', 'jpeg', 'png', 'webp', 'avif')
+        keep_exif: EXIFメタデータを保持するか
+        balance: 圧縮と品質のバランス (1-10, 1=最高圧縮率, 10=最高品質)
+        webp_lossless: WebPをロスレスで保存するかどうか
+        fast_decode: JPEGを最も大きい幅に合わせて縮小デコードするか
+        draft_oversample: 縮小デコード時に目標サイズの何倍以上の解像度を確保するか
+        use_mmap: 元ファイルをメモリマップして Pillow に渡すか
+        target_ssim: 指定した場合、幅ごとに SSIM がこの値以上になる最低の品質で保存する
+        codec: エンコードに使うコーデックのバックエンド（resize_and_compress_image と同じ）
+        
+    Returns:
+        list[RenditionResult]: targets と同じ順の各出力の結果
+        
+    Raises:
+        ValueError: パラメータが無効な場合
+        OSError: ファイルの読み書きに失敗した場合
+        PIL.UnidentifiedImageError: サポートされていない画像形式または破損している場合
+    """
+    targets = [(target[0], target[1], target[2] if len(target) > 2 else format)
+               for target in targets]
+    if not targets:
+        return []
+    for width, _, target_format in targets:
+        validate_resize_params(width, quality, balance, target_format)
+    
+    source_path_str = normalize_long_path(source_path, remove_prefix=True)
+    name = Path(source_path_str).name
+    
+    with open_source_image(source_path_str, use_mmap) as img:
+        img_format = img.format
+        original_size = img.size
+        sizes = {width: rendition_size(original_size, width) for width, _, _ in targets}
+        exif = img.info.get('exif') if keep_exif else None
+        if fast_decode:
+            apply_jpeg_draft(img, max(sizes.values()), draft_oversample)
+        
+        with perf_stage('decode', source_path_str):
+            img.load()
+        
+        # 'auto' の解析は全ての幅で共通なので1回だけ行う
+        auto_format = None
+        if any(target_format == 'auto' for _, _, target_format in targets):
+            auto_format = decide_output_format(img, 'auto', name=name)
+        
+        # 同じ幅の出力が複数あっても縮小は1回だけ行う
+        with perf_stage('resize', source_path_str):
+            images = dict(iter_renditions(img, sizes.values()))
+        
+        results = []
+        for width, dest_path, target_format in targets:
+            if target_format == 'auto':
+                output_format, palette_colors = auto_format
+            else:
+                output_format = resolve_output_format(img_format, target_format, name=name)
+                palette_colors = None
+            optimized_quality = adjust_quality_by_balance(quality, balance, output_format.lower())
+            save_options, output_ext = build_save_options(
+                output_format, optimized_quality, exif=exif, webp_lossless=webp_lossless,
+                png_tier=png_tier_for_balance(balance)
+            )
+            save_img = convert_for_output(
+                images[sizes[width]], output_format, webp_lossless, palette_colors
+            )
+            save_options = tune_quality_for_ssim(
+                save_img, save_options, target_ssim, source_path_str, codec
+            )
+            
+            with perf_stage('encode', source_path_str) as stage:
+                encoded, stage.backend = encode_image(save_img, save_options, codec)
+                stage.nbytes = len(encoded)
+            
+            final_dest_path = update_extension(str(dest_path), output_ext)
+            success, _ = ensure_directory(Path(final_dest_path).parent)
+            if not success:
+                raise PermissionError(f"出力先ディレクトリを作成できませんでした: {Path(final_dest_path).parent}")
+            write_file_atomic(final_dest_path, encoded, name=source_path_str)
+            
+            results.append(RenditionResult(
+                width, final_dest_path, output_format, sizes[width],
+                len(encoded), sizes[width] == original_size, stage.backend
+            ))
+            logger.debug(f"出力しました ({width}px): {final_dest_path}")
+    
+    return results
+
+
+def build_save_options(output_format, quality, exif=None, webp_lossless=False, png_tier='default'):
+    """
+    出力形式に応じた保存オプションを作成します
+    
+    Args:
+        output_format: 出力形式 ('JPEG', 'PNG', 'WEBP', 'AVIF')
+        quality: 品質値 (JPEG/WebP/AVIFで使用)
+        exif: 保持するEXIFデータ (不要な場合は None)
+        webp_lossless: WebPをロスレスで保存するかどうか
+        png_tier: PNGの圧縮の段階 ('fast', 'default', 'max'。PNG_TIERS を参照)
+        
+    Returns:
+        tuple[dict, str]: (Image.save に渡すオプション, 拡張子)
+        
+    Raises:
+        ValueError: 未対応の出力形式の場合
+    """
+    if output_format == 'JPEG':
+        save_options = {
+            'format': 'JPEG',
+            'quality': quality,
+            'optimize': True,
+            'progressive': True
+        }
+        output_ext = '.jpg'
+    elif output_format == 'PNG':
+        # PNGの圧縮レベル (0-9, 9が最高圧縮)。品質とは直接関係ない。
+        if png_tier == 'fast':
+            save_options = {
+                'format': 'PNG',
+                'compress_level': 1
+            }
+        elif png_tier == 'max':
+            # strategies は PillowBackend が並列に試す zlib 戦略（Pillow 自体は無視する）
+            save_options = {
+                'format': 'PNG',
+                'compress_level': 9,
+                'strategies': PNG_MAX_STRATEGIES
+            }
+        else:
+            save_options = {
+                'format': 'PNG',
+                'optimize': True,
+                'compress_level': 6
+            }
+        output_ext = '.png'
+    elif output_format == 'WEBP':
+        save_options = {
+            'format': 'WEBP',
+            'quality': quality,
+            'lossless': webp_lossless,
+            'method': 6 # 高品質な圧縮方法
+        }
+        output_ext = '.webp'
+    elif output_format == 'AVIF':
+        save_options = {
+            'format': 'AVIF',
+            'quality': quality,
+        }
+        output_ext = '.avif'
+    else:
+        raise ValueError(f"未対応の出力形式です: {output_format}")
+    
+    # EXIF情報を保持する場合 (PNG標準では保存されないことが多いが、念のため試みる)
+    if exif:
+        save_options['exif'] = exif
+    
+    return save_options, output_ext
+
+
+def convert_for_output(img, output_format, webp_lossless=False, palette_colors=None):
+    """
+    出力形式で保存できるカラーモードに画像を変換します
+    
+    Args:
+        img: 変換する画像
+        output_format: 出力形式 ('JPEG', 'PNG', 'WEBP')
+        webp_lossless: WebPをロスレスで保存するかどうか
+        palette_colors: PNGの場合、この色数のパレット画像に減色する（decide_output_format を参照）
+        
+    Returns:
+        Image: 変換後の画像（変換不要な場合は元の画像）
+    """
+    if output_format == 'PNG' and palette_colors and img.mode != 'P':
+        logger.debug(f"PNG用に{palette_colors}色のパレット画像に減色中 (元: {img.mode})")
+        if 'A' in img.mode:
+            return img.convert('RGBA').quantize(palette_colors, method=Image.Quantize.FASTOCTREE)
+        return img.convert('RGB').quantize(palette_colors)
+    if output_format == 'JPEG':
+        # JPEGはRGBモードである必要がある
+        if img.mode != 'RGB':
+            logger.debug(f"画像をRGBモードに変換中 (元: {img.mode})")
+            return img.convert('RGB')
+    elif output_format in ('WEBP', 'AVIF'):
+        # ロスレス・ロッシーともに透明度がある場合は RGBA のまま保存
+        if 'A' in img.mode:
+            logger.debug(f"WebP{'ロスレス' if webp_lossless else 'ロッシー'}でRGBAモードのまま保存")
+        # 透明度がない場合はRGBで良い
+        elif img.mode != 'RGB':
+            logger.debug(f"WebP用に画像をRGBモードに変換中 (元: {img.mode})")
+            return img.convert('RGB')
+    return img
+
+
+class CodecBackend:
+    """
+    画像エンコーダーのバックエンドの基底クラス
+    
+    サブクラスは name（バックエンド名）、formats（出力できる形式）、capabilities（対応する機能）を
+    宣言し、encode を実装します。capabilities には次の値を使います。
+    
+    - 'exif': EXIFメタデータを保存できる
+    - 'alpha': 透明度を保存できる
+    - 'lossless': ロスレス圧縮（WebPロスレスなど）ができる
+    - 'palette': パレット画像（モード P）をそのまま保存できる
+    
+    effort は速度と圧縮率のつまみです（1=最速 〜 10=最小サイズ。None はバックエンドの既定値）。
+    """
+    
+    name = 'base'
+    formats = frozenset()
+    capabilities = frozenset()
+    
+    def is_available(self):
+        """このバックエンドが使えるか（外部コマンドがインストールされているかなど）"""
+        return True
+    
+    def supports(self, output_format, required=()):
+        """出力形式と必要な機能に対応しているか"""
+        return output_format in self.formats and set(required) <= self.capabilities
+    
+    def encode(self, img, save_options, effort=None):
+        """
+        画像をエンコードしたバイト列を返します
+        
+        Args:
+            img: エンコードする画像（convert_for_output で変換済みのもの）
+            save_options: build_save_options で作成した保存オプション
+            effort: 速度と圧縮率のつまみ (1-10、None は既定値)
+        """
+        raise NotImplementedError
+
+
+class PillowBackend(CodecBackend):
+    """Pillow（pillow-simd がインストールされていればそれ）によるエンコード"""
+    
+    capabilities = frozenset({'exif', 'alpha', 'lossless', 'palette'})
+    
+    def __init__(self):
+        # pillow-simd はバージョンに '.post' が付く
+        self.name = 'pillow-simd' if '.post' in Image.__version__ else 'pillow'
+        formats = {'JPEG', 'PNG', 'WEBP'}
+        try:
+            from PIL import features
+            if features.check('avif'):
+                formats.add('AVIF')
+        except Exception:
+            pass
+        self.formats = frozenset(formats)
+    
+    def encode(self, img, save_options, effort=None):
+        options = dict(save_options)
+        strategies = options.pop('strategies', None)
+        if effort is not None:
+            output_format = options.get('format')
+            if output_format == 'JPEG':
+                options['optimize'] = effort >= 3
+            elif output_format == 'PNG':
+                options['compress_level'] = max(1, min(9, round(effort * 0.9)))
+                options['optimize'] = effort >= 9
+            elif output_format == 'WEBP':
+                options['method'] = max(0, min(6, round((effort - 1) * 6 / 9)))
+            elif output_format == 'AVIF':
+                options['speed'] = max(0, min(10, 10 - effort))
+        if strategies and options.get('format') == 'PNG':
+            return encode_png_smallest(img, options, strategies)
+        buffer = io.BytesIO()
+        img.save(buffer, **options)
+        return buffer.getvalue()
+
+
+def encode_png_smallest(img, save_options, strategies=PNG_MAX_STRATEGIES):
+    """
+    zlib の圧縮戦略ごとにPNGを並列にエンコードし、最も小さい結果を返します
+    
+    zlib の圧縮は GIL を解放するため、スレッドで並列に実行できます。
+    
+    Args:
+        img: エンコードする画像
+        save_options: PNGの保存オプション（compress_type は戦略ごとに上書きされる）
+        strategies: 試す zlib の戦略 (zlib.Z_DEFAULT_STRATEGY など)
+        
+    Returns:
+        bytes: 最も小さいエンコード結果
+    """
+    def encode(strategy):
+        # Image.save は保存オプションを画像オブジェクトに設定するため、スレッドごとに複製する
+        buffer = io.BytesIO()
+        img.copy().save(buffer, **{**save_options, 'compress_type': strategy})
+        return buffer.getvalue()
+    
+    strategies = list(strategies)
+    if len(strategies) == 1:
+        return encode(strategies[0])
+    with ThreadPoolExecutor(max_workers=len(strategies),
+                            thread_name_prefix="png-strategy") as executor:
+        return min(executor.map(encode, strategies), key=len)
+
+
+@lru_cache(maxsize=None)
+def find_codec_executable(*names, version_marker=None):
+    """
+    外部エンコーダーの実行ファイルを探します（結果はキャッシュされます）
+    
+    Args:
+        *names: 候補の実行ファイル名（先に見つかったものを使う）
+        version_marker: 指定した場合、'-version' の出力にこの文字列を含むものだけを使う
+                        （libjpeg-turbo の cjpeg と mozjpeg の cjpeg を区別するためなど）
+        
+    Returns:
+        str | None: 実行ファイルのパス（見つからない場合は None）
+    """
+    for name in names:
+        path = shutil.which(name)
+        if path is None:
+            continue
+        if version_marker is None:
+            return path
+        try:
+            completed = subprocess.run([path, '-version'], capture_output=True, text=True,
+                                       timeout=10, stdin=subprocess.DEVNULL)
+        except (OSError, subprocess.SubprocessError):
+            continue
+        if version_marker in (completed.stdout + completed.stderr).lower():
+            return path
+    return None
+
+
+def _run_codec(command, input_data=None):
+    """外部エンコーダーを実行し、標準出力を返します（失敗した場合は OSError）"""
+    try:
+        completed = subprocess.run(command, input=input_data, capture_output=True,
+                                   timeout=CODEC_SUBPROCESS_TIMEOUT, check=True)
+    except subprocess.CalledProcessError as e:
+        message = e.stderr.decode('utf-8', 'replace').strip() if e.stderr else ''
+        raise OSError(f"{Path(command[0]).name} が失敗しました (終了コード {e.returncode}): {message}") from e
+    except subprocess.TimeoutExpired as e:
+        raise OSError(f"{Path(command[0]).name} がタイムアウトしました") from e
+    return completed.stdout
+
+
+class MozjpegBackend(CodecBackend):
+    """mozjpeg の cjpeg コマンドによるJPEGエンコード（同じ品質で標準のJPEGより小さくなる）"""
+    
+    name = 'mozjpeg'
+    formats = frozenset({'JPEG'})
+    capabilities = frozenset()
+    
+    def executable(self):
+        return find_codec_executable('mozjpeg-cjpeg', 'cjpeg-mozjpeg', 'cjpeg',
+                                     version_marker='mozjpeg')
+    
+    def is_available(self):
+        return self.executable() is not None
+    
+    def encode(self, img, save_options, effort=None):
+        # cjpeg は PPM/PGM を標準入力から読み込める
+        source = io.BytesIO()
+        img.convert('L' if img.mode == 'L' else 'RGB').save(source, format='PPM')
+        command = [self.executable(), '-quality', str(save_options.get('quality', 85))]
+        if not save_options.get('progressive', True):
+            command.append('-baseline')
+        if effort is not None and effort <= 3:
+            command.append('-fastcrush')
+        return _run_codec(command, source.getvalue())
+
+
+class OxipngBackend(CodecBackend):
+    """Pillowで保存したPNGを oxipng コマンドでロスレス最適化する"""
+    
+    name = 'oxipng'
+    formats = frozenset({'PNG'})
+    capabilities = frozenset({'exif', 'alpha', 'palette'})
+    
+    def executable(self):
+        return find_codec_executable('oxipng')
+    
+    def is_available(self):
+        return self.executable() is not None
+    
+    def encode(self, img, save_options, effort=None):
+        # 圧縮は oxipng に任せるので、Pillowでは最速で保存する
+        source = io.BytesIO()
+        options = {key: value for key, value in save_options.items() if key != 'strategies'}
+        img.save(source, **{**options, 'optimize': False, 'compress_level': 1})
+        level = 2 if effort is None else max(0, min(6, round(effort * 0.6)))
+        return _run_codec([self.executable(), '-o', str(level), '--stdout', '-'], source.getvalue())
+
+
+class AvifencBackend(CodecBackend):
+    """libavif の avifenc コマンドによるAVIFエンコード（PillowがAVIFに対応していない場合に使う）"""
+    
+    name = 'avifenc'
+    formats = frozenset({'AVIF'})
+    capabilities = frozenset({'alpha'})
+    
+    def executable(self):
+        return find_codec_executable('avifenc')
+    
+    def is_available(self):
+        return self.executable() is not None
+    
+    def encode(self, img, save_options, effort=None):
+        # avifenc はファイルの入出力のみ対応
+        speed = 6 if effort is None else max(0, min(10, 10 - effort))
+        with tempfile.TemporaryDirectory(prefix='edit-img-avif-') as temp_dir:
+            source_path = os.path.join(temp_dir, 'source.png')
+            output_path = os.path.join(temp_dir, 'output.avif')
+            img.save(source_path, format='PNG', compress_level=1)
+            _run_codec([self.executable(), '-q', str(save_options.get('quality', 60)),
+                        '--speed', str(speed), source_path, output_path])
+            with open(output_path, 'rb') as f:
+                return f.read()
+
+
+# 登録済みのバックエンド [(優先度, 登録順, バックエンド), ...]
+_codec_backends = []
+_codec_backends_lock = threading.Lock()
+
+
+def register_codec_backend(backend, priority=0):
+    """
+    コーデックのバックエンドを登録します
+    
+    codec='auto' では、出力形式と必要な機能に対応する使用可能なバックエンドのうち
+    優先度の最も高いものが選ばれます。
+    
+    Args:
+        backend: CodecBackend のインスタンス
+        priority: 優先度（大きいほど優先）
+    """
+    with _codec_backends_lock:
+        _codec_backends.append((priority, len(_codec_backends), backend))
+        _codec_backends.sort(key=lambda entry: (-entry[0], entry[1]))
+
+
+def get_codec_backends(output_format=None):
+    """
+    使用可能なバックエンドを優先度の高い順に返します
+    
+    Args:
+        output_format: 指定した場合、この形式に対応するものだけを返す
+        
+    Returns:
+        list[CodecBackend]: バックエンドのリスト
+    """
+    with _codec_backends_lock:
+        backends = [backend for _, _, backend in _codec_backends]
+    return [backend for backend in backends
+            if (output_format is None or output_format in backend.formats)
+            and backend.is_available()]
+
+
+def get_codec_backend(name):
+    """名前でバックエンドを返します（登録されていない場合は None）"""
+    with _codec_backends_lock:
+        for _, _, backend in _codec_backends:
+            if backend.name == name:
+                return backend
+    return None
+
+
+def codec_requirements(img, save_options):
+    """画像と保存オプションから、バックエンドに必要な機能を返します"""
+    required = set()
+    if save_options.get('exif'):
+        required.add('exif')
+    if save_options.get('lossless'):
+        required.add('lossless')
+    if 'A' in img.mode or 'transparency' in img.info:
+        required.add('alpha')
+    if img.mode == 'P':
+        required.add('palette')
+    return required
+
+
+def select_codec_backend(output_format, required=(), codec=None):
+    """
+    出力に使うバックエンドを選びます
+    
+    Args:
+        output_format: 出力形式 ('JPEG', 'PNG', 'WEBP', 'AVIF')
+        required: 必要な機能（codec_requirements を参照）
+        codec: None または 'pillow' で Pillow、'auto' で優先度の最も高いもの、
+               それ以外はその名前のバックエンド（使えない・出力形式に対応しない場合は Pillow）
+        
+    Returns:
+        CodecBackend: 選んだバックエンド
+        
+    Raises:
+        ValueError: 出力形式に対応するバックエンドがない場合
+    """
+    candidates = [backend for backend in get_codec_backends(output_format)
+                  if backend.supports(output_format, required)]
+    if codec != 'auto':
+        preferred = [backend for backend in candidates if backend.name == codec]
+        if not preferred:
+            if codec not in (None, 'pillow', 'pillow-simd'):
+                logger.debug(f"コーデック '{codec}' は {output_format} に使えないため Pillow を使用します")
+            preferred = [backend for backend in candidates if isinstance(backend, PillowBackend)]
+        # Pillow も使えない形式（Pillow が AVIF に未対応など）は他のバックエンドで出力する
+        candidates = preferred + candidates
+    if not candidates:
+        raise ValueError(f"{output_format} を出力できるエンコーダーがありません")
+    return candidates[0]
+
+
+def encode_image(img, save_options, codec=None, effort=None):
+    """
+    コーデックのバックエンドを選んで画像をエンコードします
+    
+    外部エンコーダーが失敗した場合は Pillow でエンコードし直します。
+    
+    Args:
+        img: エンコードする画像（convert_for_output で変換済みのもの）
+        save_options: build_save_options で作成した保存オプション
+        codec: 使うバックエンド（select_codec_backend を参照）
+        effort: 速度と圧縮率のつまみ (1-10、None はバックエンドの既定値)
+        
+    Returns:
+        tuple[bytes, str]: (エンコード結果, 使ったバックエンド名)
+    """
+    output_format = save_options['format']
+    backend = select_codec_backend(output_format, codec_requirements(img, save_options), codec)
+    try:
+        return backend.encode(img, save_options, effort), backend.name
+    except OSError as e:
+        if isinstance(backend, PillowBackend):
+            raise
+        logger.warning(f"{backend.name} でのエンコードに失敗したため Pillow を使用します: {e}")
+        required = codec_requirements(img, save_options)
+        fallback = select_codec_backend(output_format, required, 'pillow')
+        return fallback.encode(img, save_options, effort), fallback.name
+
+
+register_codec_backend(PillowBackend(), priority=0)
+register_codec_backend(MozjpegBackend(), priority=20)
+register_codec_backend(OxipngBackend(), priority=20)
+register_codec_backend(AvifencBackend(), priority=-10)
+
+
+def _get_estimate_buffer():
+    """見積もり用に使い回すスレッドごとのメモリバッファを空にして返します"""
+    buffer = getattr(_estimate_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = io.BytesIO()
+        _estimate_buffers.buffer = buffer
+    buffer.seek(0)
+    buffer.truncate()
+    return buffer
+
+
+def _encoded_size(img, save_options):
+    """画像をメモリ上でエンコードし、そのバイト数を返します"""
+    buffer = _get_estimate_buffer()
+    img.save(buffer, **save_options)
+    return buffer.tell()
+
+
+def estimate_encoded_size(img, output_format, save_options, webp_lossless=False,
+                          target_size=None, sampled=False):
+    """
+    画像を保存した場合のファイルサイズをメモリ上で見積もります（ディスクI/Oなし）
+    
+    sampled=True の場合は、出力サイズに換算した小さな領域を格子状に数か所だけ
+    切り出してエンコードし、画素数の比で全体のサイズを推定します。
+    全体のリサイズとエンコードを省略できるため、大量の画像のドライランが高速になります。
+    
+    Args:
+        img: 元の画像
+        output_format: 出力形式 ('JPEG', 'PNG', 'WEBP')
+        save_options: build_save_options で作成した保存オプション
+        webp_lossless: WebPをロスレスで保存するかどうか
+        target_size: リサイズ後のサイズ (幅, 高さ)。None の場合は img のサイズのまま
+        sampled: 一部の領域から推定するかどうか
+        
+    Returns:
+        int | None: 見積もりサイズ（バイト）。失敗した場合は None
+    """
+    try:
+        target_size = tuple(target_size) if target_size else img.size
+        target_width, target_height = target_size
+        tile = ESTIMATE_TILE_SIZE
+        grid = ESTIMATE_TILE_GRID
+        
+        if not sampled or target_width < tile * grid or target_height < tile * grid:
+            # 全体をエンコードして計測
+            frame = img if target_size == img.size else downscale_image(img, target_size)
+            frame = convert_for_output(frame, output_format, webp_lossless)
+            return _encoded_size(frame, save_options)
+        
+        # ヘッダーやEXIFなど、画像の大きさに依存しない部分のサイズ
+        tiny = convert_for_output(downscale_image(img, (8, 8)), output_format, webp_lossless)
+        overhead = _encoded_size(tiny, save_options)
+        
+        # 出力座標系の格子の中心から領域を切り出し、元画像から直接縮小してエンコード
+        scale_x = img.width / target_width
+        scale_y = img.height / target_height
+        sampled_payload = 0
+        for gy in range(grid):
+            for gx in range(grid):
+                x0 = (2 * gx + 1) * target_width // (2 * grid) - tile // 2
+                y0 = (2 * gy + 1) * target_height // (2 * grid) - tile // 2
+                box = (x0 * scale_x, y0 * scale_y, (x0 + tile) * scale_x, (y0 + tile) * scale_y)
+                piece = downscale_image(img, (tile, tile), box=box)
+                piece = convert_for_output(piece, output_format, webp_lossless)
+                sampled_payload += max(0, _encoded_size(piece, save_options) - overhead)
+        
+        sampled_pixels = tile * tile * grid * grid
+        return int(overhead + sampled_payload * (target_width * target_height) / sampled_pixels)
+    except Exception as e:
+        logger.error(f"サイズ見積もりエラー: {e}")
+        return None
+
+
+def encode_to_byte_budget(img, max_bytes, save_options, min_quality=30,
+                          max_encodes=BYTE_BUDGET_MAX_ENCODES, codec=None):
+    """
+    指定バイト数以下に収まる最高品質を二分探索し、エンコード結果を返します
+    
+    エンコードは全てメモリ上で行い、同じ画像（変換済みのもの）を全ての試行で
+    使い回します。まず save_options の品質で試し、収まらなければ最低品質との間を
+    二分探索します。エンコード回数は max_encodes 回までに制限されます。
+    
+    Args:
+        img: エンコードする画像（出力形式に合わせて変換済みのもの）
+        max_bytes: 許容する最大バイト数
+        save_options: 保存オプション（'quality' を探索の上限として使用）
+        min_quality: 探索する品質の下限
+        max_encodes: エンコードの最大回数
+        codec: エンコードに使うコーデックのバックエンド（select_codec_backend を参照）
+        
+    Returns:
+        tuple[bytes, int, bool, str]: (エンコード結果, 使用した品質, 目標サイズに収まったか,
+        結果をエンコードしたバックエンド名)
+        収まらなかった場合は最低品質でのエンコード結果を返します
+    """
+    backends = {}
+    
+    def encode(test_quality):
+        options = {**save_options, 'quality': test_quality}
+        data, backends[test_quality] = encode_image(img, options, codec)
+        return data
+    
+    high = max(1, min(100, save_options.get('quality', 85)))
+    low = max(1, min(min_quality, high))
+    
+    # 最初の品質で収まればそれで確定（最も多いケース）
+    data = encode(high)
+    encodes = 1
+    if len(data) <= max_bytes:
+        return data, high, True, backends[high]
+    if low == high:
+        return data, high, False, backends[high]
+    
+    # 最低品質でも収まらない場合は探索しない
+    best_data = encode(low)
+    encodes += 1
+    if len(best_data) > max_bytes:
+        return best_data, low, False, backends[low]
+    
+    # low は収まり high は収まらない、という状態を保って範囲を狭める
+    best_quality = low
+    while high - low > 1 and encodes < max_encodes:
+        mid = (low + high) // 2
+        data = encode(mid)
+        encodes += 1
+        if len(data) <= max_bytes:
+            low, best_data, best_quality = mid, data, mid
+        else:
+            high = mid
+    
+    logger.debug(f"品質探索: {encodes}回のエンコードで品質{best_quality}%に決定 "
+                 f"({len(best_data)} / {max_bytes} バイト)")
+    return best_data, best_quality, True, backends[best_quality]
+
+
+def _box_mean(np, values, size):
+    """積分画像を使い、size×size の窓ごとの平均を一度に計算します"""
+    integral = np.pad(values.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+    sums = (integral[size:, size:] - integral[:-size, size:]
+            - integral[size:, :-size] + integral[:-size, :-size])
+    return sums / (size * size)
+
+
+def compute_ssim(reference, candidate, window_size=SSIM_WINDOW_SIZE):
+    """
+    2つの画像の輝度の SSIM（構造的類似度）を numpy で計算します
+    
+    窓ごとの平均・分散・共分散を積分画像からまとめて求めるため、画素ごとのループはありません。
+    
+    Args:
+        reference: 基準の画像
+        candidate: 比較する画像（reference と同じサイズ）
+        window_size: 窓の一辺（ピクセル）
+        
+    Returns:
+        float | None: SSIM (1.0 で完全一致)。numpy がない場合は None
+    """
+    np = _get_numpy()
+    if np is None:
+        return None
+    x = np.asarray(reference.convert('L'), dtype=np.float64)
+    y = np.asarray(candidate.convert('L'), dtype=np.float64)
+    size = max(1, min(window_size, *x.shape))
+    
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    mu_x = _box_mean(np, x, size)
+    mu_y = _box_mean(np, y, size)
+    var_x = _box_mean(np, x * x, size) - mu_x * mu_x
+    var_y = _box_mean(np, y * y, size) - mu_y * mu_y
+    cov_xy = _box_mean(np, x * y, size) - mu_x * mu_y
+    ssim_map = (((2 * mu_x * mu_y + c1) * (2 * cov_xy + c2))
+                / ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2)))
+    return float(ssim_map.mean())
+
+
+def find_quality_for_ssim(img, save_options, target_ssim, min_quality=30,
+                          proxy_size=SSIM_PROXY_SIZE, max_encodes=SSIM_MAX_ENCODES, codec=None):
+    """
+    基準画像との SSIM が target_ssim 以上になる最低の品質を二分探索します
+    
+    探索は長辺 proxy_size ピクセルに縮小したプロキシで行い、エンコードとデコードは全てメモリ上で
+    行います。プロキシは本番と同じバックエンド（encode_image）でエンコードします。save_options の
+    品質を上限とし、上限でも目標に届かない場合や結果をデコードできない場合は上限の品質を返します。
+    
+    Args:
+        img: 基準の画像（リサイズ・出力形式への変換済みのもの）
+        save_options: 保存オプション（'quality' を探索の上限として使用）
+        target_ssim: 目標の SSIM (0-1、例: 0.95)
+        min_quality: 探索する品質の下限
+        proxy_size: プロキシの長辺（ピクセル）
+        max_encodes: エンコードの最大回数
+        codec: 使うバックエンド（select_codec_backend を参照）
+        
+    Returns:
+        int: 決定した品質。numpy がない場合は save_options の品質
+    """
+    high = max(1, min(100, save_options.get('quality', 85)))
+    if _get_numpy() is None:
+        return high
+    low = max(1, min(min_quality, high))
+    
+    scale = proxy_size / max(img.size)
+    if scale < 1:
+        proxy_dims = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        proxy = downscale_image(img, proxy_dims)
+    else:
+        proxy = img
+    # 画素に影響しないオプション（EXIF・ハフマン最適化など）は省いて速くする
+    options = {key: value for key, value in save_options.items()
+               if key not in ('exif', 'optimize', 'progressive')}
+    
+    def score(test_quality):
+        data, _ = encode_image(proxy, {**options, 'quality': test_quality}, codec)
+        with Image.open(io.BytesIO(data)) as decoded:
+            return compute_ssim(proxy, decoded)
+    
+    # 上限でも目標に届かなければ上限を使う
+    try:
+        high_score = score(high)
+    except OSError as e:
+        # Pillow が読めない形式（AVIF プラグインなしの avifenc の出力など）は探索しない
+        logger.debug(f"画質目標の品質探索をスキップ: {e}")
+        return high
+    if high_score < target_ssim or low == high:
+        return high
+    if score(low) >= target_ssim:
+        return low
+    
+    # low は目標に届かず high は届く、という状態を保って範囲を狭める
+    encodes = 2
+    while high - low > 1 and encodes < max_encodes:
+        mid = (low + high) // 2
+        encodes += 1
+        if score(mid) >= target_ssim:
+            high = mid
+        else:
+            low = mid
+    
+    logger.debug(f"画質目標の品質探索: {encodes}回のエンコードで品質{high}%に決定 (SSIM目標: {target_ssim})")
+    return high
+
+
+def tune_quality_for_ssim(img, save_options, target_ssim, name=None, codec=None):
+    """
+    target_ssim が指定され、非可逆の出力形式（JPEG、ロッシーのWebP）であれば、
+    find_quality_for_ssim で決めた品質に置き換えた保存オプションを返します（それ以外はそのまま）
+    """
+    if not target_ssim or 'quality' not in save_options or save_options.get('lossless'):
+        return save_options
+    with perf_stage('ssim', name):
+        quality = find_quality_for_ssim(img, save_options, target_ssim, codec=codec)
+    return {**save_options, 'quality': quality}
+
+
+def update_extension(file_path, new_ext):
+    """
+    ファイルパスの拡張子を更新します
+    
+    Args:
+        file_path: 元のファイルパス
+        new_ext: 新しい拡張子 (ドット付き、例: '.jpg')
+        
+    Returns:
+        str: 拡張子を更新したパス
+    """
+    path_obj = Path(file_path)
+    stem = path_obj.stem
+    parent = path_obj.parent
+    
+    # 新しいパスを作成
+    new_path = parent / f"{stem}{new_ext}"
+    
+    return str(new_path)
+
+
+def downscale_image(img, size, resample=Image.LANCZOS, box=None, reducing_gap=RESIZE_REDUCING_GAP):
+    """
+    画像を2段階で縮小します（整数倍の reduce() の後に Lanczos などで目標サイズへ）
+    
+    縮小率が reducing_gap の2倍以上の場合のみ reduce() が使われ、それ以外は通常の
+    resize と同じです。PNGやWebPなど縮小デコードできない形式の大きな画像で特に効果があります。
+    
+    Args:
+        img: PIL.Image オブジェクト
+        size: 目標サイズ (幅, 高さ)
+        resample: 最終段の補間フィルタ
+        box: 元画像から縮小する領域（省略時は全体）
+        reducing_gap: reduce() 後に残す目標サイズに対する倍率（None で1段階の縮小）
+        
+    Returns:
+        PIL.Image: 縮小した画像
+    """
+    try:
+        return img.resize(tuple(size), resample, box=box, reducing_gap=reducing_gap)
+    except ValueError:
+        # reduce() に対応していないモード（16ビットグレースケールなど）は1段階で縮小
+        if reducing_gap is None:
+            raise
+        return img.resize(tuple(size), resample, box=box)
+
+
+def apply_jpeg_draft(img, target_size, oversample=DRAFT_OVERSAMPLE):
+    """
+    JPEGのDCTスケーリング（draftモード）で縮小デコードするよう設定します
+    
+    画像データを読み込む前に呼び出すと、目標サイズの oversample 倍以上を保てる
+    範囲で 1/2、1/4、1/8 のいずれかの解像度でデコードされます。
+    JPEG/MPO以外の画像や、縮小の必要がない場合は何もしません。
+    
+    Args:
+        img: Image.open で開いた直後（未デコード）の画像
+        target_size: 最終的なリサイズ後のサイズ (幅, 高さ)
+        oversample: 目標サイズに対して確保する解像度の倍率 (1.0以上)
+        
+    Returns:
+        int: 適用された縮小率 (1, 2, 4, 8)。適用しなかった場合は 1
+    """
+    if img.format not in ('JPEG', 'MPO'):
+        return 1
+    
+    original_width, original_height = img.size
+    target_width, target_height = target_size
+    oversample = max(1.0, oversample)
+    request_size = (
+        max(1, math.ceil(target_width * oversample)),
+        max(1, math.ceil(target_height * oversample)),
+    )
+    
+    # 縮小率2未満では効果がないので通常デコード
+    if original_width < request_size[0] * 2 or original_height < request_size[1] * 2:
+        return 1
+    
+    try:
+        img.draft(None, request_size)
+    except Exception as e:
+        logger.debug(f"縮小デコードを適用できませんでした（通常デコードで続行します）: {e}")
+        return 1
+    
+    scale = max(1, original_width // max(1, img.size[0]))
+    if scale > 1:
+        logger.debug(f"JPEG縮小デコード: 1/{scale} "
+                     f"({original_width}x{original_height} → {img.size[0]}x{img.size[1]})")
+    return scale
+
+
+def stat_source_file(path):
+    """
+    1回の os.stat で元ファイルの存在と種類を確認します
+    
+    Args:
+        path: 元ファイルのパス
+        
+    Returns:
+        os.stat_result: stat の結果（サイズなどの取得に使う）
+        
+    Raises:
+        FileNotFoundError: ファイルが存在しないか、通常のファイルでない場合
+    """
+    st = os.stat(path)
+    if not stat.S_ISREG(st.st_mode):
+        raise FileNotFoundError(f"通常のファイルではありません: {path}")
+    return st
+
+
+@contextmanager
+def map_source_file(path):
+    """
+    元ファイルを読み取り専用でメモリマップします
+    
+    返す mmap オブジェクトはファイルと同じように read/seek でき、Image.open に直接渡せます。
+    デコーダーが mmap.read() で読む分のコピーは発生しますが、ファイル全体を先に読み込んだ
+    バッファを持たずに済み、データはページキャッシュ（他のプロセスと共有）から直接読まれます。
+    
+    Args:
+        path: 元ファイルのパス
+        
+    Yields:
+        mmap.mmap: ファイル全体のマップ（len() でファイルサイズが分かる）
+        
+    Raises:
+        ValueError: 空のファイルの場合（mmap できない）
+    """
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            yield mapped
+
+
+@contextmanager
+def open_source_image(path, use_mmap=False):
+    """
+    元画像を開きます。use_mmap の場合はメモリマップ経由で開きます
+    
+    Args:
+        path: 元ファイルのパス
+        use_mmap: メモリマップを使うか
+        
+    Yields:
+        PIL.Image.Image: 開いた画像（with ブロックを出ると閉じられる）
+    """
+    if not use_mmap:
+        with Image.open(path) as img:
+            yield img
+        return
+    with map_source_file(path) as mapped, Image.open(mapped) as img:
+        yield img
+
+
+def read_image_header(source_path):
+    """
+    画像のヘッダーだけを読み込み、画素データをデコードせずにサイズと形式を返します
+    
+    Args:
+        source_path: 画像ファイルのパス
+        
+    Returns:
+        tuple: (幅, 高さ, 形式, モード)。例: (4000, 3000, 'JPEG', 'RGB')
+        
+    Raises:
+        OSError, PIL.UnidentifiedImageError: 画像として読み込めない場合
+    """
+    with Image.open(source_path) as img:
+        return img.size[0], img.size[1], img.format, img.mode
+
+
+# メタデータとして扱う Image.info のキー（EXIF・XMP）と、PNGのメタデータのチャンク
+METADATA_INFO_KEYS = ('exif', 'xmp', 'XML:com.adobe.xmp')
+PNG_METADATA_CHUNKS = (b'eXIf', b'tEXt', b'zTXt', b'iTXt')
+
+
+def _png_has_metadata_chunk(source_path):
+    """PNGのチャンクを画像データの後ろまで走査し、メタデータのチャンクがあるかを返します"""
+    with open(source_path, 'rb') as f:
+        if f.read(8) != b'\x89PNG\r\n\x1a\n':
+            return False
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                return False
+            length, chunk_type = int.from_bytes(header[:4], 'big'), header[4:]
+            if chunk_type in PNG_METADATA_CHUNKS:
+                return True
+            if chunk_type == b'IEND':
+                return False
+            # データとCRCを読み飛ばす
+            f.seek(length + 4, os.SEEK_CUR)
+
+
+def image_has_metadata(img):
+    """
+    開いた画像にEXIF・XMPなどのメタデータが含まれるかを返します
+    
+    PNGのテキストチャンクは、画像データの後ろにあるものは読み込み（load）後に確認できます。
+    """
+    if any(img.info.get(key) for key in METADATA_INFO_KEYS):
+        return True
+    return img.format == 'PNG' and bool(getattr(img, 'text', None))
+
+
+def has_embedded_metadata(source_path):
+    """
+    画像にEXIF・XMPなどのメタデータが含まれるかを、画素データをデコードせずに調べます
+    
+    PNGは画像データの後ろに置かれたチャンク（eXIf・テキスト）も確認します。
+    読み込めない場合は、メタデータを含むものとして True を返します。
+    
+    Args:
+        source_path: 画像ファイルのパス
+        
+    Returns:
+        bool: メタデータが含まれるか
+    """
+    try:
+        with Image.open(source_path) as img:
+            if any(img.info.get(key) for key in METADATA_INFO_KEYS):
+                return True
+            image_format = img.format
+        # PNGは画素をデコードせずに、チャンクを走査して確認する
+        if image_format == 'PNG':
+            return _png_has_metadata_chunk(source_path)
+        return False
+    except Exception:
+        return True
+
+
+def resolve_output_format(input_format, format='original', name=None):
+    """
+    入力形式と指定された出力形式から、実際に保存する形式を決定します
+    
+    Args:
+        input_format: 入力画像の形式 ('JPEG', 'MPO' など。不明な場合は None)
+        format: 指定された出力形式 ('original', 'jpeg', 'png', 'webp')
+        name: 警告メッセージに含めるファイル名（None の場合は警告を出さない）
+        
+    Returns:
+        str: 出力形式 ('JPEG', 'PNG', 'WEBP')
+    """
+    if format == 'original':
+        # 元の形式を維持する場合
+        if input_format == 'MPO':
+            # MPOは維持できないのでJPEGとして扱い、警告を出す
+            if name is not None:
+                logger.warning(f"入力形式がMPOのため、元の形式を維持できません。JPEGとして処理します。 - {name}")
+            return 'JPEG'
+        if input_format and input_format.upper() in OUTPUT_EXTENSIONS:
+            return input_format.upper()
+        # サポート外または不明な形式はJPEGにフォールバック
+        if name is not None:
+            if input_format:
+                logger.warning(f"入力形式 '{input_format}' は維持できません。JPEGに変換します。 - {name}")
+            else:
+                logger.warning(f"入力形式が不明です。JPEGとして処理します。 - {name}")
+        return 'JPEG'
+    
+    if format and format.upper() in OUTPUT_EXTENSIONS:
+        # 特定の形式が指定された場合 (WEBP含む)
+        return format.upper()
+    
+    # 指定された形式がサポート外の場合、JPEGにフォールバック
+    if name is not None:
+        logger.warning(f"指定された出力形式 '{format}' はサポートされていません。JPEGとして処理します。")
+    return 'JPEG'
+
+
+# 出力形式の自動選択に使う画像の統計
+# alpha_used: 透明な画素があるか、colors: 色数、entropy: 輝度ヒストグラムのエントロピー（ビット、0-8）、
+# edge_density: 輝度の差が大きい（エッジの）画素の割合 (0-1)
+ImageStats = namedtuple('ImageStats', ['alpha_used', 'colors', 'entropy', 'edge_density'])
+
+
+def analyze_image(img, thumbnail_size=ANALYSIS_THUMBNAIL_SIZE):
+    """
+    縮小画像から、出力形式の選択に使う統計を numpy でまとめて計算します
+    
+    縮小には最近傍法を使い、元の画像にない中間色が増えないようにします。
+    透明度の使用だけは縮小前の画像全体で確認します（小さな透明部分を見落とさないため）。
+    画像がまだデコードされていない場合はここでデコードされます（縮小デコードの設定後に呼び出すこと）。
+    
+    Args:
+        img: 解析する画像
+        thumbnail_size: 解析に使う縮小画像の長辺（ピクセル）
+        
+    Returns:
+        ImageStats | None: 画像の統計。numpy がない場合は None
+    """
+    np = _get_numpy()
+    if np is None:
+        return None
+    
+    alpha_used = False
+    if 'A' in img.mode or 'transparency' in img.info:
+        alpha = img.convert('RGBA').getchannel('A') if img.mode != 'RGBA' else img.getchannel('A')
+        alpha_used = alpha.getextrema()[0] < 255
+    
+    scale = thumbnail_size / max(img.size)
+    thumb = img
+    if scale < 1:
+        thumb = img.resize((max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+                           Image.Resampling.NEAREST)
+    
+    rgba = np.asarray(thumb.convert('RGBA'), dtype=np.uint8)
+    packed = rgba.view(np.uint32).reshape(-1)
+    colors = int(np.unique(packed).size)
+    
+    luma = np.asarray(thumb.convert('L'), dtype=np.int16)
+    histogram = np.bincount(luma.reshape(-1), minlength=256).astype(np.float64)
+    probabilities = histogram[histogram > 0] / luma.size
+    entropy = float(-(probabilities * np.log2(probabilities)).sum())
+    
+    # 隣り合う画素との輝度差が大きい画素をエッジとして数える
+    edges = np.zeros(luma.shape, dtype=bool)
+    edges[:, 1:] |= np.abs(np.diff(luma, axis=1)) > 32
+    edges[1:, :] |= np.abs(np.diff(luma, axis=0)) > 32
+    edge_density = float(edges.mean())
+    
+    return ImageStats(alpha_used, colors, entropy, edge_density)
+
+
+def choose_output_format(stats):
+    """
+    画像の統計から出力形式を選びます
+    
+    - 写真でなく色数が少ない（図・ロゴ・グラデーションなど）: パレットPNG
+    - 透明度を使う画像: WebP（ロッシーでも透明度を保てる）
+    - エッジが多く輝度の分布が偏っている（スクリーンショット・文字など）: PNG
+    - それ以外の写真: JPEG
+    
+    色数が少なくても、輝度の分布が広くエッジの多い画像（白黒写真など）は写真として扱います。
+    
+    Args:
+        stats: analyze_image の結果
+        
+    Returns:
+        tuple[str, int | None]: (出力形式, パレットの色数)。パレット化しない場合の色数は None
+    """
+    photo_like = (stats.entropy > AUTO_GRAPHIC_ENTROPY
+                  and stats.edge_density >= AUTO_PHOTO_EDGE_DENSITY)
+    if stats.colors <= AUTO_PALETTE_COLORS and not photo_like:
+        return 'PNG', AUTO_PALETTE_COLORS
+    if stats.alpha_used:
+        return 'WEBP', None
+    if stats.edge_density >= AUTO_GRAPHIC_EDGE_DENSITY and stats.entropy <= AUTO_GRAPHIC_ENTROPY:
+        return 'PNG', None
+    return 'JPEG', None
+
+
+def decide_output_format(img, format='original', name=None):
+    """
+    実際に保存する形式を決定します。format='auto' の場合は画素を解析して選びます
+    
+    'auto' の場合は画像がデコードされるため、縮小デコード（apply_jpeg_draft）の設定後に呼び出してください。
+    numpy がない場合、'auto' は 'original' と同じ扱いになります。
+    
+    Args:
+        img: Image.open で開いた画像
+        format: 指定された出力形式 ('original', 'auto', 'jpeg', 'png', 'webp')
+        name: ログと計測に使う名前（None の場合は警告を出さない）
+        
+    Returns:
+        tuple[str, int | None]: (出力形式, パレットの色数)。パレット化しない場合の色数は None
+    """
+    if format != 'auto':
+        return resolve_output_format(img.format, format, name=name), None
+    
+    with perf_stage('analyze', name):
+        stats = analyze_image(img)
+    if stats is None:
+        return resolve_output_format(img.format, 'original', name=name), None
+    output_format, palette_colors = choose_output_format(stats)
+    logger.debug(f"出力形式を自動選択: {output_format}{' (パレット)' if palette_colors else ''} - "
+                 f"色数 {stats.colors}, エントロピー {stats.entropy:.2f}, エッジ密度 {stats.edge_density:.3f}, "
+                 f"透明度 {'あり' if stats.alpha_used else 'なし'} - {name}")
+    return output_format, palette_colors
+
+
+# 事前走査で作成する画像ごとの処理計画
+# action: 'resize'（縮小が必要）, 'reencode'（縮小不要だが再エンコードする）,
+#         'copy'（そのままコピーできる）, 'error'（画像として読み込めない）
+ImagePlan = namedtuple(
+    'ImagePlan',
+    ['path', 'file_size', 'width', 'height', 'format', 'mode', 'output_format', 'action',
+     'output_size'],
+)
+
+
+def plan_image(source_path, target_width, format='original', copy_unchanged=False, file_size=None,
+               keep_exif=True):
+    """
+    画像のヘッダーだけを読み込み、画素データをデコードせずに処理計画を作成します
+    
+    Args:
+        source_path: 画像ファイルのパス
+        target_width: 目標の幅
+        format: 出力形式 ('original', 'auto', 'jpeg', 'png', 'webp', 'avif')
+        copy_unchanged: リサイズも形式変換も不要な画像を 'copy' にするか（False の場合は 'reencode'）
+        file_size: 元ファイルのサイズ（省略時は取得します）
+        keep_exif: False の場合、EXIF・XMPを含む画像はコピーせず 'reencode' にする
+                   （コピーではメタデータを取り除けないため）
+        
+    Returns:
+        ImagePlan: 処理計画
+    """
+    try:
+        if file_size is None:
+            file_size = os.path.getsize(source_path)
+        width, height, image_format, mode = read_image_header(source_path)
+    except Exception:
+        return ImagePlan(Path(source_path), file_size or 0, 0, 0, None, None, None, 'error', None)
+    
+    # 'auto' は画素を解析するまで出力形式が決まらない
+    output_format = None if format == 'auto' else resolve_output_format(image_format, format)
+    if width > target_width:
+        action = 'resize'
+        output_size = (target_width, max(1, int(height * target_width / width)))
+    else:
+        # MPOは複数の画像を含むため、JPEGとして出力する場合も再エンコードする
+        unchanged = output_format == image_format
+        copyable = copy_unchanged and unchanged
+        if copyable and not keep_exif:
+            copyable = not has_embedded_metadata(source_path)
+        action = 'copy' if copyable else 'reencode'
+        output_size = (width, height)
+    return ImagePlan(Path(source_path), file_size, width, height, image_format, mode,
+                     output_format, action, output_size)
+
+
+def build_plan(source_paths, target_width, format='original', copy_unchanged=False,
+               workers=PIPELINE_IO_THREADS, keep_exif=True):
+    """
+    複数の画像の処理計画を、ヘッダーだけを並列に読み込んで作成します
+    
+    Args:
+        source_paths: 画像ファイルのパスのイテラブル
+        target_width: 目標の幅
+        format: 出力形式 ('original', 'auto', 'jpeg', 'png', 'webp', 'avif')
+        copy_unchanged: リサイズも形式変換も不要な画像を 'copy' にするか
+        workers: ヘッダーを読み込むスレッド数
+        keep_exif: False の場合、メタデータを含む画像は 'copy' にしない（plan_image を参照）
+        
+    Returns:
+        list[ImagePlan]: source_paths と同じ順序の処理計画
+    """
+    def plan(path):
+        return plan_image(path, target_width, format, copy_unchanged, keep_exif=keep_exif)
+    
+    if workers <= 1:
+        return [plan(path) for path in source_paths]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(plan, source_paths))
+
+
+def summarize_plan(plans):
+    """
+    処理計画をアクションごとに集計します
+    
+    Returns:
+        dict: {アクション: {'count': 件数, 'bytes': 元ファイルサイズの合計, 'pixels': 画素数の合計}}
+    """
+    summary = {}
+    for plan in plans:
+        stats = summary.setdefault(plan.action, {'count': 0, 'bytes': 0, 'pixels': 0})
+        stats['count'] += 1
+        stats['bytes'] += plan.file_size
+        stats['pixels'] += plan.width * plan.height
+    return summary
+
+
+def write_plan(plans, output_file):
+    """
+    処理計画をファイルに出力します
+    
+    拡張子が .csv の場合は1画像1行のCSV、それ以外は集計結果と全画像の計画を含むJSONで出力します。
+    
+    Args:
+        plans: ImagePlan のリスト
+        output_file: 出力先のファイルパス
+    """
+    def row(plan):
+        values = plan._asdict()
+        values['path'] = str(plan.path)
+        values['output_size'] = 'x'.join(map(str, plan.output_size)) if plan.output_size else ''
+        return values
+    
+    output_path = Path(output_file)
+    if output_path.suffix.lower() == '.csv':
+        with open(output_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=ImagePlan._fields)
+            writer.writeheader()
+            for plan in plans:
+                writer.writerow(row(plan))
+    else:
+        data = {
+            'summary': summarize_plan(plans),
+            'plans': [row(plan) for plan in plans],
+            'timestamp': time.time(),
+        }
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+def _reflink_file(source_path, dest_path):
+    """reflink（FICLONE、btrfs/xfs などのコピーオンライト複製）で複製します。対応していなければ False"""
+    if fcntl is None:
+        return False
+    try:
+        with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), _FICLONE, src.fileno())
+        return True
+    except OSError:
+        return False
+
+
+def _copy_file_range(source_path, dest_path):
+    """os.copy_file_range でカーネル内コピーします。対応していなければ False"""
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    try:
+        with open(source_path, 'rb') as src, open(dest_path, 'wb') as dst:
+            remaining = os.fstat(src.fileno()).st_size
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), min(remaining, 1 << 30))
+                if copied == 0:
+                    break
+                remaining -= copied
+        return remaining <= 0
+    except OSError:
+        return False
+
+
+def copy_source_file(source_path, dest_path, method='auto'):
+    """
+    元ファイルをデコードせずにそのまま出力先へ複製します
+    
+    一時ファイルに複製してからリネームするため、途中で中断されても不完全な出力は残りません。
+    複製方法は次の順に試し、使えなければ次の方法にフォールバックします。
+    
+    - 'hardlink': ハードリンク（元ファイルと同じ実体を共有。同じボリューム上のみ）
+    - 'auto': reflink（コピーオンライト複製）→ os.copy_file_range → 通常のストリームコピー
+    - 'copy': 通常のストリームコピーのみ
+    
+    ハードリンク以外では更新時刻などのメタデータもコピーします。
+    
+    Args:
+        source_path: 元ファイルのパス
+        dest_path: 出力先のパス
+        method: 複製方法 (COPY_METHODS のいずれか)
+        
+    Returns:
+        str: 実際に使われた方法 ('hardlink', 'reflink', 'copy_file_range', 'copy')
+    """
+    if method not in COPY_METHODS:
+        raise ValueError(f"未対応の複製方法です: {method}")
+    
+    source_path = str(source_path)
+    dest_path = str(dest_path)
+    temp_path = os.path.join(os.path.dirname(dest_path) or '.', f".tmp_copy_{uuid.uuid4().hex}")
+    
+    with perf_stage('copy', source_path) as stage:
+        try:
+            used = None
+            if method == 'hardlink':
+                try:
+                    os.link(source_path, temp_path)
+                    used = 'hardlink'
+                except OSError as e:
+                    logger.debug(f"ハードリンクを作成できないため複製します: {e}")
+            if used is None and method != 'copy':
+                if _reflink_file(source_path, temp_path):
+                    used = 'reflink'
+                elif _copy_file_range(source_path, temp_path):
+                    used = 'copy_file_range'
+            if used is None:
+                shutil.copyfile(source_path, temp_path)
+                used = 'copy'
+            if used != 'hardlink':
+                shutil.copystat(source_path, temp_path)
+            os.replace(temp_path, dest_path)
+        except BaseException:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                pass
+            raise
+        stage.nbytes = os.path.getsize(dest_path)
+    
+    logger.debug(f"複製しました ({used}): {source_path} → {dest_path}")
+    return used
+
+
+def _pixel_bytes(mode):
+    """Pillowが内部で1画素の保持に使うバイト数を返します（RGBなど3チャンネルも4バイト）"""
+    if mode in ('1', 'L', 'P'):
+        return 1
+    if mode.startswith('I;16'):
+        return 2
+    return 4
+
+
+def estimate_processing_memory(width, height, mode, image_format, target_width, file_size=0,
+                               fast_decode=True, draft_oversample=DRAFT_OVERSAMPLE,
+                               reducing_gap=RESIZE_REDUCING_GAP):
+    """
+    1枚の画像の処理（読み込み・デコード・縮小・エンコード）に必要なメモリ量を見積もります
+    
+    ヘッダーから得られるサイズだけで計算し、JPEGの縮小デコードと2段階縮小の中間画像も考慮します。
+    
+    Args:
+        width, height: 元画像のサイズ
+        mode: 画像のモード ('RGB' など)
+        image_format: 画像の形式 ('JPEG' など)
+        target_width: 目標の幅
+        file_size: 元ファイルのサイズ（読み込んだデータとエンコード結果の分として加算）
+        fast_decode: JPEGの縮小デコードを使うか
+        draft_oversample: 縮小デコード時に確保する解像度の倍率
+        reducing_gap: 2段階縮小の倍率（downscale_image を参照）
+        
+    Returns:
+        int: 見積もりメモリ量（バイト）
+    """
+    pixel_bytes = _pixel_bytes(mode)
+    if width <= target_width or width <= 0:
+        # 縮小しない場合はデコード結果と出力用の変換のみ
+        return file_size * 2 + width * height * (pixel_bytes + 4)
+    
+    target_height = max(1, int(height * target_width / width))
+    
+    # JPEGの縮小デコード後のサイズ（apply_jpeg_draft と同じ条件）
+    decoded_width, decoded_height = width, height
+    if fast_decode and image_format in ('JPEG', 'MPO'):
+        request_width = math.ceil(target_width * max(1.0, draft_oversample))
+        request_height = math.ceil(target_height * max(1.0, draft_oversample))
+        for scale in (8, 4, 2):
+            if width // scale >= request_width and height // scale >= request_height:
+                decoded_width, decoded_height = math.ceil(width / scale), math.ceil(height / scale)
+                break
+    decoded = decoded_width * decoded_height * pixel_bytes
+    
+    # reduce() による中間画像
+    intermediate = 0
+    if reducing_gap:
+        factor = int(decoded_width / target_width / reducing_gap)
+        if factor >= 2:
+            intermediate = (decoded_width // factor) * (decoded_height // factor) * pixel_bytes
+    
+    # 縮小後の画像と出力用に変換した画像
+    resized = target_width * target_height * 4 * 2
+    return file_size * 2 + decoded + intermediate + resized
+
+
+class MemoryBudget:
+    """
+    処理中の画像の見積もりメモリ量の合計を上限以下に抑えるための受付制御
+    
+    acquire で見積もり量を予約し、処理が終わったら release で返却します。
+    上限を超える大きな画像は、他の画像の処理がすべて終わってから単独で処理されます。
+    大きな画像が待っている間は新しい予約を受け付けないため、小さな画像が次々に予約して
+    大きな画像がいつまでも待たされることはありません。
+    """
+    
+    def __init__(self, limit_bytes: int):
+        """
+        Args:
+            limit_bytes: メモリ使用量の上限（バイト）
+        """
+        self.limit_bytes = max(1, int(limit_bytes))
+        self._used = 0
+        self._oversize_waiting = 0
+        self._condition = threading.Condition()
+    
+    @property
+    def used(self) -> int:
+        """予約中のメモリ量（バイト）"""
+        with self._condition:
+            return self._used
+    
+    def acquire(self, nbytes: int, cancelled=None) -> bool:
+        """
+        メモリ量を予約します（上限に空きができるまで待機します）
+        
+        Args:
+            nbytes: 予約するメモリ量（バイト）
+            cancelled: 待機を打ち切るかを返す関数
+            
+        Returns:
+            bool: 予約できたか（打ち切られた場合は False）
+        """
+        nbytes = max(0, int(nbytes))
+        with self._condition:
+            if nbytes > self.limit_bytes:
+                return self._acquire_oversize(nbytes, cancelled)
+            # 上限内に収まり、上限を超える画像が待っていなくなるまで待つ
+            while self._oversize_waiting or self._used + nbytes > self.limit_bytes:
+                if cancelled is not None and cancelled():
+                    return False
+                self._condition.wait(timeout=0.1)
+            self._used += nbytes
+            return True
+    
+    def _acquire_oversize(self, nbytes, cancelled):
+        """上限を超えるメモリ量を、処理中の画像がなくなるまで待って予約します（ロック保持中に呼ぶ）"""
+        self._oversize_waiting += 1
+        try:
+            while self._used:
+                if cancelled is not None and cancelled():
+                    return False
+                self._condition.wait(timeout=0.1)
+        finally:
+            self._oversize_waiting -= 1
+            self._condition.notify_all()
+        logger.debug(f"見積もりメモリ量 {format_file_size(nbytes)} が上限を超えるため単独で処理します")
+        self._used += nbytes
+        return True
+    
+    def release(self, nbytes: int):
+        """予約したメモリ量を返却します"""
+        with self._condition:
+            self._used = max(0, self._used - max(0, int(nbytes)))
+            self._condition.notify_all()
+
+
+def adjust_quality_by_balance(quality, balance, format):
+    """
+    圧縮と品質のバランスに基づいて品質パラメータを調整します
+    
+    Args:
+        quality: 元の品質値 (1-100)
+        balance: 圧縮と品質のバランス (1-10, 1=最高圧縮率, 10=最高品質) - PNGは png_tier_for_balance で扱う
+        format: 出力形式 ('jpeg', 'png', 'webp')
+        
+    Returns:
+        int: 調整後の品質値
+    """
+    # バランス値を正規化 (1-10 → 0.0-1.0)
+    balance_factor = (balance - 1) / 9.0
+    
+    # 形式ごとの品質調整
+    if format.lower() == 'jpeg':
+        # JPEGの場合: バランス値が高いほど高品質
+        # balance = 1 (最高圧縮) → quality * 0.7
+        # balance = 10 (最高品質) → quality * 1.2 (上限100)
+        adjustment = 0.7 + (balance_factor * 0.5)
+        new_quality = int(quality * adjustment)
+        
+    elif format.lower() == 'png':
+        # PNGの場合: ロスレスのため品質は使わない（balance は png_tier_for_balance で圧縮の段階に対応させる）
+        new_quality = quality
+        
+    elif format.lower() in ('webp', 'avif'):
+        # WebP・AVIFの場合: バランスに基づく調整
+        # balance = 1 (最高圧縮) → quality * 0.6
+        # balance = 10 (最高品質) → quality * 1.1 (上限100)
+        adjustment = 0.6 + (balance_factor * 0.5)
+        new_quality = int(quality * adjustment)
+    
+    else:
+        # 未対応の形式はそのまま返す
+        new_quality = quality
+    
+    # 範囲の正規化 (1-100)
+    return max(1, min(100, new_quality))
+
+
+def png_tier_for_balance(balance):
+    """
+    圧縮と品質のバランスからPNGの圧縮の段階を決めます
+    
+    PNGはロスレスのため画質は変わらず、balance はファイルサイズと保存にかかる時間の
+    バランスとして扱います。
+    
+    Args:
+        balance: 圧縮と品質のバランス (1-10, 1=最高圧縮率, 10=最高品質)
+        
+    Returns:
+        str: 'max' (1-3, 最小サイズ)、'default' (4-7)、'fast' (8-10, 最速)
+    """
+    if balance <= 3:
+        return 'max'
+    if balance >= 8:
+        return 'fast'
+    return 'default'
 
 
 def format_file_size(size_in_bytes):
@@ -1176,49 +3142,901 @@ def format_file_size(size_in_bytes):
     return f"{size_in_bytes:.1f} {unit}"
 
 
-def save_progress(processed_files, remaining_files, output_file="progress.json"):
+class _StageMeasurement:
+    """perf_stage で計測中の段階に付随する情報（処理したバイト数、エンコードしたバックエンドなど）"""
+    
+    __slots__ = ('nbytes', 'backend')
+    
+    def __init__(self):
+        self.nbytes = None
+        self.backend = None
+
+
+class PerfRecorder:
+    """
+    画像ごと・処理段階ごとの計測結果（経過時間・CPU時間・バイト数・コーデックのバックエンド）を記録します
+    
+    段階ごとのパーセンタイル (p50/p95/p99) を集計し、JSON または CSV で出力できます。
+    CPU時間が経過時間より大幅に短い段階は I/O 待ちが支配的であることを示します。
+    """
+    
+    CSV_FIELDS = ('image', 'stage', 'wall_ms', 'cpu_ms', 'bytes', 'backend')
+    
+    def __init__(self):
+        self._records = []
+        self._lock = threading.Lock()
+    
+    def add(self, image, stage, wall, cpu, nbytes=None, backend=None):
+        """計測結果を1件追加します（時間は秒単位）"""
+        with self._lock:
+            name = str(image) if image is not None else ''
+            self._records.append((name, stage, wall, cpu, nbytes, backend))
+    
+    def extend(self, records):
+        """他の PerfRecorder（ワーカープロセスなど）の records をまとめて追加します"""
+        with self._lock:
+            self._records.extend(tuple(r) for r in records)
+    
+    @property
+    def records(self):
+        """記録済みの計測結果のリスト [(画像, 段階, 経過秒, CPU秒, バイト数, バックエンド), ...]"""
+        with self._lock:
+            return list(self._records)
+    
+    def summary(self):
+        """
+        段階ごとの集計結果を返します
+        
+        Returns:
+            dict: {段階名: {'count', 'wall_total_s', 'wall_p50_ms', 'wall_p95_ms', 'wall_p99_ms',
+                            'cpu_total_s', 'cpu_p50_ms', 'cpu_p95_ms', 'cpu_p99_ms',
+                            'cpu_ratio', 'bytes_total'}}
+            エンコードの段階にはバックエンドごとの件数 'backends' ({バックエンド名: 件数}) も含まれます
+        """
+        by_stage = {}
+        for _, stage, wall, cpu, nbytes, backend in self.records:
+            by_stage.setdefault(stage, []).append((wall, cpu, nbytes, backend))
+        
+        result = {}
+        for stage, samples in by_stage.items():
+            walls = sorted(s[0] for s in samples)
+            cpus = sorted(s[1] for s in samples)
+            wall_total = sum(walls)
+            cpu_total = sum(cpus)
+            result[stage] = {
+                'count': len(samples),
+                'wall_total_s': round(wall_total, 6),
+                'wall_p50_ms': round(percentile(walls, 50) * 1000, 3),
+                'wall_p95_ms': round(percentile(walls, 95) * 1000, 3),
+                'wall_p99_ms': round(percentile(walls, 99) * 1000, 3),
+                'cpu_total_s': round(cpu_total, 6),
+                'cpu_p50_ms': round(percentile(cpus, 50) * 1000, 3),
+                'cpu_p95_ms': round(percentile(cpus, 95) * 1000, 3),
+                'cpu_p99_ms': round(percentile(cpus, 99) * 1000, 3),
+                'cpu_ratio': round(cpu_total / wall_total, 3) if wall_total > 0 else None,
+                'bytes_total': sum(s[2] for s in samples if s[2] is not None),
+            }
+            backends = [s[3] for s in samples if s[3] is not None]
+            if backends:
+                result[stage]['backends'] = {name: backends.count(name)
+                                             for name in sorted(set(backends))}
+        return result
+    
+    def dump(self, output_file):
+        """
+        計測結果をファイルに出力します
+        
+        拡張子が .csv の場合は1計測1行のCSV、それ以外は集計結果と全記録を含むJSONで出力します。
+        
+        Args:
+            output_file: 出力先のファイルパス
+        """
+        output_path = Path(output_file)
+        if output_path.suffix.lower() == '.csv':
+            with open(output_path, 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(self.CSV_FIELDS)
+                for image, stage, wall, cpu, nbytes, backend in self.records:
+                    writer.writerow([image, stage, round(wall * 1000, 3), round(cpu * 1000, 3),
+                                     '' if nbytes is None else nbytes, backend or ''])
+        else:
+            data = {
+                'summary': self.summary(),
+                'records': [dict(zip(self.CSV_FIELDS, (image, stage, round(wall * 1000, 3),
+                                                       round(cpu * 1000, 3), nbytes, backend)))
+                            for image, stage, wall, cpu, nbytes, backend in self.records],
+                'timestamp': time.time(),
+            }
+            with open(output_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+
+
+# 有効な計測レコーダー（None の場合は計測しない）
+_perf_recorder = None
+
+
+def enable_instrumentation(recorder=None):
+    """
+    処理段階ごとの計測を有効にします
+    
+    Args:
+        recorder: 記録先の PerfRecorder（省略時は新規作成）
+        
+    Returns:
+        PerfRecorder: 記録先のレコーダー
+    """
+    global _perf_recorder
+    _perf_recorder = recorder if recorder is not None else PerfRecorder()
+    return _perf_recorder
+
+
+def disable_instrumentation():
+    """
+    処理段階ごとの計測を無効にします
+    
+    Returns:
+        PerfRecorder | None: それまで有効だったレコーダー
+    """
+    global _perf_recorder
+    recorder, _perf_recorder = _perf_recorder, None
+    return recorder
+
+
+def get_perf_recorder():
+    """有効な計測レコーダーを返します（無効な場合は None）"""
+    return _perf_recorder
+
+
+@contextmanager
+def perf_stage(stage, image=None):
+    """
+    処理段階の経過時間とCPU時間を計測するコンテキストマネージャ
+    
+    計測が無効な場合はほぼ何もしません。処理したバイト数とエンコードしたバックエンド名は、
+    yield された値の nbytes・backend に設定すると記録されます。
+    
+    Args:
+        stage: 段階名 ('decode', 'encode' など)
+        image: 対象の画像（パスなど）
+    """
+    recorder = _perf_recorder
+    measurement = _StageMeasurement()
+    if recorder is None:
+        yield measurement
+        return
+    
+    wall_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    try:
+        yield measurement
+    finally:
+        recorder.add(image, stage, time.perf_counter() - wall_start,
+                     time.thread_time() - cpu_start, measurement.nbytes, measurement.backend)
+
+
+def percentile(sorted_values, pct):
+    """
+    昇順に並んだ値から最近傍順位法でパーセンタイルを求めます
+    
+    Args:
+        sorted_values: 昇順に並んだ数値のリスト
+        pct: パーセンタイル (0-100)
+        
+    Returns:
+        float: パーセンタイル値（空の場合は 0.0）
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(len(sorted_values) * pct / 100))
+    return sorted_values[rank - 1]
+
+
+def _call_with_instrumentation(func, *args, **kwargs):
+    """
+    計測を有効にして func を呼び出し、(戻り値, 計測記録) を返します
+    
+    ワーカープロセス内の計測結果を親プロセスのレコーダーにまとめるために使います。
+    """
+    recorder = enable_instrumentation()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        disable_instrumentation()
+    return result, recorder.records
+
+
+def create_process_pool(workers, initializer=None):
+    """
+    段階パイプラインの処理段階に使うプロセスプールを作成します
+    
+    fork で起動すると、読み込み・書き込みスレッドがインポートやログのロックを保持した瞬間の
+    状態が子プロセスに引き継がれ、子プロセスが停止することがあります。そのため、使える環境では
+    forkserver でワーカーを起動します（Windows では常に spawn です）。
+    
+    Args:
+        workers: ワーカープロセス数
+        initializer: 各ワーカーの起動時に呼び出す関数
+        
+    Returns:
+        ProcessPoolExecutor: 作成したプロセスプール
+    """
+    context = None
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+    return ProcessPoolExecutor(max_workers=workers, initializer=initializer, mp_context=context)
+
+
+def run_staged_pipeline(items, read_fn, process_fn, write_fn, read_workers=PIPELINE_IO_THREADS,
+                        process_workers=1, write_workers=PIPELINE_IO_THREADS, queue_size=None,
+                        executor=None, should_stop=None, memory_budget=None, cost_fn=None):
     """
-    処理の進捗状況を保存します
+    読み込み・処理・書き込みの3段階を有界キューでつないだパイプラインで items を処理します
+    
+    読み込み（プリフェッチ）と書き込みはスレッドプールで行い、I/O待ちの間もエンコードを進めます。
+    段階間のキューは有界のため、後段が詰まると前段が待機し、メモリ上の画像数が抑えられます。
     
     Args:
-        processed_files: 処理済みファイルのリスト
-        remaining_files: 残りのファイルのリスト
-        output_file: 出力ファイル名
+        items: 処理対象のイテラブル
+        read_fn: read_fn(item) -> payload（I/Oスレッドで実行）
+        process_fn: process_fn(item, payload) -> processed（CPU処理。executor 指定時はそこで実行）
+        write_fn: write_fn(item, processed) -> result（I/Oスレッドで実行）
+        read_workers: 読み込みスレッド数
+        process_workers: 同時に処理する件数（executor 未指定時はスレッド数）
+        write_workers: 書き込みスレッド数
+        queue_size: 段階間キューの上限（省略時は process_workers の2倍）
+        executor: 処理段階を実行する Executor（ProcessPoolExecutor など。process_fn は pickle 可能であること）
+        should_stop: 新しい項目の読み込みを止めるかを返す関数（読み込み済みの項目は最後まで処理）
+        memory_budget: MemoryBudget。指定した場合、cost_fn(item) の見積もり量を読み込み前に予約し、
+                       書き込み完了（またはエラー）時に返却します
+        cost_fn: cost_fn(item) -> 見積もりメモリ量（バイト）（I/Oスレッドで実行）
+        
+    Yields:
+        tuple: 完了した順に (item, result, error)。いずれかの段階で例外が発生した場合は
+               result が None、error がその例外になります
     """
-    data = {
-        "processed": [str(p) for p in processed_files],
-        "remaining": [str(r) for r in remaining_files],
-        "timestamp": time.time()
-    }
+    read_workers = max(1, read_workers)
+    process_workers = max(1, process_workers)
+    write_workers = max(1, write_workers)
+    if queue_size is None:
+        queue_size = process_workers * 2
+    
+    read_queue = queue.Queue(maxsize=max(1, queue_size))
+    write_queue = queue.Queue(maxsize=max(1, queue_size))
+    result_queue = queue.Queue()
+    cancelled = threading.Event()
+    item_iter = iter(items)
+    item_lock = threading.Lock()
+    done_marker = object()
+    
+    # 処理段階をプロセスで実行する場合は、ワーカー側の計測記録も受け取る
+    recorder = _perf_recorder
+    profile_in_executor = executor is not None and recorder is not None
+    
+    def put(q, value):
+        # キャンセル時にブロックしたままにならないよう、タイムアウト付きで投入する
+        while not cancelled.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def get(q):
+        while not cancelled.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return done_marker
+    
+    def next_item():
+        with item_lock:
+            if cancelled.is_set() or (should_stop is not None and should_stop()):
+                return done_marker
+            return next(item_iter, done_marker)
+    
+    costs = {}
+    
+    def admit(item):
+        # メモリ量を予約できるまで読み込みを待機する（id をキーに返却量を覚えておく）
+        if memory_budget is None:
+            return True
+        try:
+            cost = cost_fn(item) if cost_fn is not None else 0
+        except Exception:
+            cost = 0
+        if not memory_budget.acquire(cost, cancelled.is_set):
+            return False
+        costs[id(item)] = cost
+        return True
+    
+    def finish(item, result, error):
+        if memory_budget is not None:
+            memory_budget.release(costs.pop(id(item), 0))
+        result_queue.put((item, result, error))
+    
+    def reader():
+        while True:
+            item = next_item()
+            if item is done_marker:
+                break
+            if not admit(item):
+                break
+            try:
+                payload = read_fn(item)
+            except Exception as e:
+                finish(item, None, e)
+                continue
+            if not put(read_queue, (item, payload)):
+                break
+    
+    def processor():
+        while True:
+            entry = get(read_queue)
+            if entry is done_marker:
+                break
+            item, payload = entry
+            try:
+                if executor is None:
+                    processed = process_fn(item, payload)
+                elif profile_in_executor:
+                    processed, records = executor.submit(
+                        _call_with_instrumentation, process_fn, item, payload
+                    ).result()
+                    recorder.extend(records)
+                else:
+                    processed = executor.submit(process_fn, item, payload).result()
+            except Exception as e:
+                finish(item, None, e)
+                continue
+            if not put(write_queue, (item, processed)):
+                break
+    
+    def writer():
+        while True:
+            entry = get(write_queue)
+            if entry is done_marker:
+                break
+            item, processed = entry
+            try:
+                result = write_fn(item, processed)
+            except Exception as e:
+                finish(item, None, e)
+            else:
+                finish(item, result, None)
+    
+    def start(target, count, name):
+        threads = [threading.Thread(target=target, name=f"pipeline-{name}-{i}", daemon=True)
+                   for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+    
+    def close_stage(threads, next_queue, consumers):
+        # 前段のスレッドがすべて終了したら、後段のスレッド数だけ終了マーカーを送る
+        for thread in threads:
+            thread.join()
+        for _ in range(consumers):
+            put(next_queue, done_marker)
+    
+    def supervisor():
+        close_stage(readers, read_queue, process_workers)
+        close_stage(processors, write_queue, write_workers)
+        for thread in writers:
+            thread.join()
+        result_queue.put(done_marker)
     
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    readers = start(reader, read_workers, "read")
+    processors = start(processor, process_workers, "process")
+    writers = start(writer, write_workers, "write")
+    threading.Thread(target=supervisor, name="pipeline-supervisor", daemon=True).start()
+    
+    try:
+        while True:
+            entry = result_queue.get()
+            if entry is done_marker:
+                break
+            yield entry
+    finally:
+        # 呼び出し側が途中で終了した場合も、スレッドがキューで待ち続けないようにする
+        cancelled.set()
 
 
-def load_progress(input_file="progress.json"):
+def resize_pipeline_item(item, target_width, **options):
     """
-    保存された進捗を読み込みます
+    run_staged_pipeline の処理段階として resize_and_compress_image を呼び出します
+    
+    プロセスプールで実行できるよう、モジュールの関数として定義しています。
+    画像ごとの目標幅は読み込み段階で決め、payload として受け取ります。
     
     Args:
-        input_file: 入力ファイル名
+        item: (元ファイルパス, 出力先パス)
+        target_width: 目標の幅 (ピクセル)
+        **options: resize_and_compress_image に渡すキーワード引数（quality, format など）
         
     Returns:
-        tuple: (処理済みファイルリスト, 残りファイルリスト)
+        tuple[bool, bool, int | None]: resize_and_compress_image の戻り値
+    """
+    source_path, dest_path = item
+    return resize_and_compress_image(source_path, dest_path, target_width, **options)
+
+
+async def resize_many(items, concurrency=None, executor=None, **options):
+    """
+    複数の画像を非同期にリサイズし、完了した順に結果を返します（asyncio 用）
+    
+    各画像の resize_and_compress_image（ファイルの読み書きとデコード・エンコード）は executor で
+    実行するため、イベントループをブロックしません。同時に実行するのは concurrency 件までで、
+    items は必要な分だけ順に取り出します（非同期イテラブルも使えます）。
+    
+    呼び出し側がタスクをキャンセルするか途中で反復をやめると、未開始の処理は取り消されます。
+    実行中の処理は最後まで進みますが、出力は一時ファイルからのリネームで書き込まれるため、
+    不完全なファイルは残りません。
+    
+    Args:
+        items: (元ファイルパス, 出力先パス) のイテラブルまたは非同期イテラブル
+        concurrency: 同時に処理する件数（省略時はCPU数）
+        executor: 処理に使う Executor。省略時は concurrency 個のスレッドプールを作成し、終了時に破棄します。
+                  ProcessPoolExecutor（create_process_pool など）を渡す場合、options は pickle 可能であること
+        **options: resize_and_compress_image に渡すキーワード引数（quality, format など。target_width は必須）
+        
+    Yields:
+        tuple: 完了した順に (item, result, error)。例外が発生した場合は result が None、
+               error がその例外になります
+        
+    Example:
+        async for item, result, error in resize_many(pairs, concurrency=4,
+                                                     target_width=1280, quality=85):
+            ...
     """
+    loop = asyncio.get_running_loop()
+    concurrency = max(1, concurrency or os.cpu_count() or 1)
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="resize-async")
+    
+    # プロセスで実行する場合は、ワーカー側の計測記録も受け取る
+    recorder = _perf_recorder
+    profile_in_executor = isinstance(executor, ProcessPoolExecutor) and recorder is not None
+    
+    async def run(item):
+        source_path, dest_path = item
+        call = partial(resize_and_compress_image, source_path, dest_path, **options)
+        if profile_in_executor:
+            result, records = await loop.run_in_executor(
+                executor, partial(_call_with_instrumentation, call)
+            )
+            recorder.extend(records)
+            return result
+        return await loop.run_in_executor(executor, call)
+    
+    async def iterate():
+        if hasattr(items, '__aiter__'):
+            async for item in items:
+                yield item
+        else:
+            for item in items:
+                yield item
+    
+    pending = {}
+    
+    async def wait_finished():
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        entries = []
+        for task in done:
+            item = pending.pop(task)
+            try:
+                entries.append((item, task.result(), None))
+            except Exception as e:
+                entries.append((item, None, e))
+        return entries
+    
     try:
-        if not os.path.exists(input_file):
-            return [], []
+        async for item in iterate():
+            if len(pending) >= concurrency:
+                for entry in await wait_finished():
+                    yield entry
+            pending[asyncio.ensure_future(run(item))] = item
+        while pending:
+            for entry in await wait_finished():
+                yield entry
+    finally:
+        for task in pending:
+            task.cancel()
+        if own_executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+
+def compute_file_hash(file_path, chunk_size=1024 * 1024):
+    """
+    ファイル内容のハッシュ値（BLAKE2b）を計算します
+    
+    Args:
+        file_path: 対象ファイルのパス
+        chunk_size: 一度に読み込むバイト数
+        
+    Returns:
+        str: 16進数のハッシュ文字列
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _same_output_path(recorded, expected):
+    """記録された出力先と期待する出力先が、拡張子を除いて同じファイルを指すかを返します"""
+    def comparable(path):
+        return os.path.normcase(os.path.abspath(os.path.splitext(str(path))[0]))
+    return comparable(recorded) == comparable(expected)
+
+
+class OutputCache:
+    """
+    処理済み出力のキャッシュインデックス（SQLite）
+    
+    元ファイルのパス・サイズ・更新時刻（必要に応じて内容のハッシュ）と
+    処理パラメータをキーとして、生成済みの出力ファイルを記録します。
+    元ファイルと出力ファイルのどちらも変化していなければ、その出力は最新とみなします。
+    """
+    
+    def __init__(self, db_path, use_hash: bool = False, commit_interval: int = 100):
+        """
+        Args:
+            db_path: キャッシュデータベースのパス
+            use_hash: 更新時刻が変わっていても内容のハッシュが同じなら最新とみなすか
+            commit_interval: 何件の書き込みごとにコミットするか
+        """
+        self.db_path = Path(db_path)
+        self.use_hash = use_hash
+        self.commit_interval = max(1, commit_interval)
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outputs (
+                source TEXT NOT NULL,
+                params TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                content_hash TEXT,
+                dest TEXT NOT NULL,
+                dest_size INTEGER NOT NULL,
+                dest_mtime_ns INTEGER NOT NULL,
+                info TEXT,
+                updated REAL NOT NULL,
+                PRIMARY KEY (source, params)
+            )
+            """
+        )
+        self._conn.commit()
+    
+    @classmethod
+    def for_directory(cls, dest_dir, **kwargs):
+        """出力先ディレクトリ直下のキャッシュを開きます"""
+        return cls(Path(dest_dir) / CACHE_DB_NAME, **kwargs)
+    
+    @staticmethod
+    def make_params(**params) -> str:
+        """処理パラメータをキャッシュキー用の文字列に変換します"""
+        return json.dumps(params, sort_keys=True, ensure_ascii=False)
+    
+    def lookup(self, source_path, params: str, dest_path=None):
+        """
+        出力が最新であればその記録を返します
+        
+        Args:
+            source_path: 元ファイルのパス
+            params: make_params で作成したパラメータ文字列
+            dest_path: 期待する出力先。指定した場合、記録の出力先と異なれば None を返します
+                （拡張子は出力形式で変わるため比較しません）
+            
+        Returns:
+            dict | None: 最新の出力があれば {'dest', 'dest_size', ...}、なければ None
+        """
+        source = str(source_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, content_hash, dest, dest_size, dest_mtime_ns, info "
+                "FROM outputs WHERE source = ? AND params = ?",
+                (source, params),
+            ).fetchone()
+        if row is None:
+            return None
+        
+        size, mtime_ns, content_hash, dest, dest_size, dest_mtime_ns, info = row
+        if dest_path is not None and not _same_output_path(dest, dest_path):
+            return None
+        try:
+            source_stat = os.stat(source)
+            dest_stat = os.stat(dest)
+        except OSError:
+            return None
+        
+        # 出力ファイルが削除・変更されていれば作り直す
+        if dest_stat.st_size != dest_size or dest_stat.st_mtime_ns != dest_mtime_ns:
+            return None
+        
+        if source_stat.st_size != size:
+            return None
+        
+        if source_stat.st_mtime_ns != mtime_ns:
+            # 更新時刻だけが変わった場合は内容のハッシュで判定（再同期などへの対策）
+            if not (self.use_hash and content_hash):
+                return None
+            try:
+                if compute_file_hash(source) != content_hash:
+                    return None
+            except OSError:
+                return None
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE outputs SET mtime_ns = ? WHERE source = ? AND params = ?",
+                    (source_stat.st_mtime_ns, source, params),
+                )
+                self._maybe_commit()
+        
+        record = json.loads(info) if info else {}
+        record.update({"dest": dest, "dest_size": dest_size})
+        return record
+    
+    def store(self, source_path, params: str, dest_path, info=None):
+        """
+        生成した出力を記録します（記録に失敗しても処理自体は継続します）
+        
+        Args:
+            source_path: 元ファイルのパス
+            params: make_params で作成したパラメータ文字列
+            dest_path: 生成した出力ファイルのパス
+            info: 併せて保存する追加情報（JSONに変換可能な dict）
+        """
+        source = str(source_path)
+        dest = str(dest_path)
+        try:
+            source_stat = os.stat(source)
+            dest_stat = os.stat(dest)
+            content_hash = compute_file_hash(source) if self.use_hash else None
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO outputs "
+                    "(source, params, size, mtime_ns, content_hash, "
+                    "dest, dest_size, dest_mtime_ns, info, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        source, params, source_stat.st_size, source_stat.st_mtime_ns, content_hash,
+                        dest, dest_stat.st_size, dest_stat.st_mtime_ns,
+                        json.dumps(info or {}, ensure_ascii=False), time.time(),
+                    ),
+                )
+                self._maybe_commit()
+        except (OSError, sqlite3.Error) as e:
+            logger.warning(f"キャッシュへの記録に失敗しました: {source}: {e}")
+    
+    def _maybe_commit(self):
+        """一定件数ごとにコミットします（ロック取得済みで呼び出すこと）"""
+        self._uncommitted += 1
+        if self._uncommitted >= self.commit_interval:
+            self._conn.commit()
+            self._uncommitted = 0
+    
+    def close(self):
+        """未コミットの記録を書き込み、データベースを閉じます"""
+        with self._lock:
+            try:
+                self._conn.commit()
+            finally:
+                self._conn.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+
+class JobJournal:
+    """
+    中断・再開用のジョブジャーナル（SQLite WAL）
+    
+    ジョブの対象ファイル一覧と、ファイルごとの完了状況を処理の都度記録します。
+    プロセスが強制終了されても記録済みの完了状況は失われず、再開時は
+    入力フォルダを再走査せずに未処理のファイルだけをジャーナルから順に読み出します。
+    対象ファイルは走査しながら記録することもでき（record）、走査の途中で中断された
+    ジョブは再走査して完了済みのファイルを除きます。
+    """
+    
+    PENDING = "pending"
+    DONE = "done"
+    ERROR = "error"
+    
+    def __init__(self, db_path, commit_interval: int = 1, fetch_size: int = 1000):
+        """
+        Args:
+            db_path: ジャーナルデータベースのパス
+            commit_interval: 何件の完了記録ごとにコミットするか（1で毎回）
+            fetch_size: 未処理ファイルを一度に読み出す件数
+        """
+        self.db_path = Path(db_path)
+        self.commit_interval = max(1, commit_interval)
+        self.fetch_size = max(1, fetch_size)
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS job (key TEXT NOT NULL, scanned INTEGER NOT NULL DEFAULT 1)"
+        )
+        # 走査完了の列がない以前のジャーナルは、常に対象ファイルを全て記録してから処理していた
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(job)")}
+        if 'scanned' not in columns:
+            self._conn.execute("ALTER TABLE job ADD COLUMN scanned INTEGER NOT NULL DEFAULT 1")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT NOT NULL UNIQUE,
+                status TEXT NOT NULL,
+                updated REAL
+            )
+            """
+        )
+        self._conn.commit()
+    
+    @classmethod
+    def for_directory(cls, dest_dir, **kwargs):
+        """出力先ディレクトリ直下のジャーナルを開きます"""
+        return cls(Path(dest_dir) / JOURNAL_DB_NAME, **kwargs)
+    
+    @property
+    def job_key(self):
+        """記録されているジョブのキー（ジョブがなければ None）"""
+        with self._lock:
+            row = self._conn.execute("SELECT key FROM job").fetchone()
+        return row[0] if row else None
+    
+    @property
+    def scan_complete(self) -> bool:
+        """対象ファイルを最後まで記録済みか（ジョブがなければ False）"""
+        with self._lock:
+            row = self._conn.execute("SELECT scanned FROM job").fetchone()
+        return bool(row and row[0])
+    
+    def can_resume(self, job_key: str) -> bool:
+        """同じジョブが未完了のまま記録されていれば True を返します"""
+        if self.job_key != job_key:
+            return False
+        return not self.scan_complete or self.pending_count() > 0
+    
+    def start(self, job_key: str, paths=None) -> int:
+        """
+        新しいジョブを開始し、対象ファイルを記録します（以前のジョブの記録は消去されます）
+        
+        Args:
+            job_key: ジョブを識別する文字列（入力・出力先・処理パラメータなど）
+            paths: 対象ファイルのイテラブル（イテレータのままでも一覧をメモリに保持しません）。
+                省略した場合は、record で走査しながら記録します
             
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        Returns:
+            int: 記録した対象ファイル数
+        """
+        with self._lock:
+            self._conn.execute("DELETE FROM job")
+            self._conn.execute("DELETE FROM files")
+            self._conn.execute(
+                "INSERT INTO job (key, scanned) VALUES (?, ?)", (job_key, int(paths is not None))
+            )
+            if paths is None:
+                self._conn.commit()
+                return 0
+            paths = iter(paths)
+            while True:
+                batch = [(str(p), self.PENDING) for p in itertools.islice(paths, self.fetch_size)]
+                if not batch:
+                    break
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO files (path, status) VALUES (?, ?)", batch
+                )
+            self._conn.commit()
+            return self._conn.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+    
+    def pending_count(self) -> int:
+        """未完了（未処理・エラー）のファイル数を返します"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM files WHERE status != ?", (self.DONE,)
+            ).fetchone()[0]
+    
+    def iter_pending(self):
+        """
+        未完了のファイルを記録順に返します（fetch_size 件ずつ読み出します）
+        
+        Yields:
+            Path: 未処理またはエラーになったファイルのパス
+        """
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT id, path FROM files WHERE id > ? AND status != ? ORDER BY id LIMIT ?",
+                    (last_id, self.DONE, self.fetch_size),
+                ).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1][0]
+            for _, path in rows:
+                yield Path(path)
+    
+    def record(self, paths):
+        """
+        走査中のファイルを対象として記録しながら、完了していないものを順に返します
+        
+        見つかったファイルをその場で記録して返すため、走査の完了を待たずに処理を始められます。
+        最後まで読み出すと走査の完了を記録します。走査の途中で中断されたジョブの再開時に
+        同じ走査を渡すと、完了済みのファイルは返しません。
+        
+        Args:
+            paths: 対象ファイルのイテラブル（iter_image_files の結果など）
             
-        processed = [Path(p) for p in data.get("processed", [])]
-        remaining = [Path(r) for r in data.get("remaining", [])]
+        Yields:
+            Path: 未処理またはエラーになったファイルのパス
+        """
+        for path in paths:
+            key = str(path)
+            with self._lock:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO files (path, status) VALUES (?, ?)", (key, self.PENDING)
+                )
+                status = self._conn.execute(
+                    "SELECT status FROM files WHERE path = ?", (key,)
+                ).fetchone()[0]
+            if status != self.DONE:
+                yield Path(path)
+        with self._lock:
+            self._conn.execute("UPDATE job SET scanned = 1")
+            self._conn.commit()
+    
+    def mark(self, path, status: str = DONE):
+        """
+        ファイルの処理結果を記録します（記録に失敗しても処理自体は継続します）
         
-        return processed, remaining
-    except Exception as e:
-        logger.error(f"進捗データ読み込みエラー: {e}")
-        return [], []
+        Args:
+            path: 対象ファイルのパス
+            status: JobJournal.DONE または JobJournal.ERROR
+        """
+        try:
+            with self._lock:
+                self._conn.execute(
+                    "UPDATE files SET status = ?, updated = ? WHERE path = ?",
+                    (status, time.time(), str(path)),
+                )
+                self._uncommitted += 1
+                if self._uncommitted >= self.commit_interval:
+                    self._conn.commit()
+                    self._uncommitted = 0
+        except sqlite3.Error as e:
+            logger.warning(f"ジャーナルへの記録に失敗しました: {path}: {e}")
+    
+    def close(self):
+        """未コミットの記録を書き込み、データベースを閉じます"""
+        with self._lock:
+            try:
+                self._conn.commit()
+            finally:
+                self._conn.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
 
 # 初期ロギング設定
@@ -10,21 +10,21 @@
 """
 
 import os
+import io
 import sys
 import json
 import argparse
 import time
 import signal
+import traceback
+from functools import lru_cache, partial
 from pathlib import Path
 from datetime import datetime
 from tqdm import tqdm
 from PIL import Image, UnidentifiedImageError
 from resize_core import (
     resize_and_compress_image,
-    find_image_files,
     create_directory_with_permissions,
-    get_directory_size,
-    calculate_reduction_rate,
     format_file_size,
     # generate_html_report, # HTMLレポート生成機能はコアに存在しないためコメントアウト
     normalize_long_path
@@ -37,6 +37,9 @@ import resize_core as core
 # デバッグモード設定
 DEBUG_MODE = False  # コマンドライン引数で上書き可能
 
+# JPEG品質の下限（目標サイズに収めるための探索でもこれ以下にはしない）
+MIN_QUALITY = 30
+
 # シグナルハンドラー変数
 interrupt_requested = False
 
@@ -57,6 +60,41 @@ def calculate_reduction_percentage(source_size, dest_size):
     
     return (source_size - dest_size) / source_size * 100
 
+def parse_byte_size(value):
+    """'500K' や '1.5M' のような表記をバイト数に変換する関数（argparse の type 用）"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = value.strip().upper().removesuffix('B')
+    try:
+        if text and text[-1] in units:
+            size = int(float(text[:-1]) * units[text[-1]])
+        else:
+            size = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"サイズの形式が正しくありません: {value}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"サイズには正の値を指定してください: {value}")
+    return size
+
+def parse_widths(value):
+    """'320,640,1280' のような幅の一覧を大きい順の整数リストに変換する関数（argparse の type 用）"""
+    try:
+        widths = {int(part) for part in value.split(',') if part.strip()}
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"幅の一覧の形式が正しくありません: {value}")
+    if not widths or min(widths) <= 0:
+        raise argparse.ArgumentTypeError(f"幅には正の整数を指定してください: {value}")
+    return sorted(widths, reverse=True)
+
+def parse_ssim(value):
+    """SSIMの目標値（0より大きく1以下）を変換する関数（argparse の type 用）"""
+    try:
+        target = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"SSIMの目標値の形式が正しくありません: {value}")
+    if not 0 < target <= 1:
+        raise argparse.ArgumentTypeError(f"SSIMの目標値は0より大きく1以下で指定してください: {value}")
+    return target
+
 def parse_args():
     """コマンドライン引数を解析する関数"""
     parser = argparse.ArgumentParser(
@@ -74,17 +112,44 @@ def parse_args():
         "-w", "--width", type=int, default=1280,
         help="リサイズ後の最大幅 (デフォルト: 1280)"
     )
+    parser.add_argument(
+        "--widths", type=parse_widths, default=None, metavar="W1,W2,...",
+        help="複数の幅で出力する（例: 320,640,1280）。1回のデコードから全ての幅を作成し、"
+             "出力先の幅ごとのサブフォルダ（例: 出力先/640/）に保存する。-w より優先"
+    )
     parser.add_argument(
         "-q", "--quality", type=int, default=85,
         help="JPEGの品質 (0-100、デフォルト: 85)"
     )
+    parser.add_argument(
+        "--max-bytes", "--target-size", dest="max_bytes", type=parse_byte_size, default=None,
+        help="1画像あたりの最大ファイルサイズ（例: 500000, 500K, 1.5M）。品質を自動調整して収める"
+    )
+    parser.add_argument(
+        "--target-ssim", type=parse_ssim, default=None, metavar="SSIM",
+        help="画像ごとに、リサイズ後の画像とのSSIMがこの値以上になる最低の品質で保存する（例: 0.95）。"
+             "-q の品質が上限。numpy が必要"
+    )
+    parser.add_argument(
+        "--codec", choices=("auto", "pillow", "mozjpeg"), default=None,
+        help="JPEGのエンコーダー。auto: 使用可能な中で最も圧縮率の高いもの（mozjpeg の cjpeg があれば使う）、"
+             "pillow: Pillow（既定）、mozjpeg: mozjpeg の cjpeg（見つからない場合は Pillow）"
+    )
     parser.add_argument(
         "--dry-run", action="store_true",
         help="ドライランモード（実際にファイルを保存せずシミュレートする）"
     )
+    parser.add_argument(
+        "--estimate", choices=["full", "sampled"], default="full",
+        help="ドライラン時のサイズ見積もり方法 (full=全体をエンコード, sampled=一部の領域から推定、デフォルト: full)"
+    )
     parser.add_argument(
         "--resume", action="store_true",
-        help="既存の出力ファイルがあればスキップする"
+        help="中断したジョブを未処理のファイルから再開し、出力キャッシュを参照して元ファイルと設定が変わっていない画像はスキップする"
+    )
+    parser.add_argument(
+        "--cache-hash", action="store_true",
+        help="更新時刻が変わっていても内容のハッシュが同じならスキップする（--resume と併用）"
     )
     parser.add_argument(
         "--log-level", default="INFO",
@@ -99,8 +164,59 @@ def parse_args():
         "--debug", action="store_true",
         help="デバッグモードを有効にする（エラー時に詳細な情報を表示）"
     )
+    parser.add_argument(
+        "--no-fast-decode", action="store_true",
+        help="JPEGの縮小デコード（DCTスケーリング）を無効にする"
+    )
+    parser.add_argument(
+        "--draft-oversample", type=float, default=core.DRAFT_OVERSAMPLE,
+        help=f"縮小デコード時に目標幅の何倍以上の解像度を確保するか (デフォルト: {core.DRAFT_OVERSAMPLE})"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="並列処理するワーカープロセス数 (0でCPUコア数、デフォルト: 1)"
+    )
+    parser.add_argument(
+        "--plan", action="store_true",
+        help="画像のヘッダーだけを読む事前走査を行い、処理計画（縮小・再エンコード・コピーの件数）を表示して終了する"
+    )
+    parser.add_argument(
+        "--plan-file", metavar="PATH",
+        help="事前走査の処理計画を保存する (.csv または .json)。--plan なしの場合は保存後に処理を続ける"
+    )
+    parser.add_argument(
+        "--copy-unresized", action="store_true",
+        help="リサイズ不要なJPEGは、デコード・再エンコードせずにそのままコピーする"
+             "（EXIF・XMPを含む画像は、メタデータを取り除くため再エンコードする）"
+    )
+    parser.add_argument(
+        "--copy-method", choices=core.COPY_METHODS, default="auto",
+        help="--copy-unresized での複製方法。auto: reflink→copy_file_range→通常コピーの順に試す、"
+             "hardlink: 同じボリューム上ならハードリンクにする（元ファイルと実体を共有する）、copy: 常に通常コピー"
+    )
+    parser.add_argument(
+        "--max-memory", type=parse_byte_size, default=None, metavar="SIZE",
+        help="同時に処理する画像の見積もりメモリ量の上限（例: 2G）。上限を超える大きな画像は単独で処理する"
+    )
+    parser.add_argument(
+        "--mmap", action="store_true",
+        help="元画像を読み込み段階でメモリに読まず、処理段階でメモリマップして直接デコードする"
+             "（ローカルSSD上の巨大なTIFF/PNGで有効）"
+    )
+    parser.add_argument(
+        "--io-threads", type=int, default=core.PIPELINE_IO_THREADS,
+        help=f"読み込み・書き込みそれぞれに使うスレッド数 (デフォルト: {core.PIPELINE_IO_THREADS})"
+    )
+    parser.add_argument(
+        "--profile-report", metavar="PATH",
+        help="処理段階ごとの計測結果（経過時間・CPU時間・バイト数）を出力する (.csv または .json)"
+    )
     
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.widths:
+        # 事前走査やメモリ見積もりは最も大きい幅を基準にする
+        args.width = args.widths[0]
+    return args
 
 def setup_logger(verbose=False):
     """
@@ -120,8 +236,8 @@ def setup_logger(verbose=False):
     )
     
     # ファイル出力用のロガー設定
-    # ログファイルの出力先ディレクトリを指定
-    log_dir = Path("/home/tn/projects/tools/edit-img/log")
+    # ログファイルの出力先ディレクトリを指定（環境変数 EDIT_IMG_LOG_DIR で変更可能）
+    log_dir = Path(os.environ.get("EDIT_IMG_LOG_DIR", "/home/tn/projects/tools/edit-img/log"))
     # ディレクトリが存在しない場合は作成
     log_dir.mkdir(parents=True, exist_ok=True)
 
@@ -141,57 +257,6 @@ def setup_logger(verbose=False):
     )
     return str(full_log_path) # 文字列として返す
 
-def get_directory_size(path):
-    """ディレクトリの合計サイズを取得"""
-    total_size = 0
-    dir_path = Path(path)
-    
-    if not dir_path.exists():
-        return 0
-    
-    for file_path in dir_path.glob('**/*'):
-        if file_path.is_file():
-            try:
-                total_size += file_path.stat().st_size
-            except OSError:
-                # ファイルアクセスエラーの場合はスキップ
-                pass
-    
-    return total_size
-
-def calculate_reduction_rate(source_dir, dest_dir):
-    """削減率を計算（%）"""
-    source_size = get_directory_size(source_dir)
-    dest_size = get_directory_size(dest_dir)
-    
-    if source_size == 0:
-        return 0
-    
-    return (source_size - dest_size) / source_size * 100
-
-def find_image_files(source_dir):
-    """指定されたディレクトリから全ての.jpgと.pngファイルを検索する"""
-    logger.info(f"ディレクトリを検索: {source_dir}")
-    
-    source_path = Path(source_dir)
-    image_files = []
-    
-    if not source_path.exists():
-        logger.error(f"ディレクトリが存在しません: {source_dir}")
-        return image_files
-    
-    try:
-        # 再帰的に画像ファイルを検索
-        for file_path in source_path.glob('**/*'):
-            if file_path.is_file() and file_path.suffix.lower() in ('.jpg', '.jpeg', '.png'):
-                image_files.append(file_path)
-                logger.debug(f"画像ファイル検出: {file_path}")
-    except Exception as e:
-        logger.error(f"ディレクトリ '{source_dir}' の検索中にエラーが発生しました: {e}")
-    
-    logger.info(f"{len(image_files)}個の画像ファイルが見つかりました。")
-    return image_files
-
 def sanitize_filename(filename):
     """ファイル名をWindows互換に変換"""
     # Windows禁止文字を置換
@@ -210,12 +275,17 @@ def get_system_encoding():
         return 'cp932'
     return 'utf-8'
 
+@lru_cache(maxsize=None)
+def normalize_directory(path):
+    """ディレクトリパスを正規化する（同じディレクトリは1回だけ正規化する）"""
+    return Path(normalize_long_path(path))
+
 def get_destination_path(source_path, source_dir, dest_dir):
     """元のパスから新しい出力先パスを生成する（Windows対応強化版）"""
     # 長いパス対応のため、入力パスを正規化
     source_path = Path(normalize_long_path(source_path))
-    source_dir = Path(normalize_long_path(source_dir))
-    dest_dir = Path(normalize_long_path(dest_dir))
+    source_dir = normalize_directory(str(source_dir))
+    dest_dir = normalize_directory(str(dest_dir))
     
     # 相対パスを取得
     try:
@@ -238,162 +308,258 @@ def get_destination_path(source_path, source_dir, dest_dir):
     # 長いパス対応のうえでパスを返す
     return Path(normalize_long_path(dest_path))
 
-def resize_and_compress_image(source_path, dest_path, target_width, quality, dry_run=False):
-    """画像をリサイズして圧縮する（メモリ効率改善版）、元ファイルより小さくなることを保証"""
-    # 長いパス対応を含め、ファイルパスを適切に正規化
-    source_path = Path(normalize_long_path(source_path))
-    dest_path = Path(normalize_long_path(dest_path))
+def log_processing_error(source_path, e):
+    """画像処理中に発生した例外を種類に応じてログ出力する関数"""
+    if isinstance(e, UnidentifiedImageError):
+        logger.error(f"有効な画像ファイルではありません: {source_path}")
+    elif isinstance(e, OSError):
+        # analyze_os_error関数を使用して詳細なエラー情報を取得
+        error_info = core.analyze_os_error(e)
+        logger.error(f"ファイルアクセスエラー: '{source_path}' 処理中: {error_info}")
+        
+        # エラー種別による追加情報
+        if os.name == 'nt' and hasattr(e, 'winerror'):
+            if e.winerror == 32:  # ファイル使用中
+                logger.info("このファイルは他のプログラムで開かれています。他のアプリケーションを閉じて再試行してください。")
+            elif e.winerror == 5:  # アクセス拒否
+                logger.info("管理者権限で実行するか、ファイルの読み取り専用属性を確認してください。")
+            elif e.winerror == 206:  # パスが長すぎる
+                logger.info("ファイルをルートに近いフォルダに移動するか、ファイル名を短くしてください。")
+    elif isinstance(e, MemoryError):
+        logger.error(f"メモリ不足エラー: '{source_path}' の処理中にメモリが不足しました")
+    else:
+        logger.error(f"画像 '{source_path}' の処理中にエラーが発生しました: {e}")
+
+def read_source_image(source_path):
+    """元画像ファイルをメモリに読み込む（パイプラインの読み込み段階）"""
+    source_path_str = normalize_long_path(source_path)
+    with core.perf_stage('read', source_path_str) as stage:
+        with open(source_path_str, 'rb') as f:
+            data = f.read()
+        stage.nbytes = len(data)
+    return data
+
+def process_image(source_path, data, target_width, quality, dry_run=False,
+                  fast_decode=True, draft_oversample=core.DRAFT_OVERSAMPLE,
+                  estimate_mode='full', max_bytes=None, widths=None, target_ssim=None, codec=None,
+                  copy_unresized=False):
+    """
+    メモリ上の画像データをリサイズして圧縮する（パイプラインの処理段階）
+    
+    元ファイルより小さく（指定があれば max_bytes 以下に）なる最高品質をメモリ上で探し、
+    書き込みは行いません。data が None の場合（--mmap）は元ファイルをメモリマップして処理します。
+    widths を指定した場合（--widths）は、1回のデコードから大きい幅の順に縮小を重ねて各幅の
+    結果を作り、widths と同じ順のリストで返します。target_ssim を指定した場合（--target-ssim）は、
+    SSIMが目標以上になる最低の品質を探索の開始品質にします。codec は JPEG のエンコードに使う
+    コーデックのバックエンドです（--codec）。copy_unresized の場合（--copy-unresized）は、
+    メタデータを含むためコピーされなかったリサイズ不要の画像で元ファイルを使わないようにします。
     
-    # ファイルパスを文字列として扱い、日本語対応を強化
+    Returns:
+        tuple: (処理結果, エンコード済みデータ)。処理結果は resize_and_compress_image と同じ形式で、
+               エンコード済みデータが None の場合は元ファイルをそのまま使用します
+    """
     source_path_str = str(source_path)
-    dest_path_str = str(dest_path)
+    
+    if data is None:
+        try:
+            with core.map_source_file(normalize_long_path(source_path)) as mapped:
+                return process_image(source_path, mapped, target_width, quality, dry_run,
+                                     fast_decode, draft_oversample, estimate_mode, max_bytes,
+                                     widths, target_ssim, codec, copy_unresized)
+        except Exception as e:
+            log_processing_error(source_path, e)
+            return (None, None), None
     
     try:
-        # 元ファイルのサイズを取得
-        original_file_size = source_path.stat().st_size
-        is_png = source_path.suffix.lower() == '.png'
+        original_file_size = len(data)
+        is_png = Path(source_path).suffix.lower() == '.png'
+        # PNGの場合はデフォルトより低い品質で開始
+        start_quality = quality - 10 if is_png else quality
         
-        # 画像を開く
-        with Image.open(source_path) as img:
+        # 画像を開く（メモリマップはそのままファイルとして渡せる）
+        with Image.open(io.BytesIO(data) if isinstance(data, bytes) else data) as img:
             # 元のサイズを取得
             original_width, original_height = img.size
             
+            # 目標幅ごとのサイズ（アスペクト比を維持。元と同じ幅ならリサイズ不要）
+            target_sizes = {}
+            for width in widths or [target_width]:
+                if original_width != width:
+                    target_sizes[width] = (width, int(original_height * (width / original_width)))
+                else:
+                    target_sizes[width] = (original_width, original_height)
+            largest_size = max(target_sizes.values())
+            if fast_decode and largest_size[0] != original_width:
+                core.apply_jpeg_draft(img, largest_size, draft_oversample)
+            
             # ドライランの場合もサイズ予測を行う
             if dry_run:
-                # 高さを計算
-                if original_width != target_width:
-                    target_height = int(original_height * (target_width / original_width))
-                    resized_img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-                else:
-                    # リサイズ不要
-                    resized_img = img
-                    target_height = original_height
-                
-                # メモリ上で一時ファイルを作成してサイズを計算
-                import io
-                start_quality = quality - 10 if is_png else quality
-                
-                # ファイルサイズ予測用のバッファ
-                buffer = io.BytesIO()
-                rgb_img = resized_img.convert('RGB')
-                
-                # 最終サイズは適切な品質での予測値
-                rgb_img.save(buffer, format='JPEG', quality=start_quality, optimize=True)
-                estimated_size = len(buffer.getvalue())
-                
-                # 元の使用中メモリを解放
-                buffer.close()
-                if resized_img is not img:
-                    del resized_img
-                del rgb_img
-                
-                return (original_width, original_height), (target_width, target_height), estimated_size
+                # 最終サイズは適切な品質での予測値（メモリ上でエンコードして計測）
+                results = []
+                for width, size in target_sizes.items():
+                    estimated_size = core.estimate_encoded_size(
+                        img, 'JPEG', {'format': 'JPEG', 'quality': start_quality, 'optimize': True},
+                        target_size=size, sampled=(estimate_mode == 'sampled')
+                    )
+                    original_size = (original_width, original_height)
+                    results.append(((original_size, size, estimated_size), None))
+                return results if widths else results[0]
             
-            # 実際の処理（ドライランでない場合）
-            # 出力先ディレクトリが存在しない場合は作成（権限対策強化版）
-            if not create_directory_with_permissions(dest_path.parent):
-                logger.error(f"出力先ディレクトリの作成に失敗しました: {dest_path.parent}")
-                return None, None
+            # 画像データのデコード（縮小デコードの設定後に読み込む）
+            with core.perf_stage('decode', source_path_str) as stage:
+                img.load()
+                stage.nbytes = original_file_size
             
-            # PNGの場合はデフォルトより低い品質で開始
-            start_quality = quality - 10 if is_png else quality
+            # --copy-unresized でメタデータを理由にコピーされなかった画像（目標幅以下のもの）は、
+            # 元ファイルを使わない
+            has_metadata = copy_unresized and core.image_has_metadata(img)
             
-            # アスペクト比を維持しながらリサイズするかどうか判断
-            if original_width != target_width:
-                # 高さを計算
-                target_height = int(original_height * (target_width / original_width))
-                resized_img = img.resize((target_width, target_height), Image.Resampling.LANCZOS)
-            else:
-                # リサイズ不要
-                logger.debug(f"リサイズ不要: すでに目標幅 {target_width}px")
-                resized_img = img
+            # 大きい幅から順に、直前の縮小結果をさらに縮小する
+            with core.perf_stage('resize', source_path_str):
+                resized_images = dict(core.iter_renditions(img, target_sizes.values()))
             
             # メモリを効率的に使うための情報
             if original_width * original_height > 4000 * 3000:  # 1200万ピクセル以上
                 logger.debug(f"大きな画像: {original_width}x{original_height} - メモリ効率モードで処理")
             
-            # 複数の品質設定で試行し、元より小さくなるものを探す
-            success = False
-            temp_file = dest_path.with_suffix('.tmp')
-            
-            # キャンバスをRGBに変換（バインドエラー防止）
-            rgb_img = resized_img.convert('RGB')
-            
-            # 4段階の品質設定で試行
-            test_qualities = [start_quality, start_quality - 10, start_quality - 20, start_quality - 30]
-            for test_quality in test_qualities:
-                if test_quality < 30:  # 最低品質の制限
-                    test_quality = 30
-                
-                try:
-                    # 一時ファイルに保存
-                    # 一時ファイル名を文字列として扱い、日本語ファイル名対応を確保
-                    rgb_img.save(str(temp_file), 'JPEG', quality=test_quality, optimize=True, progressive=True)
-                    
-                    # サイズ比較
-                    new_size = temp_file.stat().st_size
-                    if new_size < original_file_size:
-                        # 小さくなったのでリネームして成功
-                        temp_file.replace(dest_path)
-                        logger.debug(f"成功: 品質{test_quality}%でサイズ削減、{format_file_size(original_file_size)} → {format_file_size(new_size)}")
-                        success = True
-                        break
-                    else:
-                        logger.debug(f"試行: 品質{test_quality}%でもまだ大きい、{format_file_size(original_file_size)} < {format_file_size(new_size)}")
-                except Exception as e:
-                    logger.error(f"品質設定{test_quality}%での保存中にエラー: {e}")
-            
-            # すべての品質設定で小さくならなかった場合
-            if not success:
-                logger.warning(f"どの品質設定でも元より小さくならなかったため、元ファイルを使用: {source_path}")
-                # 元のファイルをコピー
-                import shutil
-                try:
-                    shutil.copy2(source_path_str, dest_path_str)
-                except Exception as copy_err:
-                    logger.error(f"ファイルコピー中にエラーが発生しました: {copy_err}")
-                    return None, None
-            
-            # 一時ファイルが残っていれば削除
-            if temp_file.exists():
-                temp_file.unlink()
-            
-            # メモリ解放
-            del rgb_img
-            if 'resized_img' in locals() and resized_img is not img:
-                del resized_img
-            
-            # 元のサイズと新しいサイズを返す
-            if original_width != target_width:
-                new_size = (target_width, target_height)
-            else:
-                new_size = (original_width, original_height)
-                
-            return (original_width, original_height), new_size
+            results = []
+            for width, size in target_sizes.items():
+                if size == (original_width, original_height):
+                    logger.debug(f"リサイズ不要: すでに目標幅 {width}px")
+                # キャンバスをRGBに変換（バインドエラー防止）。全ての試行で使い回す
+                with core.perf_stage('resize', source_path_str):
+                    rgb_img = resized_images[size].convert('RGB')
+                # 画質目標があれば、画像の内容に合わせて開始品質を下げる
+                save_options = core.tune_quality_for_ssim(
+                    rgb_img, {'format': 'JPEG', 'quality': start_quality}, target_ssim,
+                    source_path_str, codec
+                )
+                strip_metadata = has_metadata and original_width <= width
+                encoded = encode_within_budget(source_path, rgb_img, save_options['quality'],
+                                               original_file_size, max_bytes, codec, strip_metadata)
+                # 元のサイズと新しいサイズを返す
+                results.append((((original_width, original_height), size), encoded))
+            return results if widths else results[0]
     
-    except UnidentifiedImageError:
-        logger.error(f"有効な画像ファイルではありません: {source_path}")
-        return None, None
-    except OSError as e:
-        # analyze_os_error関数を使用して詳細なエラー情報を取得
-        error_info = analyze_os_error(e)
-        logger.error(f"ファイルアクセスエラー: '{source_path}' 処理中: {error_info}")
-        
-        # エラー種別による追加情報
-        if os.name == 'nt' and hasattr(e, 'winerror'):
-            if e.winerror == 32:  # ファイル使用中
-                logger.info("このファイルは他のプログラムで開かれています。他のアプリケーションを閉じて再試行してください。")
-            elif e.winerror == 5:  # アクセス拒否
-                logger.info("管理者権限で実行するか、ファイルの読み取り専用属性を確認してください。")
-            elif e.winerror == 206:  # パスが長すぎる
-                logger.info("ファイルをルートに近いフォルダに移動するか、ファイル名を短くしてください。")
-        return None, None
-    except MemoryError:
-        logger.error(f"メモリ不足エラー: '{source_path}' の処理中にメモリが不足しました")
+    except Exception as e:
+        log_processing_error(source_path, e)
+        return (None, None), None
+
+def encode_within_budget(source_path, rgb_img, start_quality, original_file_size, max_bytes=None,
+                         codec=None, strip_metadata=False):
+    """
+    元ファイルより小さく（指定があれば max_bytes 以下に）なる最高品質をメモリ上で二分探索し、
+    エンコード済みデータを返す関数（小さくできない場合は None）
+    
+    strip_metadata が True の場合（--copy-unresized でメタデータを除去する必要がある場合）は、
+    元ファイルをそのまま使うとメタデータが残るため、元より小さくできなければ探索した最低品質の
+    データを警告付きで返します。
+    """
+    byte_budget = original_file_size - 1
+    if max_bytes:
+        byte_budget = min(byte_budget, max_bytes)
+    
+    try:
+        with core.perf_stage('encode', str(source_path)) as stage:
+            encoded, used_quality, fits, stage.backend = core.encode_to_byte_budget(
+                rgb_img, byte_budget,
+                {'format': 'JPEG', 'quality': start_quality, 'optimize': True, 'progressive': True},
+                min_quality=MIN_QUALITY, codec=codec
+            )
+            stage.nbytes = len(encoded) if encoded is not None else None
+    except Exception as e:
+        logger.error(f"JPEGエンコード中にエラーが発生しました: {e}")
+        return None
+    
+    if encoded is None:
+        return None
+    if fits or len(encoded) < original_file_size:
+        if not fits:
+            logger.warning(f"品質{used_quality}%でも目標サイズ {format_file_size(max_bytes)} に"
+                           f"収まりませんでした: {source_path}")
+        logger.debug(f"品質{used_quality}%でサイズ削減、{format_file_size(original_file_size)} → "
+                     f"{format_file_size(len(encoded))}")
+        return encoded
+    if strip_metadata:
+        logger.warning(f"メタデータを除去するため、元ファイルより大きい出力を使用します "
+                       f"({format_file_size(original_file_size)} → "
+                       f"{format_file_size(len(encoded))}): {source_path}")
+        return encoded
+    return None
+
+def write_processed_image(source_path, dest_path, processed):
+    """
+    処理結果を出力先に書き込む（パイプラインの書き込み段階）
+    
+    エンコード済みデータは一時ファイル経由で書き込み、データがない場合は元ファイルをコピーします。
+    
+    Returns:
+        tuple: resize_and_compress_image と同じ形式の処理結果
+    """
+    resize_result, encoded = processed
+    # 処理失敗時・ドライラン（見積もりサイズ付きの結果）では書き込まない
+    if resize_result[0] is None or len(resize_result) > 2:
+        return resize_result
+    
+    source_path_str = normalize_long_path(source_path)
+    dest_path = Path(normalize_long_path(dest_path))
+    dest_path_str = str(dest_path)
+    
+    # 出力先ディレクトリが存在しない場合は作成（権限対策強化版）
+    with core.perf_stage('mkdir', source_path_str):
+        created, _ = core.ensure_directory(dest_path.parent)
+    if not created:
+        logger.error(f"出力先ディレクトリの作成に失敗しました: {dest_path.parent}")
         return None, None
+    
+    success = False
+    temp_file = dest_path.with_suffix('.tmp')
+    if encoded is not None:
+        try:
+            # 一時ファイル名を文字列として扱い、日本語ファイル名対応を確保
+            with core.perf_stage('write', source_path_str) as stage:
+                with open(str(temp_file), 'wb') as f:
+                    f.write(encoded)
+                stage.nbytes = len(encoded)
+            with core.perf_stage('rename', source_path_str):
+                temp_file.replace(dest_path)
+            success = True
+        except Exception as e:
+            logger.error(f"圧縮した画像の保存中にエラー: {e}")
+    
+    # どの品質設定でも小さくならなかった場合
+    if not success:
+        logger.warning(f"どの品質設定でも元より小さくならなかったため、元ファイルを使用: {source_path}")
+        # 元のファイルをコピー（reflink / copy_file_range が使えればそれを使う）
+        try:
+            core.copy_source_file(source_path_str, dest_path_str)
+        except Exception as copy_err:
+            logger.error(f"ファイルコピー中にエラーが発生しました: {copy_err}")
+            return None, None
+    
+    # 一時ファイルが残っていれば削除
+    if temp_file.exists():
+        temp_file.unlink()
+    
+    return resize_result
+
+def resize_and_compress_image(source_path, dest_path, target_width, quality, dry_run=False,
+                              fast_decode=True, draft_oversample=core.DRAFT_OVERSAMPLE,
+                              estimate_mode='full', max_bytes=None, use_mmap=False):
+    """画像をリサイズして圧縮する（メモリ効率改善版）、元ファイルより小さくなることを保証"""
+    try:
+        data = None if use_mmap else read_source_image(source_path)
     except Exception as e:
-        logger.error(f"画像 '{source_path}' の処理中にエラーが発生しました: {e}")
+        log_processing_error(source_path, e)
         return None, None
+    
+    processed = process_image(
+        source_path, data, target_width, quality, dry_run,
+        fast_decode=fast_decode, draft_oversample=draft_oversample,
+        estimate_mode=estimate_mode, max_bytes=max_bytes
+    )
+    del data
+    return write_processed_image(source_path, dest_path, processed)
 
 def format_file_size(size_in_bytes):
     """ファイルサイズを読みやすい形式に変換"""
@@ -403,6 +569,264 @@ def format_file_size(size_in_bytes):
         size_in_bytes /= 1024.0
     return f"{size_in_bytes:.2f} {unit}"
 
+def _init_worker():
+    """ワーカープロセスの初期化（Ctrl+Cは親プロセスでまとめて処理する）"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def print_profile_summary(recorder):
+    """段階ごとの計測結果の集計を表示する関数"""
+    summary = recorder.summary()
+    if not summary:
+        return
+    
+    print("\n--- 処理段階ごとの計測結果 ---")
+    print(f"{'段階':<10}{'件数':>6}{'合計(s)':>10}"
+          f"{'p50(ms)':>10}{'p95(ms)':>10}{'p99(ms)':>10}{'CPU率':>8}")
+    for stage, stats in sorted(summary.items(), key=lambda item: -item[1]['wall_total_s']):
+        cpu_ratio = f"{stats['cpu_ratio']:.2f}" if stats['cpu_ratio'] is not None else "-"
+        print(f"{stage:<10}{stats['count']:>6}{stats['wall_total_s']:>10.3f}"
+              f"{stats['wall_p50_ms']:>10.2f}{stats['wall_p95_ms']:>10.2f}"
+              f"{stats['wall_p99_ms']:>10.2f}{cpu_ratio:>8}")
+        if stats.get('backends'):
+            backends = ", ".join(f"{name}={count}" for name, count in stats['backends'].items())
+            print(f"  バックエンド: {backends}")
+
+def prepare_task(source_path, args):
+    """処理前に元ファイルサイズと出力先パスを取得する関数"""
+    try:
+        file_size_before = source_path.stat().st_size
+    except Exception:
+        file_size_before = 0
+    
+    if args.widths:
+        dest_path = get_rendition_paths(source_path, args)
+    else:
+        dest_path = get_destination_path(source_path, args.source, args.dest)
+    return file_size_before, dest_path
+
+def get_rendition_paths(source_path, args):
+    """--widths の各幅の出力先パス（出力先/幅/元の相対パス）を、幅の大きい順のリストで返す関数"""
+    return [get_destination_path(source_path, args.source, Path(args.dest) / str(width))
+            for width in args.widths]
+
+def get_output_paths(dest_path):
+    """出力先（--widths の場合は出力先のリスト）を出力パスのリストとして返す関数"""
+    return dest_path if isinstance(dest_path, list) else [dest_path]
+
+def get_cache_params(args):
+    """CLIの処理設定から出力キャッシュのキーを作成する関数"""
+    params = dict(
+        tool="cli", width=args.width, quality=args.quality, format="jpeg", keep_exif=False,
+        max_bytes=args.max_bytes,
+        fast_decode=not args.no_fast_decode, draft_oversample=args.draft_oversample
+    )
+    if args.widths:
+        params["widths"] = args.widths
+    if args.target_ssim:
+        params["target_ssim"] = args.target_ssim
+    if args.codec:
+        params["codec"] = args.codec
+    return core.OutputCache.make_params(**params)
+
+def get_job_key(args):
+    """ジョブジャーナルで同じジョブかどうかを判定するためのキーを作成する関数"""
+    return core.OutputCache.make_params(
+        source=str(Path(args.source).resolve()), dest=str(Path(args.dest).resolve()),
+        params=get_cache_params(args)
+    )
+
+def get_resize_options(args):
+    """CLI引数から resize_and_compress_image に渡す追加オプションを作成する関数"""
+    return {
+        "fast_decode": not args.no_fast_decode,
+        "draft_oversample": args.draft_oversample,
+        "estimate_mode": args.estimate,
+        "max_bytes": args.max_bytes,
+        "widths": args.widths,
+        "target_ssim": args.target_ssim,
+        "codec": args.codec,
+        "copy_unresized": args.copy_unresized,
+    }
+
+def lookup_cached_result(cache, source_path, args, dest_path=None):
+    """キャッシュ上で出力が最新ならスキップ扱いの処理結果を返す（なければ None）"""
+    if cache is None or not args.resume:
+        return None
+    
+    expected_dest = get_output_paths(dest_path)[0] if dest_path is not None else None
+    cached = cache.lookup(source_path, get_cache_params(args), expected_dest)
+    if cached is None:
+        return None
+    # --widths ではキャッシュに記録するのは最大の幅の出力だけなので、残りの出力も確認する
+    if dest_path is not None and not all(path.exists() for path in get_output_paths(dest_path)):
+        return None
+    
+    # 元サイズはそのまま、新サイズを None にしてスキップとして扱う
+    return tuple(cached.get("original_size", (0, 0))), None
+
+def read_task(source_path, args, cache=None, plans=None):
+    """
+    画像1件分の入力を準備する（パイプラインの読み込み段階）
+    
+    Returns:
+        tuple: (出力先, 元サイズ, 確定済みの処理結果, 元画像データ, コピー計画)。キャッシュ済みや
+               読み込み失敗で処理が不要な場合は確定済みの処理結果が、--copy-unresized で
+               デコードせずにコピーする場合はコピー計画（ImagePlan）が入ります
+    """
+    file_size_before, dest_path = prepare_task(source_path, args)
+    cached_result = lookup_cached_result(cache, source_path, args, dest_path)
+    if cached_result is not None:
+        return dest_path, file_size_before, cached_result, None, None
+    
+    # リサイズ不要なJPEGはヘッダーだけで判断し、読み込まずにコピーする（--widths では対象外）
+    if args.copy_unresized and not args.widths:
+        plan = get_image_plan(source_path, args, plans, file_size_before)
+        if plan.action == 'copy':
+            return dest_path, file_size_before, None, None, plan
+    
+    # --mmap の場合は読み込まず、処理段階でメモリマップする
+    if args.mmap:
+        return dest_path, file_size_before, None, None, None
+    
+    try:
+        data = read_source_image(source_path)
+    except Exception as e:
+        log_processing_error(source_path, e)
+        return dest_path, file_size_before, (None, None), None, None
+    return dest_path, file_size_before, None, data, None
+
+def process_task(source_path, task, target_width, quality, dry_run=False, **options):
+    """読み込んだ画像をリサイズ・圧縮する（パイプラインの処理段階、ワーカープロセスでも実行）"""
+    dest_path, file_size_before, ready_result, data, copy_plan = task
+    if ready_result is not None or copy_plan is not None:
+        return dest_path, file_size_before, ready_result, None, copy_plan
+    processed = process_image(source_path, data, target_width, quality, dry_run, **options)
+    return dest_path, file_size_before, None, processed, None
+
+def write_task(source_path, task, dry_run=False, copy_method='auto'):
+    """処理結果を書き込み、(出力先, 元サイズ, 処理結果) を返す（パイプラインの書き込み段階）"""
+    dest_path, file_size_before, ready_result, processed, copy_plan = task
+    if ready_result is not None:
+        return dest_path, file_size_before, ready_result
+    if copy_plan is not None:
+        return dest_path, file_size_before, copy_unresized_image(source_path, dest_path, copy_plan,
+                                                                 dry_run, copy_method)
+    if isinstance(dest_path, list):
+        return dest_path, file_size_before, write_renditions(source_path, dest_path, processed)
+    return dest_path, file_size_before, write_processed_image(source_path, dest_path, processed)
+
+def write_renditions(source_path, dest_paths, processed):
+    """
+    --widths の各幅の処理結果を書き込み、最大の幅の処理結果を返す関数
+    
+    いずれかの幅で失敗した場合は失敗として扱います。ドライランでは見積もりサイズの合計を返します。
+    """
+    # 処理段階で失敗した場合はリストではなく失敗の結果1つが返される
+    if not isinstance(processed, list):
+        return processed[0]
+    
+    results = [write_processed_image(source_path, dest_path, entry)
+               for dest_path, entry in zip(dest_paths, processed)]
+    if any(result[0] is None for result in results):
+        return None, None
+    if len(results[0]) > 2:
+        return results[0][0], results[0][1], sum(result[2] or 0 for result in results)
+    return results[0]
+
+def get_image_plan(source_path, args, plans=None, file_size=None):
+    """事前走査の計画があればそれを、なければヘッダーを読んで画像1件の処理計画を返す関数"""
+    plan = plans.get(source_path) if plans else None
+    if plan is None:
+        # CLIの出力はEXIFを保持しないため、メタデータを含む画像はコピーせず再エンコードする
+        plan = core.plan_image(source_path, args.width, 'jpeg', copy_unchanged=args.copy_unresized,
+                               file_size=file_size, keep_exif=False)
+    return plan
+
+def copy_unresized_image(source_path, dest_path, plan, dry_run=False, copy_method='auto'):
+    """リサイズ不要な画像をデコードせずに出力先へ複製する関数（複製方法は core.copy_source_file を参照）"""
+    size = (plan.width, plan.height)
+    if dry_run:
+        # コピーするだけなのでサイズは変わらない
+        return size, size, plan.file_size
+    
+    dest_path = Path(normalize_long_path(dest_path))
+    created, _ = core.ensure_directory(dest_path.parent)
+    if not created:
+        logger.error(f"出力先ディレクトリの作成に失敗しました: {dest_path.parent}")
+        return None, None
+    try:
+        used = core.copy_source_file(normalize_long_path(source_path), str(dest_path), copy_method)
+    except Exception as e:
+        log_processing_error(source_path, e)
+        return None, None
+    logger.debug(f"リサイズ不要のため複製しました ({used}): {source_path}")
+    return size, size
+
+def print_plan_summary(plans, target_width):
+    """事前走査で作成した処理計画の集計を表示する関数"""
+    labels = {
+        'resize': "縮小する",
+        'reencode': "縮小不要（再エンコード）",
+        'copy': "縮小不要（そのままコピー）",
+        'error': "読み込めない",
+    }
+    print(f"\n--- 処理計画（目標幅: {target_width}px）---")
+    print(f"{'アクション':<24}{'件数':>8}{'元サイズ合計':>14}{'画素数(MP)':>12}")
+    for action, stats in core.summarize_plan(plans).items():
+        print(f"{labels.get(action, action):<24}{stats['count']:>8}"
+              f"{format_file_size(stats['bytes']):>14}{stats['pixels'] / 1_000_000:>12.1f}")
+
+def estimate_task_memory(source_path, args, plans=None):
+    """画像1件の処理に必要なメモリ量をヘッダーだけから見積もる関数（--max-memory 用）"""
+    plan = get_image_plan(source_path, args, plans)
+    if plan.action == 'error':
+        # 画像として読み込めないファイルはデコードされないため見積もり対象外
+        return 0
+    if plan.action == 'copy':
+        return 0
+    return core.estimate_processing_memory(
+        plan.width, plan.height, plan.mode, plan.format, args.width, plan.file_size,
+        fast_decode=not args.no_fast_decode, draft_oversample=args.draft_oversample
+    )
+
+def iter_pipeline_results(image_files, args, workers, cache=None, plans=None):
+    """
+    読み込み・処理・書き込みを段階パイプラインで並行して行い、完了した順に
+    (元パス, 出力先, 元サイズ, 処理結果) を返す
+    
+    読み込みと書き込みは --io-threads 個のスレッドで行い、処理段階は workers が2以上なら
+    プロセスプールで実行します。--max-memory 指定時は、処理中の画像の見積もりメモリ量が
+    上限を超えないよう読み込みを待機します。中断リクエスト後は新しいファイルを読み込まず、
+    読み込み済みのファイルだけを最後まで処理します。
+    """
+    read_fn = partial(read_task, args=args, cache=cache, plans=plans)
+    process_fn = partial(
+        process_task, target_width=args.width, quality=args.quality, dry_run=args.dry_run,
+        **get_resize_options(args)
+    )
+    write_fn = partial(write_task, dry_run=args.dry_run, copy_method=args.copy_method)
+    executor = core.create_process_pool(workers, initializer=_init_worker) if workers > 1 else None
+    memory_budget = core.MemoryBudget(args.max_memory) if args.max_memory else None
+    
+    try:
+        for source_path, result, error in core.run_staged_pipeline(
+            image_files, read_fn, process_fn, write_fn,
+            read_workers=args.io_threads, process_workers=workers, write_workers=args.io_threads,
+            executor=executor, should_stop=lambda: interrupt_requested,
+            memory_budget=memory_budget,
+            cost_fn=partial(estimate_task_memory, args=args, plans=plans)
+        ):
+            if error is not None:
+                logger.error(f"パイプライン処理中にエラーが発生しました: {source_path}: {error}")
+                file_size_before, dest_path = prepare_task(source_path, args)
+                yield source_path, dest_path, file_size_before, (None, None)
+                continue
+            dest_path, file_size_before, resize_result = result
+            yield source_path, dest_path, file_size_before, resize_result
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
 def main():
     """メイン関数"""
     try:
@@ -443,12 +867,42 @@ def main():
                     logger.error(f"トレースバック情報:\n{error_trace}")
                 return 1
         
-        # 画像ファイルを検索
+        # 処理段階ごとの計測（--profile-report 指定時のみ）
+        recorder = core.enable_instrumentation() if args.profile_report else None
+        
+        # 中断・再開用のジョブジャーナル（ドライラン以外では常に記録する）
+        journal = None
+        if not args.dry_run and not args.plan:
+            try:
+                journal = core.JobJournal.for_directory(dest_dir)
+            except Exception as e:
+                logger.warning(f"ジョブジャーナルを開けませんでした（再開情報なしで続行します）: {e}")
+        job_key = get_job_key(args)
+        
+        # 画像ファイルは走査しながら処理する（--resume で未完了のジョブがあればジャーナルから再開）
+        # 走査しながら処理する場合、総数は分からないため None とする
+        total_files = None
         try:
-            image_files = find_image_files(source_dir)
+            if args.resume and journal is not None and journal.can_resume(job_key):
+                if journal.scan_complete:
+                    total_files = journal.pending_count()
+                    image_files = journal.iter_pending()
+                    logger.info(f"前回のジョブを再開します（残り: {total_files}件）")
+                else:
+                    # 走査の途中で中断されたジョブは、再走査して完了済みのファイルを除く
+                    image_files = journal.record(core.iter_image_files(source_dir))
+                    logger.info("前回のジョブを再開します（走査の途中だったため再走査します）")
+            else:
+                image_files = core.iter_image_files(source_dir)
+                if journal is not None:
+                    # ファイル一覧はメモリに保持せず、処理に渡す都度ジャーナルに記録する
+                    journal.start(job_key)
+                    image_files = journal.record(image_files)
             
-            if not image_files:
+            if total_files == 0:
                 logger.warning(f"ディレクトリ '{args.source}' には画像ファイルが見つかりませんでした。")
+                if journal is not None:
+                    journal.close()
                 return 0
         except Exception as e:
             logger.error(f"画像ファイル検索中にエラーが発生しました: {e}")
@@ -461,23 +915,48 @@ def main():
             logger.error(f"トレースバック情報:\n{error_trace}")
         return 1
     
-    # ディレクトリサイズ情報を取得
-    source_size = get_directory_size(args.source)
+    # ヘッダーだけを読む事前走査（--plan / --plan-file 指定時）
+    plans = None
+    if args.plan or args.plan_file:
+        image_files = list(image_files)
+        total_files = len(image_files)
+        with core.perf_stage('plan', source_dir):
+            plan_list = core.build_plan(image_files, args.width, 'jpeg',
+                                        copy_unchanged=args.copy_unresized, workers=args.io_threads,
+                                        keep_exif=False)
+        print_plan_summary(plan_list, args.width)
+        if args.plan_file:
+            try:
+                core.write_plan(plan_list, args.plan_file)
+                print(f"処理計画を保存しました: {args.plan_file}")
+            except OSError as e:
+                logger.error(f"処理計画の保存に失敗しました: {e}")
+        if args.plan:
+            if journal is not None:
+                journal.close()
+            return 0
+        plans = {plan.path: plan for plan in plan_list}
+        del plan_list
+    
+    # 入力フォルダ全体のサイズは処理と並行してバックグラウンドで走査する
+    source_size_future = core.start_directory_size_scan(args.source)
     
     logger.info(f"{'【ドライラン】' if args.dry_run else ''}処理を開始します。")
-    logger.info(f"処理対象画像ファイル数: {len(image_files)}")
+    if total_files is not None:
+        logger.info(f"処理対象画像ファイル数: {total_files}")
+    else:
+        logger.info("処理対象画像ファイル: 入力フォルダを走査しながら処理します")
     logger.info(f"ソースディレクトリ: {args.source}")
     logger.info(f"出力先ディレクトリ: {args.dest}")
-    logger.info(f"リサイズ幅: {args.width}px")
+    if args.widths:
+        logger.info(f"リサイズ幅: {', '.join(str(width) for width in args.widths)}px")
+    else:
+        logger.info(f"リサイズ幅: {args.width}px")
     logger.info(f"JPEG品質: {args.quality}%")
 
-    # 処理開始前にソースディレクトリの総サイズを取得（ドライラン時のみ）
-    if args.dry_run:
-        total_size_before_display = get_directory_size(args.source)
-        logger.info(f"処理前の総合サイズ: {format_file_size(total_size_before_display)}")
-
     # 出力ディレクトリを作成 (存在しない場合)
     # create_output_directory(args.dest, args.dry_run)
+    core.reset_directory_cache()
     success, created_path = create_directory_with_permissions(args.dest)
     if not success:
         logger.error(f"出力ディレクトリの作成に失敗しました: {created_path}")
@@ -485,11 +964,6 @@ def main():
     elif created_path:
         logger.info(f"出力ディレクトリを作成しました: {created_path}")
 
-    image_files = find_image_files(args.source)
-    if not image_files:
-        logger.warning("処理対象の画像ファイルが見つかりませんでした。")
-        return 1
-
     # 処理時間の計測開始
     start_time = time.time()
 
@@ -501,48 +975,47 @@ def main():
     total_size_after = 0
     results = []
     
+    # 出力キャッシュ（ドライラン以外では常に記録し、--resume 時に参照する）
+    cache = None
+    if not args.dry_run:
+        try:
+            # 強制終了されても記録が失われないよう、1件ごとにコミットする（WALのため低コスト）
+            cache = core.OutputCache.for_directory(
+                args.dest, use_hash=args.cache_hash, commit_interval=1
+            )
+        except Exception as e:
+            logger.warning(f"出力キャッシュを開けませんでした（キャッシュなしで続行します）: {e}")
+    cache_params = get_cache_params(args)
+    
+    # ワーカー数の決定（0の場合はCPUコア数）
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    if workers > 1:
+        logger.info(f"並列処理モード: {workers}ワーカー")
+    result_iter = iter_pipeline_results(image_files, args, workers, cache, plans)
+    
     # tqdmで進捗バーを表示
-    with tqdm(total=len(image_files), desc="画像処理中", unit="files") as progress:
-        for idx, source_path in enumerate(image_files, 1):
-            # 中断リクエストがあれば処理を停止
-            if interrupt_requested:
-                logger.info("ユーザーによる中断リクエストにより処理を停止します")
-                # 処理途中の場合は進捗を保存
-                if not args.dry_run:
-                    remaining = image_files[idx:]
-                    save_progress([], remaining)
-                break
-                
-            # 元のファイルサイズを取得
-            try:
-                file_size_before = source_path.stat().st_size
-                total_size_before += file_size_before
-            except Exception:
-                file_size_before = 0
-            
-            # 出力先パスを取得
-            dest_path = get_destination_path(source_path, args.source, args.dest)
+    with tqdm(total=total_files, desc="画像処理中", unit="files") as progress:
+        for idx, result in enumerate(result_iter, 1):
+            source_path, dest_path, file_size_before, resize_result = result
+            total_size_before += file_size_before
+            output_paths = get_output_paths(dest_path)
             
             # 処理状況を表示
             person_name = source_path.parent.name
             qualification_name = source_path.stem
             
             # 詳細情報表示（進捗バーの下に表示）
-            tqdm.write(f"[{idx}/{len(image_files)}] 処理中: {source_path}")
+            tqdm.write(f"[{idx}/{total_files or '?'}] 処理中: {source_path}")
             tqdm.write(f"  - 人物名: {person_name}")
             tqdm.write(f"  - 資格名: {qualification_name}")
             tqdm.write(f"  - 元サイズ: {format_file_size(file_size_before)}")
-            tqdm.write(f"  → 出力先: {dest_path}")
-            
-            # 画像をリサイズして圧縮
-            resize_result = resize_and_compress_image(
-                source_path, dest_path, args.width, args.quality, args.dry_run
-            )
+            for output_path in output_paths:
+                tqdm.write(f"  → 出力先: {output_path}")
             
             # ドライランの場合は3つの値が返される（サイズ予測あり）
             if args.dry_run and len(resize_result) == 3:
                 original_size, new_size, estimated_size = resize_result
-                has_size_estimate = True
+                has_size_estimate = estimated_size is not None
             else:
                 original_size, new_size = resize_result
                 has_size_estimate = False
@@ -571,9 +1044,9 @@ def main():
                     result_item["reduction"] = f"{reduction_percent:.1f}"
                 
                 # 実際の処理結果のファイルサイズを取得（ドライランでない場合）
-                elif not args.dry_run and dest_path.exists():
+                elif not args.dry_run and all(path.exists() for path in output_paths):
                     try:
-                        file_size_after = dest_path.stat().st_size
+                        file_size_after = sum(path.stat().st_size for path in output_paths)
                         total_size_after += file_size_after
                         size_diff = file_size_before - file_size_after
                         reduction_percent = (size_diff / file_size_before * 100) if file_size_before > 0 else 0
@@ -584,21 +1057,61 @@ def main():
                     except Exception:
                         result_item["new_size"] = "不明"
                         result_item["reduction"] = "0"
+                    
+                    if cache is not None:
+                        cache.store(source_path, cache_params, output_paths[0], info={
+                            "original_size": list(original_size),
+                            "new_size": list(new_size),
+                        })
             elif original_size is None:
                 tqdm.write(f"  ✗ エラー: 画像処理に失敗しました")
                 error_count += 1
                 result_item["status"] = "error"
             else:
-                tqdm.write(f"  ✗ スキップしました")
+                tqdm.write("  ✓ 出力が最新のためスキップしました")
                 skipped_count += 1
                 result_item["status"] = "skipped"
+                
+                # 既存の出力サイズも合計に含める
+                try:
+                    total_size_after += sum(path.stat().st_size for path in output_paths)
+                except OSError:
+                    pass
             
             results.append(result_item)
             tqdm.write("")  # 空行
             
+            # 完了状況をその都度ジャーナルに記録（強制終了されても再開できるように）
+            if journal is not None:
+                failed = result_item["status"] == "error"
+                journal.mark(source_path, core.JobJournal.ERROR if failed else core.JobJournal.DONE)
+            
             # 進捗バーを更新
             progress.update(1)
     
+    if cache is not None:
+        cache.close()
+    
+    # 走査しながら処理するため、画像がなかったことは処理後に分かる
+    if not results and not interrupt_requested:
+        logger.warning(f"ディレクトリ '{args.source}' には画像ファイルが見つかりませんでした。")
+        if journal is not None:
+            journal.close()
+        return 0
+    
+    # 中断された場合、未処理のファイルはジャーナルに記録済み
+    if interrupt_requested:
+        logger.info("ユーザーによる中断リクエストにより処理を停止しました")
+        if journal is not None:
+            if journal.scan_complete:
+                logger.info(f"進捗はジャーナルに記録済みです（残り: {journal.pending_count()}件）。"
+                            f"--resume で再開できます")
+            else:
+                logger.info("進捗はジャーナルに記録済みです（走査の途中のため再開時に再走査します）。"
+                            "--resume で再開できます")
+    if journal is not None:
+        journal.close()
+    
     elapsed_time = time.time() - start_time
     
     print("-" * 80)
@@ -612,15 +1125,33 @@ def main():
         reduction_percent = (size_diff / total_size_before * 100)
         print(f"合計サイズ削減: {format_file_size(total_size_before)} → {format_file_size(total_size_after)} ({reduction_percent:.1f}% 削減)")
     
+    # 入力フォルダ全体のサイズ（処理中に走査済み）
+    try:
+        source_size = source_size_future.result()
+    except Exception as e:
+        logger.warning(f"入力フォルダのサイズを取得できませんでした: {e}")
+        source_size = 0
+    # 入力フォルダのサイズは表示のみ（画像以外のファイルや前回までに処理済みのファイルを含むため）
+    if source_size > 0:
+        print(f"入力フォルダの総合サイズ: {format_file_size(source_size)}")
+    
     if not args.dry_run:
-        # ディレクトリサイズ情報
-        dest_size = get_directory_size(args.dest)
-        print(f"処理後の総合サイズ: {format_file_size(dest_size)}")
-        overall_reduction = calculate_reduction_rate(args.source, args.dest)
+        # 削減率は処理中に集計したファイルごとのサイズから求める（出力フォルダは再走査しない）
+        print(f"処理後の総合サイズ: {format_file_size(total_size_after)}")
+        overall_reduction = calculate_reduction_percentage(total_size_before, total_size_after)
         print(f"全体の削減率: {overall_reduction:.1f}%")
     
     print(f"処理時間: {elapsed_time:.2f}秒")
     
+    if recorder is not None:
+        core.disable_instrumentation()
+        print_profile_summary(recorder)
+        try:
+            recorder.dump(args.profile_report)
+            print(f"計測結果を保存しました: {args.profile_report}")
+        except OSError as e:
+            logger.error(f"計測結果の保存に失敗しました: {e}")
+    
     # HTMLレポート生成 (機能が存在しないためコメントアウト)
     # report_file = generate_html_report(results, args.source, args.dest)
     # if report_file:
@@ -1,8 +1,11 @@
 import customtkinter as ctk
 from tkinter import filedialog, TclError
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
 from pathlib import Path
+import os
+import queue
 import threading
-import time
 
 # 日本語フォント設定モジュールをインポート
 try:
@@ -20,13 +23,17 @@ except ImportError:
 
 
 try:
+    import resize_core as core
     from resize_core import (
         resize_and_compress_image,
         get_destination_path,
         sanitize_filename,
         format_file_size,
+        reset_directory_cache,
     )
 except ImportError:
+    # プロセスプールでの一括処理には resize_core が必要
+    core = None
 
     def resize_and_compress_image(*args, **kwargs):
         print("ダミー: resize_and_compress_image")
@@ -47,6 +54,42 @@ except ImportError:
             size_in_bytes /= 1024.0
         return f"{size_in_bytes:.1f} {unit}"
 
+    def reset_directory_cache():
+        pass
+
+
+# GUIの表示名 → resize_core 用の値
+RESIZE_MODES = {"パーセント": "percent", "幅指定": "width", "高さ指定": "height"}
+OUTPUT_FORMATS = {
+    "元のフォーマットを維持": "original",
+    "PNG": "png",
+    "JPEG": "jpeg",
+    "WEBP": "webp",
+}
+
+# 画面更新1回あたりに処理する進捗イベントの上限（大量の完了通知でUIが固まらないようにする）
+MAX_EVENTS_PER_POLL = 200
+
+
+def calculate_target_width(original_size, resize_mode, resize_value):
+    """
+    リサイズモードと値から、画像ごとの目標の幅（ピクセル）を求める関数
+    
+    Args:
+        original_size: 元の画像サイズ (幅, 高さ)
+        resize_mode: 'percent'（元の幅に対する割合）、'width'（幅）、'height'（高さ）
+        resize_value: リサイズの値（% またはピクセル）
+        
+    Returns:
+        int: 目標の幅（縦横比を維持した場合）
+    """
+    width, height = original_size
+    if resize_mode == "percent":
+        return max(1, round(width * resize_value / 100))
+    if resize_mode == "height":
+        return max(1, round(width * resize_value / height))
+    return max(1, int(resize_value))
+
 
 class App(ctk.CTk):
     def __init__(self):
@@ -120,6 +163,20 @@ class App(ctk.CTk):
         except Exception:
             pass
 
+        # 処理の状態を初期化（プロセスプールは初回の処理開始時に作成し、終了時まで使い回す）
+        self.process_pool = None
+        self.pool_workers = max(1, os.cpu_count() or 1)
+        self.pool_lock = threading.Lock()
+        self.batch_thread = None
+        self.cancel_event = threading.Event()
+        self.progress_events = queue.Queue()
+        self.batch_total = None
+        self.batch_done = 0
+        self.batch_succeeded = 0
+        self.batch_failed = 0
+        self.batch_error = None
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
         # 必要な変数を初期化
         self.resize_value_unit_label = None
         self.resize_quality_text_label = None
@@ -221,7 +278,7 @@ class App(ctk.CTk):
         current_row = 0
 
         ctk.CTkLabel(
-            self.resize_tab_content, text="入力ファイル:", font=self.normal_font
+            self.resize_tab_content, text="入力ファイル/フォルダ:", font=self.normal_font
         ).grid(row=current_row, column=0, padx=(10, 5), pady=10, sticky="w")
         self.resize_input_file_entry = ctk.CTkEntry(
             self.resize_tab_content, font=self.normal_font
@@ -229,18 +286,30 @@ class App(ctk.CTk):
         self.resize_input_file_entry.grid(
             row=current_row, column=1, padx=5, pady=10, sticky="ew"
         )
+        input_buttons_frame = ctk.CTkFrame(self.resize_tab_content, fg_color="transparent")
+        input_buttons_frame.grid(
+            row=current_row, column=2, padx=(5, 10), pady=10, sticky="e"
+        )
         self.resize_input_file_button = ctk.CTkButton(
-            self.resize_tab_content,
-            text="選択...",
+            input_buttons_frame,
+            text="ファイル...",
             width=80,
             font=self.button_font,
             command=lambda: self._select_file(
                 self.resize_input_file_entry, title="入力ファイルを選択"
             ),
         )
-        self.resize_input_file_button.grid(
-            row=current_row, column=2, padx=(5, 10), pady=10, sticky="e"
+        self.resize_input_file_button.grid(row=0, column=0, padx=(0, 5))
+        self.resize_input_dir_button = ctk.CTkButton(
+            input_buttons_frame,
+            text="フォルダ...",
+            width=80,
+            font=self.button_font,
+            command=lambda: self._select_directory(
+                self.resize_input_file_entry, title="入力フォルダを選択"
+            ),
         )
+        self.resize_input_dir_button.grid(row=0, column=1)
         current_row += 1
 
         ctk.CTkLabel(
@@ -483,80 +552,87 @@ class App(ctk.CTk):
         self.update_idletasks()
 
     def start_resize_process(self):
+        if self.batch_thread is not None:
+            return
         self.add_log_message("リサイズ処理を開始します...")
-        if self.resize_start_button:
-            self.resize_start_button.configure(state="disabled")
-        if self.resize_cancel_button:
-            self.resize_cancel_button.configure(state="normal")
-        self.update_progress(0.1)
 
-        input_file_str = self.resize_input_file_entry.get()
-        output_dir_str = self.resize_output_dir_entry.get()
+        input_str = self.resize_input_file_entry.get().strip()
+        output_dir_str = self.resize_output_dir_entry.get().strip()
         resize_mode_gui = self.resize_mode_var.get()
-        resize_value_str = self.resize_value_entry.get()
+        resize_value_str = self.resize_value_entry.get().strip()
         keep_aspect_ratio = self.resize_aspect_ratio_var.get()
         output_format_gui = self.resize_output_format_var.get()
-        quality = self.resize_quality_var.get()
+        quality = int(self.resize_quality_var.get())
 
-        if not input_file_str:
-            self.add_log_message(
-                "エラー: 入力ファイルが選択されていません。ファイルを選択してください。"
+        if core is None:
+            self.finish_resize_process(success=False, message="resize_core が見つからないため処理できません")
+            return
+        if not input_str:
+            self.finish_resize_process(
+                success=False,
+                message="入力ファイルまたはフォルダが選択されていません。選択してください。",
             )
-            self.finish_resize_process(success=False)
-
-        core_output_format = {
-            "JPEG": "jpeg",
-            "PNG": "png",
-            "WebP": "webp",
-            "入力と同じ": "same",
-        }.get(output_format, "same")
-
-        # 出力ファイルパスの生成
-        base_name = source_path.stem
-        ext = source_path.suffix
-
-        sanitized_stem = sanitize_filename(base_name)
-        output_filename = sanitized_stem + ext
-        dest_path = dest_dir / output_filename
+            return
+        input_path = Path(input_str)
+        if not input_path.exists():
+            self.finish_resize_process(success=False, message=f"入力が見つかりません: {input_path}")
+            return
+        if not output_dir_str:
+            self.finish_resize_process(
+                success=False, message="出力先フォルダが選択されていません。選択してください。"
+            )
+            return
+        try:
+            resize_value = float(resize_value_str)
+            if resize_value <= 0:
+                raise ValueError
+        except ValueError:
+            self.finish_resize_process(
+                success=False, message=f"リサイズの値には正の数を入力してください: '{resize_value_str}'"
+            )
+            return
 
+        resize_mode = RESIZE_MODES.get(resize_mode_gui, "percent")
+        core_output_format = OUTPUT_FORMATS.get(output_format_gui, "original")
+        if not keep_aspect_ratio:
+            self.add_log_message("注意: 縦横比を変える変形には対応していないため、縦横比を維持して処理します")
         self.add_log_message(
             f"フォーマット: {core_output_format}, 品質: {quality if core_output_format in ['jpeg', 'webp'] else 'N/A'}"
         )
 
-        self.update_progress(0.3)
-        self.processing_thread = None
-        self.cancel_requested = False
-
-        # 処理をスレッドで実行
-        try:
-            self.add_log_message("画像処理を実行中...")
-            self.processing_thread = threading.Thread(
-                target=self._process_image_thread,
-                args=(
-                    source_path,
-                    dest_path,
-                    core_resize_mode,
-                    resize_value,
-                    keep_aspect_ratio,
-                    core_output_format,
-                    quality,
-                ),
-                daemon=True
-            )
-            self.processing_thread.start()
-            
-            # 進捗状況の更新を開始
-            self.after(100, self._check_thread_status)
-        except Exception as e:
-            self.add_log_message(f"画像処理の開始中に予期せぬエラーが発生しました: {e}")
-            self.finish_resize_process(success=False, message=str(e))
+        # 前回の処理後に出力先が削除されている場合に備え、作成済みディレクトリの記録を消去
+        reset_directory_cache()
+        if self.resize_start_button:
+            self.resize_start_button.configure(state="disabled")
+        if self.resize_cancel_button:
+            self.resize_cancel_button.configure(state="normal")
+        self.update_progress(0)
+
+        self.cancel_event.clear()
+        self.batch_total = None
+        self.batch_done = 0
+        self.batch_succeeded = 0
+        self.batch_failed = 0
+        self.batch_error = None
+
+        # 走査と処理の待ち合わせはスレッドで行い、進捗はキュー経由で after() から受け取る
+        self.batch_thread = threading.Thread(
+            target=self._run_batch,
+            args=(input_path, Path(output_dir_str), resize_mode, resize_value,
+                  core_output_format, quality),
+            name="resize-batch",
+            daemon=True,
+        )
+        self.batch_thread.start()
+        self.after(100, self._poll_progress_events)
 
     def cancel_resize_process(self):
-        self.add_log_message("リサイズ処理を中断しています...")
-        self.cancel_requested = True
-        
-        # スレッドは自然に終了するのを待つ
-        # 本格的な実装では、もっと洗練された中断機構が必要
+        if self.batch_thread is None:
+            return
+        self.add_log_message("リサイズ処理を中断しています（処理中の画像は最後まで処理します）...")
+        self.cancel_event.set()
+        if self.resize_cancel_button:
+            self.resize_cancel_button.configure(state="disabled")
 
     def finish_resize_process(self, success=True, message="処理完了"):
         if success:
@@ -570,75 +646,165 @@ class App(ctk.CTk):
             self.resize_start_button.configure(state="normal")
         if self.resize_cancel_button:
             self.resize_cancel_button.configure(state="disabled")
-            
+
         # 処理関連の状態をリセット
-        self.processing_thread = None
-        self.cancel_requested = False
+        self.batch_thread = None
+        self.cancel_event.clear()
+
+    def on_close(self):
+        """ウィンドウを閉じるときに、未開始の処理を取り消してプロセスプールを終了する"""
+        self.cancel_event.set()
+        with self.pool_lock:
+            pool, self.process_pool = self.process_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+        self.destroy()
+
+    def _get_process_pool(self):
+        """
+        処理用のプロセスプールを返す（初回のみ作成）
         
-    def _process_image_thread(self, source_path, dest_path, resize_mode, resize_value, keep_aspect_ratio, output_format, quality):
-        """スレッドで実行される画像処理関数"""
+        ワーカーはモジュールの読み込みなどの起動処理を済ませた状態で次の処理にも使い回すため、
+        2回目以降の処理開始は起動のコストがかかりません。
+        """
+        with self.pool_lock:
+            if self.process_pool is None:
+                self.process_pool = core.create_process_pool(self.pool_workers)
+                self.progress_events.put(("log", f"{self.pool_workers} 個のワーカープロセスを起動しました"))
+            return self.process_pool
+
+    def _discard_process_pool(self):
+        """異常終了したプロセスプールを破棄する（次の処理開始時に作り直す）"""
+        with self.pool_lock:
+            pool, self.process_pool = self.process_pool, None
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+
+    def _read_target_width(self, item, resize_mode, resize_value):
+        """画像のヘッダーだけを読み、目標の幅を決める（パイプラインの読み込み段階、I/Oスレッドで実行）"""
+        source_path, _ = item
+        width, height, _, _ = core.read_image_header(str(source_path))
+        return calculate_target_width((width, height), resize_mode, resize_value)
+
+    def _run_batch(self, input_path, output_dir, resize_mode, resize_value, output_format, quality):
+        """
+        入力ファイルまたはフォルダ内の画像をプロセスプールで並列に処理する（スレッドで実行）
+        
+        ウィジェットには触れず、進捗は progress_events に送る:
+        ("total", 件数)、("file", item, 結果, 例外)、("log", メッセージ)、("error", メッセージ)、("finished",)
+        """
         try:
-            # キャンセル要求のチェック
-            if self.cancel_requested:
+            if input_path.is_dir():
+                source_dir = input_path
+                sources = list(core.iter_image_files(input_path, sort=True))
+            else:
+                source_dir = input_path.parent
+                sources = [input_path]
+            items = [(source, get_destination_path(source, source_dir, output_dir))
+                     for source in sources]
+            self.progress_events.put(("total", len(items)))
+            if not items:
                 return
-                
-            # 実際の画像処理を実行
-            success, stats, message = resize_and_compress_image(
-                source_path=str(source_path),
-                destination_path=str(dest_path),
-                resize_mode=resize_mode,
-                resize_value=resize_value,
-                maintain_aspect_ratio=keep_aspect_ratio,
-                output_format=output_format,
-                quality=quality
+
+            pool = self._get_process_pool()
+            results = core.run_staged_pipeline(
+                items,
+                partial(self._read_target_width,
+                        resize_mode=resize_mode, resize_value=resize_value),
+                partial(core.resize_pipeline_item, quality=quality, format=output_format),
+                lambda item, processed: processed,
+                process_workers=self.pool_workers,
+                executor=pool,
+                should_stop=self.cancel_event.is_set,
             )
-            
-            # キャンセル要求のチェック
-            if self.cancel_requested:
-                return
-                
-            # 処理結果をメインスレッドに通知
-            if success and stats:
-                original_size = stats.get('original_size', 0)
-                new_size = stats.get('new_size', 0)
-                compression_ratio = stats.get('compression_ratio', 0)
-                result_message = f"処理完了 - 元サイズ: {format_file_size(original_size)}, 新サイズ: {format_file_size(new_size)}, 圧縮率: {compression_ratio:.1f}%"
-            else:
-                result_message = message or "処理が完了しましたが、詳細情報はありません"
-                
-            # UIスレッドでの処理完了通知
-            self.after(0, lambda: self.finish_resize_process(success=success, message=result_message))
-            
+            for item, result, error in results:
+                if isinstance(error, BrokenProcessPool):
+                    self._discard_process_pool()
+                self.progress_events.put(("file", item, result, error))
         except Exception as e:
-            # エラー発生時の処理
-            error_message = f"画像処理中にエラーが発生しました: {e}"
-            self.after(0, lambda: self.finish_resize_process(success=False, message=error_message))
-            
-    def _check_thread_status(self):
-        """処理スレッドの状態をチェックし、進捗バーを更新する"""
-        if self.processing_thread and self.processing_thread.is_alive():
-            # スレッドがまだ実行中の場合、進捗を更新して再度チェックをスケジュール
-            if self.cancel_requested:
-                self.update_progress(0.5, pulse=True)  # パルスモードで進捗表示
-            else:
-                # ここでは簡易的な進捗表示。実際には処理の進行状況に応じて値を設定すべき
-                current_progress = min(0.9, self.progress_var.get() + 0.1)
-                self.update_progress(current_progress)
-                
-            # 100ms後に再度チェック
-            self.after(100, self._check_thread_status)
-        elif self.cancel_requested:
-            # キャンセルが要求され、スレッドが終了している場合
-            self.after(0, lambda: self.finish_resize_process(success=False, message="ユーザーにより中断されました"))
+            self.progress_events.put(("error", f"画像処理中にエラーが発生しました: {e}"))
+        finally:
+            self.progress_events.put(("finished",))
+
+    def _poll_progress_events(self):
+        """処理スレッドからの進捗イベントを取り出し、ログと進捗バーを更新する（after() で定期実行）"""
+        for _ in range(MAX_EVENTS_PER_POLL):
+            try:
+                event = self.progress_events.get_nowait()
+            except queue.Empty:
+                break
+            kind = event[0]
+            if kind == "total":
+                self.batch_total = event[1]
+                self.add_log_message(f"{self.batch_total} 件の画像を処理します")
+            elif kind == "file":
+                self._on_file_processed(*event[1:])
+            elif kind == "log":
+                self.add_log_message(event[1])
+            elif kind == "error":
+                self.batch_error = event[1]
+            elif kind == "finished":
+                self._on_batch_finished()
+                return
 
+        if self.batch_total is None or self.cancel_event.is_set():
+            # 走査中・中断待ちの間は件数が確定しないため、パルス表示にする
+            self.update_progress(0.5, pulse=True)
+        self.after(100, self._poll_progress_events)
+
+    def _on_file_processed(self, item, result, error):
+        """1件の処理結果をログと進捗バーに反映する"""
+        source_path, _ = item
+        self.batch_done += 1
+        if error is None and result and result[0]:
+            self.batch_succeeded += 1
+            note = "（リサイズ不要）" if result[1] else ""
+            self.add_log_message(f"処理完了{note}: {source_path.name}")
+        else:
+            self.batch_failed += 1
+            self.add_log_message(f"処理失敗: {source_path.name} - {error or '詳細はログを確認してください'}")
+        if self.batch_total:
+            self.update_progress(self.batch_done / self.batch_total)
+
+    def _on_batch_finished(self):
+        """全件の処理（または中断）が終わったときの表示を行う"""
+        summary = f"{self.batch_succeeded} 件成功、{self.batch_failed} 件失敗"
+        if self.batch_error:
+            self.finish_resize_process(success=False, message=self.batch_error)
+        elif self.cancel_event.is_set():
+            self.finish_resize_process(
+                success=False,
+                message=f"ユーザーにより中断されました（{self.batch_done}/{self.batch_total} 件処理済み: {summary}）",
+            )
+        elif self.batch_total == 0:
+            self.finish_resize_process(success=False, message="処理できる画像が見つかりませんでした")
+        else:
+            self.finish_resize_process(success=self.batch_failed == 0, message=summary)
 
 def main():
     ctk.set_appearance_mode("System")
     ctk.set_default_color_theme("blue")
 
+    # 環境変数 EDIT_IMG_PROFILE に出力先を指定すると処理段階ごとの計測を有効にする
+    profile_report = os.environ.get("EDIT_IMG_PROFILE")
+    recorder = None
+    if profile_report:
+        try:
+            import resize_core
+            recorder = resize_core.enable_instrumentation()
+        except ImportError:
+            print("resize_core が見つからないため計測を無効にします")
+
     app = App()
     app.mainloop()
 
+    if recorder is not None:
+        try:
+            recorder.dump(profile_report)
+            print(f"計測結果を保存しました: {profile_report}")
+        except OSError as e:
+            print(f"計測結果の保存に失敗しました: {e}")
+
 
 if __name__ == "__main__":
     main()
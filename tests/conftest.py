@@ -0,0 +1,13 @@
+"""テスト共通のフィクスチャ"""
+
+import pytest
+from PIL import Image
+
+
+@pytest.fixture
+def pattern_image():
+    """圧縮率が品質によって変わる、模様のあるRGB画像（320x240）"""
+    img = Image.new("RGB", (320, 240))
+    img.putdata([((x * 7) % 256, (y * 5) % 256, (x * y) % 256)
+                 for y in range(240) for x in range(320)])
+    return img
@@ -0,0 +1,29 @@
+"""バイト数の上限に収める品質探索（encode_to_byte_budget）のテスト"""
+
+import resize_core as core
+
+
+def test_result_fits_budget_and_reports_pillow_backend(pattern_image):
+    img = pattern_image
+    options = {"format": "JPEG", "quality": 95}
+    full_size = len(core.encode_image(img, options)[0])
+
+    data, quality, fits, backend = core.encode_to_byte_budget(img, full_size // 2, options)
+
+    assert fits and len(data) <= full_size // 2 and quality < 95
+    assert backend == core.select_codec_backend("JPEG").name
+
+
+def test_reports_backend_that_actually_encoded(pattern_image, monkeypatch):
+    # 外部エンコーダーが失敗して Pillow で再エンコードした場合など、選択と実際が異なるケース
+    def fallback_encode_image(img, save_options, codec=None, effort=None):
+        return b"x" * save_options["quality"], "pillow"
+
+    monkeypatch.setattr(core, "encode_image", fallback_encode_image)
+
+    _, quality, fits, backend = core.encode_to_byte_budget(
+        pattern_image, 60, {"format": "JPEG", "quality": 90}, codec="mozjpeg"
+    )
+
+    assert fits and quality == 60
+    assert backend == "pillow"
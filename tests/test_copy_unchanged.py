@@ -0,0 +1,121 @@
+"""リサイズ不要な画像のコピー（copy_unchanged / --copy-unresized）とメタデータの扱いのテスト"""
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+import resize_core as core
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def make_jpeg(path, size=(400, 300), with_exif=True, noise=False, quality=90):
+    """EXIF（撮影機器とGPS）付きのJPEGを作成する"""
+    options = {}
+    if with_exif:
+        exif = Image.Exif()
+        exif[0x010F] = "TestCamera"
+        exif[0x8825] = {1: "N", 2: (35.0, 40.0, 0.0)}
+        options["exif"] = exif.tobytes()
+    if noise:
+        # 低品質で保存したノイズ画像は、再エンコードしても小さくならない
+        img = Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3))
+    else:
+        img = Image.new("RGB", size, (120, 80, 40))
+    img.save(path, format="JPEG", quality=quality, **options)
+    return path
+
+
+def has_exif(path):
+    with Image.open(path) as img:
+        return bool(img.info.get("exif"))
+
+
+def test_plan_image_reencodes_when_metadata_must_be_removed(tmp_path):
+    source = make_jpeg(tmp_path / "exif.jpg")
+    plain = make_jpeg(tmp_path / "plain.jpg", with_exif=False)
+
+    def action(path, **options):
+        return core.plan_image(path, 800, "jpeg", copy_unchanged=True, **options).action
+
+    assert action(source) == "copy"
+    assert action(source, keep_exif=False) == "reencode"
+    assert action(plain, keep_exif=False) == "copy"
+
+
+def test_png_text_chunk_after_image_data_is_detected(tmp_path):
+    source = tmp_path / "text.png"
+    Image.new("RGB", (40, 30), (1, 2, 3)).save(source, format="PNG")
+    data = source.read_bytes()
+    # IEND の直前（画像データの後ろ）に tEXt チャンクを挿入する
+    chunk_data = b"Comment\x00secret"
+    chunk = len(chunk_data).to_bytes(4, "big") + b"tEXt" + chunk_data + b"\x00\x00\x00\x00"
+    source.write_bytes(data[:-12] + chunk + data[-12:])
+
+    assert core.has_embedded_metadata(source)
+    assert not core.has_embedded_metadata(make_jpeg(tmp_path / "plain.jpg", with_exif=False))
+
+
+def test_copy_unchanged_strips_exif_when_keep_exif_is_false(tmp_path):
+    source = make_jpeg(tmp_path / "src.jpg")
+    dest = tmp_path / "out" / "src.jpg"
+
+    success, keep_original_size, _ = core.resize_and_compress_image(
+        source, dest, 800, 85, keep_exif=False, copy_unchanged=True
+    )
+
+    assert success and keep_original_size
+    assert not has_exif(dest)
+
+
+def test_copy_unchanged_copies_bytes_when_keep_exif_is_true(tmp_path):
+    source = make_jpeg(tmp_path / "src.jpg")
+    dest = tmp_path / "out" / "src.jpg"
+
+    core.resize_and_compress_image(source, dest, 800, 85, keep_exif=True, copy_unchanged=True)
+
+    assert dest.read_bytes() == source.read_bytes()
+
+
+def run_cli(tmp_path, source_dir, dest_dir, *options):
+    env = dict(os.environ, EDIT_IMG_LOG_DIR=str(tmp_path / "log"))
+    completed = subprocess.run(
+        [sys.executable, str(REPO_ROOT / "resize_images.py"),
+         "-s", str(source_dir), "-d", str(dest_dir), "-w", "800", *options],
+        env=env, capture_output=True,
+    )
+    assert completed.returncode == 0, completed.stderr.decode("utf-8", "replace")
+
+
+def test_cli_copy_unresized_does_not_leak_exif(tmp_path):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    make_jpeg(source_dir / "exif.jpg")
+    plain = make_jpeg(source_dir / "plain.jpg", with_exif=False)
+    dest_dir = tmp_path / "out"
+
+    run_cli(tmp_path, source_dir, dest_dir, "--copy-unresized")
+
+    assert not has_exif(dest_dir / "exif.jpg")
+    # メタデータのない画像はそのままコピーされる
+    assert (dest_dir / "plain.jpg").read_bytes() == plain.read_bytes()
+
+
+def test_cli_output_is_never_larger_than_exif_source(tmp_path):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    sources = [
+        make_jpeg(source_dir / "resized.jpg", size=(1200, 900), noise=True, quality=20),
+        make_jpeg(source_dir / "unresized.jpg", size=(800, 600), noise=True, quality=20),
+    ]
+    dest_dir = tmp_path / "out"
+
+    # --copy-unresized なしでは、メタデータを含む画像でも元より大きい出力にはしない
+    run_cli(tmp_path, source_dir, dest_dir)
+
+    for source in sources:
+        output = dest_dir / source.name
+        assert output.stat().st_size <= source.stat().st_size
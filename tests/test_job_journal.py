@@ -0,0 +1,148 @@
+"""中断・再開用のジョブジャーナル（JobJournal）と --resume のテスト"""
+
+import itertools
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+from PIL import Image
+
+import resize_core as core
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def test_pending_files_are_read_back_in_order_across_batches(tmp_path):
+    paths = [tmp_path / f"{i:02d}.jpg" for i in range(7)]
+
+    with core.JobJournal(tmp_path / "journal.sqlite3", fetch_size=3) as journal:
+        assert journal.start("job", iter(paths)) == 7
+        journal.mark(paths[1])
+        journal.mark(paths[4], core.JobJournal.ERROR)
+
+        # エラーになったファイルは未完了として残る
+        assert journal.pending_count() == 6
+        assert list(journal.iter_pending()) == [p for i, p in enumerate(paths) if i != 1]
+
+
+def test_journal_survives_reopen_and_resumes_same_job_only(tmp_path):
+    db_path = tmp_path / "journal.sqlite3"
+    paths = [tmp_path / "a.jpg", tmp_path / "b.jpg"]
+
+    with core.JobJournal(db_path) as journal:
+        journal.start("job", paths)
+        journal.mark(paths[0])
+
+    with core.JobJournal(db_path) as journal:
+        assert journal.can_resume("job")
+        assert not journal.can_resume("other-job")
+        assert list(journal.iter_pending()) == [paths[1]]
+        journal.mark(paths[1])
+        # 全て完了したジョブは再開しない
+        assert not journal.can_resume("job")
+
+
+def test_starting_a_new_job_discards_previous_records(tmp_path):
+    with core.JobJournal(tmp_path / "journal.sqlite3") as journal:
+        journal.start("old", [tmp_path / "a.jpg"])
+        journal.start("new", [tmp_path / "b.jpg"])
+
+        assert journal.job_key == "new"
+        assert list(journal.iter_pending()) == [tmp_path / "b.jpg"]
+
+
+def test_record_returns_files_as_they_are_scanned(tmp_path):
+    scanned = []
+
+    def scan():
+        for i in range(5):
+            scanned.append(i)
+            yield tmp_path / f"{i}.jpg"
+
+    with core.JobJournal(tmp_path / "journal.sqlite3") as journal:
+        journal.start("job")
+        recording = journal.record(scan())
+
+        # 最初のファイルは走査の完了を待たずに返る
+        assert next(recording) == tmp_path / "0.jpg"
+        assert scanned == [0]
+        assert journal.can_resume("job") and not journal.scan_complete
+
+        assert list(recording) == [tmp_path / f"{i}.jpg" for i in range(1, 5)]
+        assert journal.scan_complete and journal.pending_count() == 5
+
+
+def test_record_skips_done_files_when_an_interrupted_scan_is_repeated(tmp_path):
+    paths = [tmp_path / f"{i}.jpg" for i in range(4)]
+
+    with core.JobJournal(tmp_path / "journal.sqlite3") as journal:
+        journal.start("job")
+        # 走査の途中（2件目まで）で中断されたジョブ
+        for path in itertools.islice(journal.record(iter(paths)), 2):
+            journal.mark(path)
+
+    with core.JobJournal(tmp_path / "journal.sqlite3") as journal:
+        assert journal.can_resume("job") and not journal.scan_complete
+        assert list(journal.record(paths)) == paths[2:]
+        assert journal.scan_complete
+
+
+def run_cli(tmp_path, source_dir, dest_dir, *options):
+    env = dict(os.environ, EDIT_IMG_LOG_DIR=str(tmp_path / "log"))
+    completed = subprocess.run(
+        [sys.executable, str(REPO_ROOT / "resize_images.py"),
+         "-s", str(source_dir), "-d", str(dest_dir), "-w", "200", *options],
+        env=env, capture_output=True,
+    )
+    assert completed.returncode == 0, completed.stderr.decode("utf-8", "replace")
+
+
+def test_cli_resume_processes_only_remaining_files(tmp_path):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    names = ["a.jpg", "b.jpg", "c.jpg", "d.jpg"]
+    for i, name in enumerate(names):
+        Image.new("RGB", (400, 300), (i * 60, 80, 40)).save(source_dir / name, quality=90)
+    dest_dir = tmp_path / "out"
+    run_cli(tmp_path, source_dir, dest_dir)
+
+    # c・d の処理中に中断された状態を再現する（出力がなく、ジャーナル上は未完了）
+    with core.JobJournal.for_directory(dest_dir) as journal:
+        for name in ["c.jpg", "d.jpg"]:
+            journal.mark(source_dir / name, core.JobJournal.PENDING)
+            (dest_dir / name).unlink()
+        assert journal.pending_count() == 2
+    # 完了済みの出力も消しておき、再開時に処理されないことを確かめる
+    for name in ["a.jpg", "b.jpg"]:
+        (dest_dir / name).unlink()
+
+    run_cli(tmp_path, source_dir, dest_dir, "--resume")
+
+    assert sorted(p.name for p in dest_dir.glob("*.jpg")) == ["c.jpg", "d.jpg"]
+    with core.JobJournal.for_directory(dest_dir) as journal:
+        assert journal.pending_count() == 0
+
+
+def test_cli_resume_rescans_a_job_interrupted_during_the_scan(tmp_path):
+    source_dir = tmp_path / "src"
+    source_dir.mkdir()
+    names = ["a.jpg", "b.jpg", "c.jpg", "d.jpg"]
+    for i, name in enumerate(names):
+        Image.new("RGB", (400, 300), (i * 60, 80, 40)).save(source_dir / name, quality=90)
+    dest_dir = tmp_path / "out"
+    run_cli(tmp_path, source_dir, dest_dir)
+
+    # a・b だけを走査・処理した時点で中断された状態を再現する
+    with core.JobJournal.for_directory(dest_dir) as journal:
+        journal.start(journal.job_key)
+        for path in itertools.islice(journal.record(source_dir / name for name in names), 2):
+            journal.mark(path)
+    for output in dest_dir.glob("*.jpg"):
+        output.unlink()
+
+    run_cli(tmp_path, source_dir, dest_dir, "--resume")
+
+    assert sorted(p.name for p in dest_dir.glob("*.jpg")) == ["c.jpg", "d.jpg"]
+    with core.JobJournal.for_directory(dest_dir) as journal:
+        assert journal.scan_complete and journal.pending_count() == 0
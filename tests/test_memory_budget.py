@@ -0,0 +1,65 @@
+"""メモリ量の受付制御（MemoryBudget）のテスト"""
+
+import threading
+import time
+
+import resize_core as core
+
+
+def start_acquire(budget, nbytes, results, cancel=None):
+    def acquire():
+        results.append((nbytes, budget.acquire(nbytes, cancel.is_set if cancel else None)))
+
+    thread = threading.Thread(target=acquire)
+    thread.start()
+    return thread
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_requests_within_limit_are_admitted_together():
+    budget = core.MemoryBudget(100)
+
+    assert budget.acquire(40) and budget.acquire(60)
+    assert budget.used == 100
+
+
+def test_small_requests_wait_behind_oversize_request():
+    budget = core.MemoryBudget(100)
+    assert budget.acquire(60)
+    results = []
+
+    oversize = start_acquire(budget, 500, results)
+    wait_until(lambda: budget._oversize_waiting)
+    # 上限内に収まる小さな予約でも、大きな画像が待っている間は受け付けない
+    small = start_acquire(budget, 10, results)
+    time.sleep(0.3)
+    assert results == [] and budget.used == 60
+
+    budget.release(60)
+    oversize.join(timeout=5)
+    assert results == [(500, True)] and budget.used == 500
+
+    budget.release(500)
+    small.join(timeout=5)
+    assert results == [(500, True), (10, True)]
+
+
+def test_cancelled_oversize_request_unblocks_others():
+    budget = core.MemoryBudget(100)
+    assert budget.acquire(60)
+    results = []
+    cancel = threading.Event()
+
+    oversize = start_acquire(budget, 500, results, cancel)
+    wait_until(lambda: budget._oversize_waiting)
+    cancel.set()
+    oversize.join(timeout=5)
+
+    assert results == [(500, False)]
+    assert budget.acquire(40) and budget.used == 100
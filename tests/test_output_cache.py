@@ -0,0 +1,77 @@
+"""出力キャッシュ（OutputCache）のキーに処理設定が反映されることのテスト"""
+
+import pytest
+from PIL import Image
+
+import resize_core as core
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "src.jpg"
+    Image.new("RGB", (640, 480), (30, 120, 200)).save(path, format="JPEG", quality=90)
+    return path
+
+
+@pytest.fixture
+def encode_calls(monkeypatch):
+    """resize_and_compress_image が実際にエンコードした回数を数える"""
+    calls = []
+    original = core.encode_image
+
+    def counting_encode_image(img, save_options, codec=None, effort=None):
+        calls.append(codec)
+        return original(img, save_options, codec, effort)
+
+    monkeypatch.setattr(core, "encode_image", counting_encode_image)
+    return calls
+
+
+def run(source, dest, cache, **options):
+    success, _, _ = core.resize_and_compress_image(source, dest, 200, 85, cache=cache, **options)
+    assert success
+
+
+def test_same_settings_are_skipped(tmp_path, source, encode_calls):
+    with core.OutputCache(tmp_path / "cache.sqlite3", commit_interval=1) as cache:
+        run(source, tmp_path / "out.jpg", cache)
+        run(source, tmp_path / "out.jpg", cache)
+
+    assert len(encode_calls) == 1
+
+
+def test_target_ssim_invalidates_cached_output(tmp_path, source, encode_calls, monkeypatch):
+    tuned = []
+
+    def fake_tune(img, save_options, target_ssim, name=None, codec=None):
+        tuned.append(target_ssim)
+        return save_options
+
+    monkeypatch.setattr(core, "tune_quality_for_ssim", fake_tune)
+
+    with core.OutputCache(tmp_path / "cache.sqlite3", commit_interval=1) as cache:
+        run(source, tmp_path / "out.jpg", cache)
+        run(source, tmp_path / "out.jpg", cache, target_ssim=0.99)
+        run(source, tmp_path / "out.jpg", cache, target_ssim=0.99)
+
+    assert len(encode_calls) == 2
+    assert tuned == [None, 0.99]
+
+
+def test_codec_invalidates_cached_output(tmp_path, source, encode_calls):
+    with core.OutputCache(tmp_path / "cache.sqlite3", commit_interval=1) as cache:
+        run(source, tmp_path / "out.jpg", cache)
+        run(source, tmp_path / "out.jpg", cache, codec="auto")
+        run(source, tmp_path / "out.jpg", cache, codec="auto")
+
+    assert encode_calls == [None, "auto"]
+
+
+def test_changed_destination_is_written(tmp_path, source, encode_calls):
+    with core.OutputCache(tmp_path / "cache.sqlite3", commit_interval=1) as cache:
+        run(source, tmp_path / "out.jpg", cache)
+        run(source, tmp_path / "other" / "out.jpg", cache)
+        run(source, tmp_path / "other" / "out.jpg", cache)
+
+    assert len(encode_calls) == 2
+    assert (tmp_path / "other" / "out.jpg").exists()
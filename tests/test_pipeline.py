@@ -0,0 +1,128 @@
+"""読み込み・処理・書き込みの段階パイプライン（run_staged_pipeline）のテスト"""
+
+import itertools
+import operator
+import threading
+import time
+
+import resize_core as core
+
+
+def wait_until(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def pipeline_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("pipeline-")]
+
+
+def run(items, read_fn=lambda item: item * 10, process_fn=operator.add,
+        write_fn=lambda item, processed: (item, processed), **options):
+    return list(core.run_staged_pipeline(items, read_fn, process_fn, write_fn, **options))
+
+
+def test_single_worker_stages_keep_input_order():
+    results = run(range(20), read_workers=1, process_workers=1, write_workers=1)
+
+    assert [item for item, _, _ in results] == list(range(20))
+    assert all(result == (item, item * 11) and error is None for item, result, error in results)
+
+
+def test_parallel_stages_return_every_item_once():
+    results = run(range(200), read_workers=4, process_workers=4, write_workers=4, queue_size=2)
+
+    assert sorted(item for item, _, _ in results) == list(range(200))
+    assert all(result == (item, item * 11) for item, result, _ in results)
+
+
+def test_errors_are_reported_per_item_and_do_not_stop_the_pipeline():
+    def fail_on(bad, value):
+        if value == bad:
+            raise ValueError(bad)
+        return value
+
+    results = run(
+        range(10),
+        read_fn=lambda item: fail_on(3, item),
+        process_fn=lambda item, payload: fail_on(5, payload),
+        write_fn=lambda item, processed: fail_on(7, processed),
+    )
+
+    by_item = {item: (result, error) for item, result, error in results}
+    assert sorted(by_item) == list(range(10))
+    for bad in (3, 5, 7):
+        result, error = by_item[bad]
+        assert result is None and isinstance(error, ValueError)
+    assert all(by_item[item] == (item, None) for item in by_item if item not in (3, 5, 7))
+
+
+def test_bounded_queues_stall_reading_and_stop_drains_read_items():
+    read = []
+    release_writer = threading.Event()
+    stop = threading.Event()
+    results = []
+
+    def read_fn(item):
+        read.append(item)
+        return item
+
+    def write_fn(item, processed):
+        release_writer.wait(timeout=5)
+        return processed
+
+    def consume():
+        results.extend(core.run_staged_pipeline(
+            itertools.count(), read_fn, lambda item, payload: payload, write_fn,
+            read_workers=1, process_workers=1, write_workers=1, queue_size=1,
+            should_stop=stop.is_set,
+        ))
+
+    consumer = threading.Thread(target=consume)
+    consumer.start()
+    time.sleep(0.3)
+    # 書き込みが詰まっている間は、各段階とキューに1件ずつしか読み込まれない
+    assert len(read) <= 5
+
+    stop.set()
+    release_writer.set()
+    consumer.join(timeout=5)
+
+    assert not consumer.is_alive()
+    assert sorted(item for item, _, _ in results) == sorted(read)
+    wait_until(lambda: not pipeline_threads())
+
+
+def test_closing_the_generator_cancels_all_stages():
+    pipeline = core.run_staged_pipeline(
+        itertools.count(), lambda item: item, lambda item, payload: payload,
+        lambda item, processed: processed, queue_size=1,
+    )
+    consumed = [next(pipeline) for _ in range(3)]
+    pipeline.close()
+
+    assert len(consumed) == 3
+    wait_until(lambda: not pipeline_threads())
+
+
+def test_memory_budget_is_released_for_every_item():
+    budget = core.MemoryBudget(100)
+
+    results = run(range(30), memory_budget=budget, cost_fn=lambda item: 40,
+                  read_fn=lambda item: 1 / (item % 7))
+
+    assert len(results) == 30
+    assert sum(error is not None for _, _, error in results) == 5
+    assert budget.used == 0
+
+
+def test_process_pool_runs_the_processing_stage():
+    executor = core.create_process_pool(2)
+    try:
+        results = run(range(20), executor=executor, process_workers=2)
+    finally:
+        executor.shutdown()
+
+    assert sorted(result for _, result, _ in results) == sorted((i, i * 11) for i in range(20))
@@ -0,0 +1,35 @@
+"""画質目標（target_ssim）の品質探索が選んだコーデックでエンコードされることのテスト"""
+
+import pytest
+
+import resize_core as core
+
+pytest.importorskip("numpy")
+
+
+def test_proxy_is_encoded_with_requested_codec(pattern_image, monkeypatch):
+    codecs = []
+    original = core.encode_image
+
+    def recording_encode_image(img, save_options, codec=None, effort=None):
+        codecs.append(codec)
+        return original(img, save_options, codec, effort)
+
+    monkeypatch.setattr(core, "encode_image", recording_encode_image)
+
+    options = {"format": "JPEG", "quality": 90}
+    quality = core.find_quality_for_ssim(pattern_image, options, 0.9, codec="auto")
+
+    assert 30 <= quality <= 90
+    assert codecs and set(codecs) == {"auto"}
+
+
+def test_undecodable_proxy_falls_back_to_upper_quality(pattern_image, monkeypatch):
+    # Pillow が読めないデータを返すバックエンド（AVIF プラグインなしの avifenc など）の代わり
+    def unreadable_encode_image(img, save_options, codec=None, effort=None):
+        return b"not an image", "avifenc"
+
+    monkeypatch.setattr(core, "encode_image", unreadable_encode_image)
+    options = {"format": "AVIF", "quality": 70}
+
+    assert core.find_quality_for_ssim(pattern_image, options, 0.95, codec="avifenc") == 70